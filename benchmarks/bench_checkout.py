@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Time the checkout of a large synthetic tree with different numbers of
+workers.
+
+    python3 benchmarks/bench_checkout.py [--files 100000] [--jobs 1 2 4 8]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import synthetic
+import libtft
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark tft checkout")
+    argparser.add_argument("--files", type=int, default=100000, help="Number of files in the tree.")
+    argparser.add_argument("--depth", type=int, default=3, help="Maximum directory depth.")
+    argparser.add_argument("--blob-size", dest="blob_size", type=int, default=1024, help="Size of each file in bytes.")
+    argparser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8], help="Worker counts to compare.")
+    args = argparser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="tft-bench-")
+    try:
+        start = time.perf_counter()
+        repo = synthetic.generate(os.path.join(tmp, "repo"), files=args.files, depth=args.depth, commits=1,
+                                  min_blob=args.blob_size, max_blob=args.blob_size, checkout=False)
+        tree = libtft.object_find(repo, "master", fmt=b'tree')
+        print("Generated {0} files in {1:.2f}s".format(args.files, time.perf_counter() - start))
+
+        print("{0:>6} {1:>10} {2:>12}".format("jobs", "seconds", "files/sec"))
+        for jobs in args.jobs:
+            path = os.path.join(tmp, "checkout-{0}".format(jobs))
+            os.makedirs(path)
+            start = time.perf_counter()
+            libtft.tree_checkout(repo, tree, path, jobs)
+            elapsed = time.perf_counter() - start
+            print("{0:>6} {1:>10.2f} {2:>12.0f}".format(jobs, elapsed, args.files / elapsed))
+            shutil.rmtree(path)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
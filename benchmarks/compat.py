@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Check that git reads what tft writes, and that both agree.
+
+    python3 benchmarks/compat.py [--files 300 --commits 60 ...]
+
+A synthetic repository is written by tft, then every check runs a tft
+command and the git one it stands for, or has git verify the files tft
+wrote: the objects and packs (git fsck), the index, bitmaps (git rev-list
+--test-bitmap), multi-pack-indexes (git multi-pack-index verify), a
+fast-export of the repository imported again (same SHAs), clones, and
+checkouts, sparse ones included (git status on a sparse index).  Prints
+one line per check; any failure makes the run fail.
+"""
+
+import argparse
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import zipfile
+
+import synthetic
+
+TFT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tft")
+
+def tft(cwd, *argv, input=None, check=True):
+    """Run tft argv in cwd and return its stdout."""
+    return run([ sys.executable, TFT ] + list(argv), cwd, input, check)
+
+def git(cwd, *argv, input=None, check=True):
+    """Run git argv in cwd and return its stdout."""
+    return run([ "git" ] + list(argv), cwd, input, check)
+
+def run(argv, cwd, input, check):
+    p = subprocess.run(argv, cwd=cwd, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if check and p.returncode:
+        raise Exception("{0} failed with status {1}: {2}".format(
+            " ".join(argv[1:] if argv[0] == sys.executable else argv), p.returncode,
+            p.stderr.decode(errors="replace").strip()))
+    return p.stdout
+
+def same(what, ours, theirs):
+    if ours == theirs:
+        return
+    if isinstance(ours, list) and isinstance(theirs, list):
+        # The first entry that differs
+        diff = [ (a, b) for a, b in zip(ours + [ None ] * len(theirs), theirs + [ None ] * len(ours)) if a != b ]
+        ours, theirs = diff[0]
+    raise Exception("{0} differs from git:\n  tft: {1}\n  git: {2}".format(
+        what, repr(ours)[:300], repr(theirs)[:300]))
+
+def lines(out):
+    return sorted(out.decode().splitlines())
+
+def check_fsck(repo, tmp):
+    git(repo, "fsck", "--strict", "--no-dangling")
+    tft(repo, "fsck")
+
+def check_index(repo, tmp):
+    same("status", git(repo, "status", "--porcelain"), b'')
+    same("diff-index", git(repo, "diff-index", "--cached", "HEAD"), b'')
+    same("ls-files", tft(repo, "ls-files"), git(repo, "ls-files"))
+    same("ls-tree -r", tft(repo, "ls-tree", "-r", "HEAD"), git(repo, "ls-tree", "-r", "HEAD"))
+
+def check_rev_list(repo, tmp):
+    same("rev-list", lines(tft(repo, "rev-list", "HEAD")), lines(git(repo, "rev-list", "HEAD")))
+    old = git(repo, "rev-parse", "HEAD~10").decode().strip()
+    same("rev-list ^old", lines(tft(repo, "rev-list", "HEAD", "^" + old)),
+         lines(git(repo, "rev-list", "HEAD", "^" + old)))
+    same("rev-list --objects", lines(tft(repo, "rev-list", "--objects", "HEAD")),
+         sorted(line[:40] for line in git(repo, "rev-list", "--objects", "HEAD").decode().splitlines()))
+
+def check_merge_base(repo, tmp):
+    merges = [ line.split() for line in git(repo, "rev-list", "--merges", "--parents", "HEAD").decode().splitlines() ]
+    if not merges:
+        raise Exception("No merges to check, use a higher --merge-density")
+    for _, a, b in merges[:20]:
+        same("merge-base --all", lines(tft(repo, "merge-base", "--all", a, b)),
+             lines(git(repo, "merge-base", "--all", a, b)))
+        for x, y in ((a, b), (b, a), (a, a)):
+            ours = subprocess.run([ sys.executable, TFT, "merge-base", "--is-ancestor", x, y ], cwd=repo).returncode
+            theirs = subprocess.run([ "git", "merge-base", "--is-ancestor", x, y ], cwd=repo).returncode
+            same("merge-base --is-ancestor", ours, theirs)
+
+def check_bitmap(repo, tmp):
+    tft(repo, "bitmap", "--interval", "10")
+    git(repo, "rev-list", "--test-bitmap", "HEAD")
+    same("rev-list --objects with a bitmap", lines(tft(repo, "rev-list", "--objects", "HEAD")),
+         sorted(line[:40] for line in git(repo, "rev-list", "--objects", "HEAD").decode().splitlines()))
+
+def check_count_objects(repo, tmp):
+    same("count-objects -v", tft(repo, "count-objects", "-v"), git(repo, "count-objects", "-v"))
+
+def check_grep(repo, tmp):
+    same("grep -n", lines(tft(repo, "grep", "-n", "abc")), lines(git(repo, "grep", "-n", "abc")))
+    old = git(repo, "rev-parse", "HEAD~5").decode().strip()
+    same("grep -l <commit>", lines(tft(repo, "grep", "-l", "abc", old)), lines(git(repo, "grep", "-l", "abc", old)))
+
+def check_archive(repo, tmp):
+    def tar_members(data):
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            return sorted((m.name, m.mode, m.isdir(), tar.extractfile(m).read() if m.isfile() else None)
+                          for m in tar.getmembers())
+    top = git(repo, "ls-tree", "--name-only", "HEAD").decode().splitlines()[0]
+    for argv in ([ "HEAD" ], [ "--prefix=p/", "HEAD" ], [ "--prefix=a/b/", "HEAD", "--", top ]):
+        same("archive " + " ".join(argv), tar_members(tft(repo, "archive", *argv)), tar_members(git(repo, "archive", *argv)))
+
+    # Only names and contents: git stores zip attributes the MS-DOS way,
+    # tft with unix modes
+    def zip_members(data):
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            return sorted((i.filename, z.read(i)) for i in z.infolist())
+    same("archive zip", zip_members(tft(repo, "archive", "--format=zip", "HEAD")),
+         zip_members(git(repo, "archive", "--format=zip", "HEAD")))
+
+def check_fast_import(repo, tmp):
+    stream = git(repo, "fast-export", "--all")
+    target = os.path.join(tmp, "imported")
+    tft(tmp, "init", target)
+    tft(target, "fast-import", input=stream)
+    same("refs after fast-export | fast-import", git(target, "for-each-ref"), git(repo, "for-each-ref"))
+    git(target, "fsck", "--strict", "--no-dangling")
+
+def check_multi_pack_index(repo, tmp):
+    # A few more packs, written by fast-import at each checkpoint
+    head = git(repo, "rev-parse", "HEAD").decode().strip()
+    stream = b''
+    for i in range(3):
+        data = "extra {0}\n".format(i).encode()
+        stream += b"commit refs/heads/extra\ncommitter Bench <bench@example.com> 1800000000 +0000\n"
+        stream += b"data 6\nextra\n" + (b"from " + head.encode() + b"\n" if i == 0 else b"")
+        stream += b"M 100644 inline extra.txt\ndata " + str(len(data)).encode() + b"\n" + data + b"\ncheckpoint\n\n"
+    tft(repo, "fast-import", input=stream)
+    packs = [ p for p in os.listdir(os.path.join(repo, ".git", "objects", "pack")) if p.endswith(".pack") ]
+    if len(packs) < 4:
+        raise Exception("Only {0} packs to index".format(len(packs)))
+
+    tft(repo, "multi-pack-index", "write")
+    git(repo, "multi-pack-index", "verify")
+    tft(repo, "multi-pack-index", "verify")
+    git(repo, "fsck", "--strict", "--no-dangling")
+    same("rev-list --objects --all with a multi-pack-index",
+         lines(tft(repo, "rev-list", "--objects", "extra", "master")),
+         sorted(line[:40] for line in git(repo, "rev-list", "--objects", "--all").decode().splitlines()))
+
+def check_clone(repo, tmp):
+    clone = os.path.join(tmp, "clone")
+    tft(tmp, "clone", repo, clone)
+    git(clone, "fsck", "--strict", "--no-dangling")
+    same("clone status", git(clone, "status", "--porcelain"), b'')
+    same("clone HEAD", git(clone, "rev-parse", "HEAD"), git(repo, "rev-parse", "HEAD"))
+
+def check_checkout(repo, tmp):
+    clone = os.path.join(tmp, "clone")
+    old = git(clone, "rev-parse", "HEAD~7").decode().strip()
+    tft(clone, "checkout", old)
+    same("HEAD after checkout", git(clone, "rev-parse", "HEAD").decode().strip(), old)
+    same("status after checkout", git(clone, "status", "--porcelain"), b'')
+
+    # A file the checkout would overwrite keeps its local changes
+    changed = git(clone, "diff", "--name-only", old, "master").decode().splitlines()[0]
+    with open(os.path.join(clone, changed), "ab") as f:
+        f.write(b"local change\n")
+    if subprocess.run([ sys.executable, TFT, "checkout", "master" ], cwd=clone,
+                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+        raise Exception("checkout overwrote the local changes of {0}".format(changed))
+    same("status after a refused checkout", git(clone, "status", "--porcelain").decode().split(), [ "M", changed ])
+
+    tft(clone, "checkout", "-f", "master")
+    same("HEAD after checkout -f", git(clone, "symbolic-ref", "HEAD"), b"refs/heads/master\n")
+    same("status after checkout -f", git(clone, "status", "--porcelain"), b'')
+
+def check_diff(repo, tmp):
+    clone = os.path.join(tmp, "clone")
+    files = git(clone, "ls-files").decode().splitlines()
+    with open(os.path.join(clone, files[0]), "ab") as f:
+        f.write(b"unstaged\n")
+    with open(os.path.join(clone, files[1]), "ab") as f:
+        f.write(b"staged\n")
+    os.remove(os.path.join(clone, files[2]))
+    with open(os.path.join(clone, "new.txt"), "wb") as f:
+        f.write(b"new\n")
+    git(clone, "add", files[1], "new.txt")
+
+    old = git(clone, "rev-parse", "HEAD~3").decode().strip()
+    for argv in ([], [ "--cached" ], [ old ], [ "--cached", old ], [ old, "HEAD" ]):
+        same("diff --name-status " + " ".join(argv), tft(clone, "diff", "--name-status", *argv),
+             git(clone, "diff", "--name-status", *argv))
+    git(clone, "reset", "-q", "--hard")
+
+def check_sparse_checkout(repo, tmp):
+    clone = os.path.join(tmp, "clone")
+    dirs = sorted(set(path.split("/")[0] for path in git(clone, "ls-files").decode().splitlines() if "/" in path))
+    tft(clone, "sparse-checkout", "set", "--sparse-index", *dirs[:2])
+    same("status on a sparse index", git(clone, "status", "--porcelain"), b'')
+    same("sparse-checkout list", tft(clone, "sparse-checkout", "list"), git(clone, "sparse-checkout", "list"))
+    collapsed = [ path for path in git(clone, "ls-files", "--sparse").decode().splitlines() if path.endswith("/") ]
+    same("collapsed directories", sorted(collapsed), [ d + "/" for d in dirs[2:] ])
+    same("diff on a sparse index", tft(clone, "diff", "--cached"), b'')
+
+    tft(clone, "sparse-checkout", "disable")
+    same("status after disable", git(clone, "status", "--porcelain"), b'')
+    same("ls-files after disable", git(clone, "ls-files"), git(repo, "ls-files"))
+
+CHECKS = [
+    check_fsck, check_index, check_rev_list, check_merge_base, check_bitmap, check_count_objects,
+    check_grep, check_archive, check_fast_import, check_multi_pack_index, check_clone,
+    check_checkout, check_diff, check_sparse_checkout,
+]
+
+def main():
+    argparser = argparse.ArgumentParser(description="Check tft against git")
+    synthetic.add_arguments(argparser)
+    argparser.set_defaults(files=300, commits=60, merge_density=0.2, pack=True)
+    args = argparser.parse_args()
+
+    if not shutil.which("git"):
+        print("git is not installed", file=sys.stderr)
+        sys.exit(2)
+
+    failed = list()
+    tmp = tempfile.mkdtemp(prefix="tft-compat-")
+    try:
+        repo = synthetic.generate(os.path.join(tmp, "repo"), **synthetic.config(args)).worktree
+        for check in CHECKS:
+            name = check.__name__[len("check_"):].replace("_", "-")
+            try:
+                check(repo, tmp)
+                print("ok    {0}".format(name))
+            except Exception as e:
+                print("FAIL  {0}: {1}".format(name, e))
+                failed.append(name)
+    finally:
+        shutil.rmtree(tmp)
+
+    if failed:
+        print("Failed: {0}".format(", ".join(failed)), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Time merge-base and is-ancestor queries on a deep, merge-heavy history.
+
+    python3 benchmarks/merge_base.py [--commits 5000 ...] [--pairs 1000]
+                                     [--distance 50]
+
+Each query compares a commit with one up to --distance commits older.
+For each kind of query we print the queries per second with the commit
+cache of the repository warm, and how many commits a query visits with
+a cold cache; next to the number of commits a full walk of the history
+(what log does) reads, this shows the traversal stops at the bases.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import synthetic
+import libtft
+
+def pairs(commits, count, distance, rng):
+    """Return count (older, newer) pairs of commits, commits being in
+topological order, parents first."""
+    ret = list()
+    for _ in range(count):
+        i = rng.randrange(1, len(commits))
+        ret.append((commits[max(0, i - rng.randint(1, distance))], commits[i]))
+    return ret
+
+def bench(repo, name, query, queries):
+    """Print the speed of query over queries, then return its results."""
+    visited = list()
+    for a, b in queries[:100]:
+        repo.commits = None
+        query(repo, a, b)
+        visited.append(len(repo.commits))
+
+    repo.commits = None
+    start = time.perf_counter()
+    results = [ query(repo, a, b) for a, b in queries ]
+    wall = time.perf_counter() - start
+    print("{0:<12} {1:>9.0f} queries/s {2:>9.1f} commits visited (median {3:.0f}, max {4})".format(
+        name, len(queries) / wall, statistics.mean(visited), statistics.median(visited), max(visited)))
+    return results
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark merge-base queries")
+    synthetic.add_arguments(argparser)
+    argparser.set_defaults(files=200, commits=5000, merge_density=0.3, changes=2, pack=True)
+    argparser.add_argument("--pairs", type=int, default=1000, help="Number of queries of each kind.")
+    argparser.add_argument("--distance", type=int, default=50, help="How many commits apart, at most, the commits of a query are.")
+    args = argparser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="tft-bench-")
+    try:
+        start = time.perf_counter()
+        config = synthetic.config(args)
+        repo = synthetic.generate(os.path.join(tmp, "repo"), checkout=False, **config)
+        print("Generated repository in {0:.2f}s".format(time.perf_counter() - start))
+
+        start = time.perf_counter()
+        commits = libtft.commits_topo_order(repo, [ libtft.ref_resolve(repo, "HEAD") ])
+        print("Full walk    {0:>9.3f}s {1:>9} commits".format(time.perf_counter() - start, len(commits)))
+
+        queries = pairs(commits, args.pairs, args.distance, random.Random(args.seed))
+        bench(repo, "merge-base", lambda repo, a, b: libtft.merge_bases(repo, a, [ b ]), queries)
+        ancestors = bench(repo, "is-ancestor", libtft.is_ancestor, queries)
+        # The older commit of a pair need not be an ancestor of the newer,
+        # across side branches
+        print("{0} of {1} pairs are ancestors".format(sum(ancestors), len(queries)))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Time tft commands against a synthetic repository.
+
+    python3 benchmarks/run.py [--files 2000 ...] [--output results.json]
+                              [--baseline baseline.json] [--threshold 0.1]
+
+Every command runs in a fresh process, --repeat times; we keep the median
+wall time, the peak RSS, the read and write calls /proc/<pid>/io reports
+and, when strace is installed, the syscall count of each.  With
+--baseline, results are compared to a previous --output and any command
+slower than the threshold makes the run fail.
+
+The repository is generated by synthetic.py in a process of its own, and
+each command is started by a small launcher process: a process inherits
+the peak RSS of the one it is forked from, so forking commands from this
+one would report its memory instead of theirs.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+import libtft
+
+TFT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tft")
+SYNTHETIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "synthetic.py")
+
+# Run with python -S: spawns the command with its stdout on /dev/null,
+# and prints its wall time, exit status, rusage and /proc/<pid>/io.
+LAUNCHER = """
+import os, sys, time
+devnull = os.open(os.devnull, os.O_WRONLY)
+start = time.perf_counter()
+pid = os.posix_spawn(sys.argv[1], sys.argv[1:], os.environ, file_actions=[ (os.POSIX_SPAWN_DUP2, devnull, 1) ])
+# Leave the process a zombie, so its /proc entry can still be read
+os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+wall = time.perf_counter() - start
+with open("/proc/{0}/io".format(pid)) as f:
+    io = dict(line.split(": ") for line in f.read().splitlines())
+_, status, rusage = os.wait4(pid, 0)
+print(wall, os.waitstatus_to_exitcode(status), rusage.ru_maxrss, io["syscr"], io["syscw"])
+"""
+
+def commands(repo):
+    """The benchmarked commands, by name."""
+    some_file = os.path.join(repo.worktree, libtft.index_read(repo).entries[0].name)
+    return {
+        "status": [ "status" ],
+        "ls-files": [ "ls-files" ],
+        "ls-tree -r": [ "ls-tree", "-r", "HEAD" ],
+        "log": [ "log", "HEAD" ],
+        "rev-parse": [ "rev-parse", "HEAD" ],
+        "hash-object": [ "hash-object", some_file ],
+    }
+
+def run_once(argv, cwd):
+    """Run argv through the launcher and return (wall seconds, peak RSS in
+KiB, read and write calls)."""
+    out = subprocess.run([ sys.executable, "-S", "-c", LAUNCHER ] + argv, cwd=cwd,
+                         stdout=subprocess.PIPE, check=True).stdout.split()
+    wall, status, rss, syscr, syscw = float(out[0]), int(out[1]), int(out[2]), int(out[3]), int(out[4])
+    if status:
+        raise Exception("{0} failed with status {1}".format(" ".join(argv), status))
+    return wall, rss, syscr + syscw
+
+def count_syscalls(argv, cwd):
+    """Return the total syscall count of argv according to strace -c."""
+    with tempfile.NamedTemporaryFile("r") as out:
+        subprocess.run([ "strace", "-f", "-c", "-U", "calls", "-o", out.name ] + argv, cwd=cwd,
+                       stdout=subprocess.DEVNULL, check=True)
+        for line in out.read().splitlines():
+            m = re.match(r"^(\d+)\s+total$", line.strip())
+            if m:
+                return int(m.group(1))
+    return None
+
+def bench(repo, repeat):
+    results = dict()
+    strace = shutil.which("strace")
+    for name, argv in commands(repo).items():
+        argv = [ sys.executable, TFT ] + argv
+        runs = [ run_once(argv, repo.worktree) for _ in range(repeat) ]
+        result = {
+            "wall": statistics.median(r[0] for r in runs),
+            "rss_kb": max(r[1] for r in runs),
+            "read_write_calls": runs[0][2],
+            "syscalls": count_syscalls(argv, repo.worktree) if strace else None,
+        }
+        results[name] = result
+        print("{0:<14} {1:>9.3f}s {2:>9} KiB {3:>9} read/write {4:>9} syscalls".format(
+            name, result["wall"], result["rss_kb"], result["read_write_calls"],
+            "-" if result["syscalls"] is None else result["syscalls"]))
+    return results
+
+def compare(results, baseline, threshold):
+    """Print the change of each command against baseline, and return the
+names of those whose wall time regressed by more than threshold."""
+    regressions = list()
+    print()
+    print("{0:<14} {1:>10} {2:>10} {3:>8}".format("command", "baseline", "current", "change"))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["wall"]
+        change = (result["wall"] - old) / old if old else 0
+        print("{0:<14} {1:>9.3f}s {2:>9.3f}s {3:>+7.1%}".format(name, old, result["wall"], change))
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark tft commands")
+    synthetic.add_arguments(argparser)
+    argparser.add_argument("--repeat", type=int, default=5, help="Runs of each command.")
+    argparser.add_argument("--output", help="Write the results as JSON to this file.")
+    argparser.add_argument("--baseline", help="Compare with the JSON results of a previous run.")
+    argparser.add_argument("--threshold", type=float, default=0.1, help="Slowdown over the baseline counted as a regression.")
+    args = argparser.parse_args()
+
+    config = synthetic.config(args)
+    tmp = tempfile.mkdtemp(prefix="tft-bench-")
+    try:
+        start = time.perf_counter()
+        path = os.path.join(tmp, "repo")
+        subprocess.run([ sys.executable, SYNTHETIC, path ] + synthetic.arguments(config), check=True)
+        print("Generated repository in {0:.2f}s".format(time.perf_counter() - start))
+        repo = libtft.repo_find(path)
+        results = bench(repo, args.repeat)
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({ "config": config, "results": results }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print("warning: the baseline was run with a different repository", file=sys.stderr)
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print("Regressions: {0}".format(", ".join(regressions)), file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Deterministic generator of synthetic tft repositories.
+
+    python3 benchmarks/synthetic.py <path> [--files 2000] [--commits 200] ...
+
+The same arguments and seed always give the same objects, so timings of
+different versions of tft are comparable.
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import libtft
+
+def make_paths(rng, files, depth, fanout):
+    """Return files distinct paths, each up to depth directories deep."""
+    paths = list()
+    seen = set()
+    while len(paths) < files:
+        dirs = [ "dir{0}".format(rng.randrange(fanout)) for _ in range(rng.randint(0, depth)) ]
+        path = "/".join(dirs + [ "file{0}.txt".format(len(paths)) ])
+        if path not in seen:
+            seen.add(path)
+            paths.append(path)
+    return paths
+
+def make_blob(rng, min_size, max_size):
+    """Return text content of a random size, so it compresses like code."""
+    size = rng.randint(min_size, max_size)
+    line = rng.randbytes(32).hex().encode("ascii")
+    lines = (line[i % 64:] + line[:i % 64] + b'\n' for i in range(size // 65 + 1))
+    return b''.join(lines)[:size]
+
+def make_commit(writer, tree, parents, n, message):
+    commit = libtft.GitCommit()
+    commit.kvlm = collections.OrderedDict()
+    commit.kvlm[b'tree'] = tree.encode("ascii")
+    if parents:
+        commit.kvlm[b'parent'] = [ p.encode("ascii") for p in parents ] if len(parents) > 1 else parents[0].encode("ascii")
+    # Fixed timestamps keep the SHAs stable across runs
+    stamp = "Bench <bench@example.com> {0} +0000".format(1700000000 + 60 * n).encode("ascii")
+    commit.kvlm[b'author'] = stamp
+    commit.kvlm[b'committer'] = stamp
+    commit.kvlm[None] = message.encode("utf8")
+    return writer.write(commit)
+
+def generate(path, files=2000, depth=3, fanout=10, commits=200, merge_density=0.1,
+             min_blob=64, max_blob=4096, changes=10, seed=0, checkout=True, pack=False):
+    """Create a repository at path and return it.
+
+The history has commits commits on master.  Each changes changes files;
+with probability merge_density a commit is a merge of a two commits long
+side branch.  With checkout, the worktree and index match HEAD."""
+    rng = random.Random(seed)
+    repo = libtft.repo_create(path)
+    paths = make_paths(rng, files, depth, fanout)
+    with libtft.GitObjectWriter(repo, pack=pack) as writer:
+        builder = libtft.GitTreeBuilder(writer)
+        for p in paths:
+            builder.set(p, b'100644', writer.write_raw(b'blob', make_blob(rng, min_blob, max_blob)))
+
+        head = None
+        n = 0
+        for i in range(commits):
+            if head and rng.random() < merge_density:
+                # A side branch, merged back into master
+                side = head
+                for j in range(2):
+                    for p in rng.sample(paths, min(changes, len(paths))):
+                        builder.set(p, b'100644', writer.write_raw(b'blob', make_blob(rng, min_blob, max_blob)))
+                    n += 1
+                    side = make_commit(writer, builder.write(), [ side ], n, "Side commit {0}.{1}\n".format(i, j))
+                n += 1
+                head = make_commit(writer, builder.write(), [ head, side ], n, "Merge {0}\n".format(i))
+                continue
+
+            if head:
+                for p in rng.sample(paths, min(changes, len(paths))):
+                    builder.set(p, b'100644', writer.write_raw(b'blob', make_blob(rng, min_blob, max_blob)))
+            n += 1
+            head = make_commit(writer, builder.write(), [ head ] if head else [], n, "Commit {0}\n".format(i))
+
+    libtft.ref_create(repo, "heads/master", head)
+
+    if checkout:
+        tree = libtft.object_find(repo, head, fmt=b'tree')
+        libtft.index_write(repo, libtft.tree_checkout(repo, tree, repo.worktree))
+
+    return repo
+
+def main():
+    argparser = argparse.ArgumentParser(description="Generate a synthetic tft repository")
+    add_arguments(argparser)
+    argparser.add_argument("path", help="Where to create the repository.")
+    args = argparser.parse_args()
+    generate(args.path, **config(args))
+
+def add_arguments(argparser):
+    argparser.add_argument("--files", type=int, default=2000, help="Number of files.")
+    argparser.add_argument("--depth", type=int, default=3, help="Maximum directory depth.")
+    argparser.add_argument("--fanout", type=int, default=10, help="Subdirectories per directory.")
+    argparser.add_argument("--commits", type=int, default=200, help="Length of the history.")
+    argparser.add_argument("--merge-density", dest="merge_density", type=float, default=0.1, help="Fraction of commits which are merges.")
+    argparser.add_argument("--min-blob", dest="min_blob", type=int, default=64, help="Smallest blob size in bytes.")
+    argparser.add_argument("--max-blob", dest="max_blob", type=int, default=4096, help="Largest blob size in bytes.")
+    argparser.add_argument("--changes", type=int, default=10, help="Files changed by each commit.")
+    argparser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    argparser.add_argument("--pack", action="store_true", help="Write objects to a pack instead of loose objects.")
+
+def config(args):
+    """Return the generate() keyword arguments set by add_arguments."""
+    return { key: getattr(args, key) for key in ("files", "depth", "fanout", "commits", "merge_density",
+                                                 "min_blob", "max_blob", "changes", "seed", "pack") }
+
+def arguments(config):
+    """Return the command line options of this script giving config."""
+    argv = list()
+    for key, value in config.items():
+        option = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(option)
+        elif value is not False:
+            argv += [ option, str(value) ]
+    return argv
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,30 @@
 import argparse
+import asyncio
+import bisect
 import collections
+import concurrent.futures
 import configparser
 from datetime import datetime
+import functools
 import grp, pwd
-from fnmatch import fnmatch
+from fnmatch import fnmatch, fnmatchcase
 import hashlib
+import heapq
+import io
+import itertools
+import json
 from math import ceil
+import mmap
 import os
 import re
+import shutil
+import struct
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 import zlib
 from pathlib import Path
 
@@ -24,14 +40,16 @@ argsp.add_argument("path", metavar="directory", nargs="?", default=".", help="Wh
 argsp = argsubparsers.add_parser("hash-object", help="Compute object ID and optionally creates a blob from a file")
 argsp.add_argument("-t", metavar="type", dest="type", choices=["blob", "commit", "tag", "tree"], default="blob", help="Specify the type")
 argsp.add_argument("-w", dest="write", action="store_true", help="Actually write the object into the database")
-argsp.add_argument("path", help="Read object from <file>")
+argsp.add_argument("path", nargs="+", help="Read object from <file>")
 
 #subparser for status
 argsp = argsubparsers.add_parser("status", help = "Show the working tree status.")
+argsp.epilog = "Paths after -- only show these files and directories; they may be globs."
 
 #subparser for ls-files
 argsp = argsubparsers.add_parser("ls-files", help = "List all the stage files")
 argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+argsp.epilog = "Paths after -- only list these files and directories; they may be globs."
 
 #subparser for rev-parse
 argsp = argsubparsers.add_parser("rev-parse", help="Parse revision (or other objects) identifiers")
@@ -53,6 +71,7 @@ argsp = argsubparsers.add_parser("show-ref", help="List references in the curren
 argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
 argsp.add_argument("-r", dest="recursive", action="store_true", help="Recurse into sub-trees")
 argsp.add_argument("tree", help="A tree-ish object.")
+argsp.epilog = "Paths after -- only list these entries, or the content of those ending with /."
 
 #subparser for log command
 argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
@@ -60,39 +79,292 @@ argsp.add_argument("commit",
                    default="HEAD",
                    nargs="?",
                    help="Commit to start at.")
+argsp.epilog = "Paths after -- only show the commits that changed them."
+
+#subparser for diff command
+argsp = argsubparsers.add_parser("diff", help="Show changed paths between the index and the worktree, a commit and the worktree or index, or two commits.")
+argsp.add_argument("--cached", "--staged", dest="cached", action="store_true", help="Compare HEAD (or the commit given) with the index, instead of the index with the worktree.")
+argsp.add_argument("--name-status", dest="name_status", action="store_true", help="Show the status letter along with each changed path.")
+argsp.add_argument("commit", nargs="*", help="No commit compares the index with the worktree, one compares it with the worktree, two compare them with each other.")
+
+#subparser for checkout command
+argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of parallel workers (default: one per CPU).")
+argsp.add_argument("-f", "--force", action="store_true", help="Discard the local changes of the files the checkout updates or removes.")
+argsp.add_argument("commit", help="The commit or tree to checkout.")
+argsp.add_argument("path", nargs="?", default=None, help="An empty directory to export to, instead of updating the worktree.")
+
+#subparser for fsck command
+argsp = argsubparsers.add_parser("fsck", help="Verify the integrity and connectivity of the objects in the database.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of worker processes (default: one per CPU).")
+argsp.add_argument("--unreachable", action="store_true", help="Show every unreachable object, not only the dangling ones.")
+
+#subparser for rev-list command
+argsp = argsubparsers.add_parser("rev-list", help="List the commits, or objects, reachable from some commits but not others.")
+argsp.add_argument("--objects", action="store_true", help="List every reachable object, not only commits.")
+argsp.add_argument("--count", action="store_true", help="Only print how many there are.")
+argsp.add_argument("commit", nargs="+", help="Commits to start from; prefix with ^ to exclude what they reach.")
+
+#subparser for merge-base command
+argsp = argsubparsers.add_parser("merge-base", help="Find the best common ancestors of commits.")
+argsp.add_argument("--all", action="store_true", help="Print every merge base, not only one.")
+argsp.add_argument("--is-ancestor", dest="is_ancestor", action="store_true", help="Exit with 0 if the first commit is an ancestor of the second, else 1.")
+argsp.add_argument("commit", nargs="+", help="The commits; with more than two, the bases of the first and a merge of the others.")
+
+#subparser for bitmap command
+argsp = argsubparsers.add_parser("bitmap", help="Write reachability bitmaps for the biggest pack.")
+argsp.add_argument("--interval", type=int, default=100, help="Also select one commit every that many, besides the refs.")
+
+#subparser for multi-pack-index command
+argsp = argsubparsers.add_parser("multi-pack-index", aliases=["midx"], help="Write or verify the index covering every pack.")
+argsp.add_argument("action", choices=["write", "verify"], help="write (re)builds it incrementally, verify checks it against the packs.")
+
+#subparser for clone command
+argsp = argsubparsers.add_parser("clone", help="Clone a local repository into a new directory.")
+argsp.add_argument("--local", action=argparse.BooleanOptionalAction, default=True, help="Hardlink the object files (the default, copying across filesystems); with --no-local, copy them.")
+argsp.add_argument("--shared", action="store_true", help="Don't copy objects, read them from the source through objects/info/alternates.")
+argsp.add_argument("--no-checkout", dest="checkout", action="store_false", help="Don't checkout HEAD.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of parallel checkout workers.")
+argsp.add_argument("repository", help="Path of the repository to clone.")
+argsp.add_argument("directory", nargs="?", default=None, help="Where to clone it (default: its basename).")
+
+#subparser for fast-import command
+argsp = argsubparsers.add_parser("fast-import", help="Import a git fast-import stream from stdin into a new pack.")
+argsp.add_argument("--import-marks", dest="import_marks", metavar="file", default=None, help="Load marks from this file before importing.")
+argsp.add_argument("--export-marks", dest="export_marks", metavar="file", default=None, help="Write every mark to this file, at each checkpoint and at the end.")
+argsp.add_argument("--force", action="store_true", help="Update branches even to commits which don't contain their current tip.")
+
+#subparser for grep command
+argsp = argsubparsers.add_parser("grep", help="Print the lines matching a pattern in the worktree, the index or a commit.")
+argsp.add_argument("-i", dest="ignore_case", action="store_true", help="Ignore case differences.")
+argsp.add_argument("-n", dest="line_number", action="store_true", help="Prefix each line with its number.")
+argsp.add_argument("-l", dest="files_with_matches", action="store_true", help="Only print the names of the matching files.")
+argsp.add_argument("--cached", action="store_true", help="Search the blobs of the index instead of the worktree.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of worker processes (default: one per CPU).")
+argsp.add_argument("pattern", help="A Python regular expression.")
+argsp.add_argument("rev", nargs="?", default=None, help="Search the files of this commit or tree instead.")
+argsp.epilog = "Paths after -- only search these files and directories."
+
+#subparser for archive command
+argsp = argsubparsers.add_parser("archive", help="Write the files of a commit or tree as a tar or zip archive.")
+argsp.add_argument("--format", choices=["tar", "tar.gz", "tgz", "zip"], default=None, help="Archive format (default: from the --output extension, else tar).")
+argsp.add_argument("--prefix", default="", help="Prepend this to every path, as in --prefix=project/.")
+argsp.add_argument("-o", "--output", default=None, help="Write to this file instead of stdout.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of threads reading blobs ahead.")
+argsp.add_argument("rev", help="The commit or tree to archive.")
+argsp.epilog = "Paths after -- only archive these files and directories."
+
+#subparser for sparse-checkout command
+argsp = argsubparsers.add_parser("sparse-checkout", help="Restrict the worktree to some directories (cone mode).")
+# As in git, the options come after the action
+sparsesubparsers = argsp.add_subparsers(title="Actions", dest="action", required=True)
+for action, text in (("set", "Check out only these directories."), ("add", "Check out these directories too.")):
+    argsp = sparsesubparsers.add_parser(action, help=text)
+    argsp.add_argument("--sparse-index", dest="sparse_index", action=argparse.BooleanOptionalAction, default=None, help="Collapse the directories outside the checkout into single index entries.")
+    argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of parallel checkout workers.")
+    argsp.add_argument("dirs", nargs="*", help="The directories to check out.")
+argsp = sparsesubparsers.add_parser("list", help="List the directories checked out.")
+argsp = sparsesubparsers.add_parser("disable", help="Check out every file again.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of parallel checkout workers.")
+
+#subparser for count-objects command
+argsp = argsubparsers.add_parser("count-objects", help="Count the loose and packed objects, and the disk space they use.")
+argsp.add_argument("-v", dest="verbose", action="store_true", help="Report packs, prunable and garbage files too.")
+
+#subparser for sizer command
+argsp = argsubparsers.add_parser("sizer", help="Report what takes space in the repository: paths, objects, trees and delta chains.")
+argsp.add_argument("-n", dest="top", type=int, default=10, help="Length of each top list.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of worker processes (default: one per CPU).")
 
 #subparser for check-ignore command
 argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
 argsp.add_argument("path", nargs="+", help="Paths to check")
 
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
+    # As in git, everything after "--" is a list of paths
+    options = argv
+    paths = list()
+    if "--" in argv:
+        paths = argv[argv.index("--") + 1:]
+        options = argv[:argv.index("--")]
+    args = argparser.parse_args(options)
+    args.paths = paths
+
+    target = os.environ.get("TFT_TRACE2")
+    if not target:
+        # Else the config of the repository we run in.  Only the command
+        # line traces: library calls and worker processes never open it
+        try:
+            repo = repo_find(required=False)
+        except Exception:
+            # The command itself reports a broken repository
+            repo = None
+        if repo:
+            target = repo.conf.get("trace2", "eventTarget", fallback=None)
+    trace_open(target)
+    if trace_file:
+        trace_event("start", argv=[ "tft" ] + argv)
+    try:
+        main_dispatch(args)
+    finally:
+        if trace_file:
+            trace_exit(args.command)
+
+def main_dispatch(args):
     match args.command:
         case "add"          : cmd_add(args)
+        case "archive"      : cmd_archive(args)
+        case "bitmap"       : cmd_bitmap(args)
         case "cat-file"     : cmd_cat_file(args)
         case "check-ignore" : cmd_check_ignore(args)
         case "checkout"     : cmd_checkout(args)
+        case "clone"        : cmd_clone(args)
         case "commit"       : cmd_commit(args)
+        case "count-objects" : cmd_count_objects(args)
+        case "diff"         : cmd_diff(args)
+        case "fast-import"  : cmd_fast_import(args)
+        case "fsck"         : cmd_fsck(args)
+        case "grep"         : cmd_grep(args)
         case "hash-object"  : cmd_hash_object(args)
         case "init"         : cmd_init(args)
         case "log"          : cmd_log(args)
+        case "merge-base"   : cmd_merge_base(args)
+        case "multi-pack-index" | "midx" : cmd_multi_pack_index(args)
         case "ls-files"     : cmd_ls_files(args)
         case "ls-tree"      : cmd_ls_tree(args)
+        case "rev-list"     : cmd_rev_list(args)
         case "rev-parse"    : cmd_rev_parse(args)
         case "rm"           : cmd_rm(args)
         case "show-ref"     : cmd_show_ref(args)
+        case "sizer"        : cmd_sizer(args)
+        case "sparse-checkout" : cmd_sparse_checkout(args)
         case "status"       : cmd_status(args)
         case "tag"          : cmd_tag(args)
         case _              : print("Bad command.")\
         
+# Tracing.  Set TFT_TRACE2, or trace2.eventTarget in .git/config, to "1"
+# for stderr, a file descriptor from 2 to 9, an absolute file path to
+# append to, or a directory to create one file per process in.  Events are
+# JSON lines, as in git's trace2 event format.  When disabled, trace_file
+# is None and hot paths only pay for testing it.
+trace_file = None
+trace_lock = threading.Lock()
+trace_start = None
+# Region depth, per thread: the threads of a command nest their own regions
+trace_local = threading.local()
+trace_counters = collections.Counter()
+trace_totals = collections.Counter()
+
+def trace_open(target):
+    global trace_file, trace_start
+    if not target or target.lower() in ("0", "false"):
+        return
+    if target.lower() in ("1", "true"):
+        trace_file = sys.stderr
+    elif target.isdigit() and 2 <= int(target) <= 9:
+        trace_file = open(int(target), "w", buffering=1, closefd=False)
+    elif os.path.isabs(target):
+        if os.path.isdir(target):
+            target = os.path.join(target, "tft-{0}-{1}.json".format(os.getpid(), time.time_ns()))
+        trace_file = open(target, "a", buffering=1)
+    else:
+        raise Exception("Bad trace target {0}".format(target))
+    trace_start = time.perf_counter()
+
+def trace_event(event, **fields):
+    """Write one event, with its time since the start of the process."""
+    fields["event"] = event
+    fields["pid"] = os.getpid()
+    fields["thread"] = threading.current_thread().name
+    fields["t_rel"] = round(time.perf_counter() - trace_start, 6)
+    with trace_lock:
+        trace_file.write(json.dumps(fields) + "\n")
+
+def trace_count(name, value=1):
+    """Add value to counter name.  Callers test trace_file first.  The
+checkout and grep threads count too, hence the lock."""
+    with trace_lock:
+        trace_counters[name] += value
+
+def trace_exit(command):
+    """Write the counters and the per-command totals."""
+    for name, value in sorted(trace_counters.items()):
+        trace_event("counter", name=name, value=value)
+    trace_event("exit", command=command,
+                t_abs=round(time.perf_counter() - trace_start, 6),
+                counters=dict(trace_counters),
+                regions={ k: round(v, 6) for k, v in trace_totals.items() })
+
+class TraceRegion(object):
+    """Time a nested region of code, as region_enter and region_leave events."""
+    def __init__(self, category, label):
+        self.category = category
+        self.label = label
+
+    def __enter__(self):
+        self.nesting = getattr(trace_local, "nesting", 0) + 1
+        trace_local.nesting = self.nesting
+        self.start = time.perf_counter()
+        trace_event("region_enter", category=self.category, label=self.label, nesting=self.nesting)
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        trace_local.nesting = self.nesting - 1
+        elapsed = time.perf_counter() - self.start
+        with trace_lock:
+            trace_totals[self.category + "/" + self.label] += elapsed
+        trace_event("region_leave", category=self.category, label=self.label, nesting=self.nesting,
+                    t_elapsed=round(elapsed, 6))
+
+class TraceNullRegion(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        pass
+
+trace_null_region = TraceNullRegion()
+
+def trace_region(category, label):
+    """Return a context manager tracing the code it wraps, if enabled."""
+    if trace_file is None:
+        return trace_null_region
+    return TraceRegion(category, label)
+
+def traced(category, label):
+    """Decorator tracing every call of a function as a region."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if trace_file is None:
+                return f(*args, **kwargs)
+            with TraceRegion(category, label):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
 class GitRepository(object):
     worktree = None
     gitdir = None
     conf = None
+    # Opened packfiles, loaded on first use by pack_list
+    packs = None
+    # Modification time of objects/pack when pack_list listed it
+    packs_mtime = None
+    # Held while the packs are listed again, by threads sharing the repo
+    packs_lock = None
+    # The GitMultiPackIndex, False if there is none, None until read
+    midx = None
+    # Repositories of objects/info/alternates, loaded by repo_alternates
+    alternates = None
+    # GitCommitCache of commit SHA -> (parent SHAs, commit time, tree),
+    # filled by commit_links
+    commits = None
 
     def __init__(self, path, force=False):
         self.worktree = path
         self.gitdir = os.path.join(path, ".git")
+        self.packs_lock = threading.RLock()
         
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception("Not a Git repository %s" % path)
@@ -134,15 +406,15 @@ class GitCommit(GitObject):
     # Specify the object format as 'commit'
     fmt = b'commit'
 
-    def __init__(self):
+    def init(self):
         # Initialize the commit object with an empty key-value list map (KVL)
         self.kvlm = {}
 
-    def read_data(self, data):
+    def deserialize(self, data):
         """Deserialize the data into a key-value list map (KVL)."""
         self.kvlm = kvlm_parse(data)
 
-    def write_data(self):
+    def serialize(self):
         """Serialize the commit's key-value list map (KVL) back into bytes."""
         return kvlm_serialize(self.kvlm)
 
@@ -166,7 +438,7 @@ class GitIndexEntry(object):
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 flag_stage=None, name=None, flag_skip_worktree=False):
         # Last modification of metadata
         self.ctime = ctime
         # Last modification of data
@@ -191,15 +463,24 @@ class GitIndexEntry(object):
         self.flag_assume_valid = flag_assume_valid
         # The file is staged
         self.flag_stage = flag_stage
+        # The file is outside the sparse checkout, and absent from the worktree
+        self.flag_skip_worktree = flag_skip_worktree
         # The file name
         self.name = name
 
 class GitIndex(object):
     version = None
     entries = []
-    def __init__(self, version=2, entries=list()):
+    # Directory path -> tree SHA, from the valid nodes of the TREE extension
+    cache_tree = None
+    # Whether directories outside the sparse checkout are collapsed into
+    # a single "dir/" entry of their tree
+    sparse = False
+    def __init__(self, version=2, entries=None, cache_tree=None, sparse=False):
         self.version = version
-        self.entries = entries
+        self.entries = entries if entries is not None else list()
+        self.cache_tree = cache_tree if cache_tree is not None else dict()
+        self.sparse = sparse
 
 class GitTree(GitObject):
     fmt = b'tree'
@@ -224,15 +505,16 @@ def tree_parse_one(raw, start=0):
     assert x - start == 5 or x - start == 6
     # Read the mode
     mode = raw[start:x]
-    if len(mode):
-        mode = b' ' + mode
+    if len(mode) == 5:
+        # Normalize to six bytes, so trees read as b'040000'
+        mode = b'0' + mode
     # Find the NULL value
     y = raw.find(b'\x00', x)
     # Read the path
     path = raw[x + 1:y]
 
     # Read the sha
-    sha = format(int.from_bytes(raw[y + 1:], 'big'), '040x')
+    sha = format(int.from_bytes(raw[y + 1:y + 21], 'big'), '040x')
     return y + 21, GitTreeLeaf(mode, path.decode('utf-8'), sha)
 
 def tree_parse(raw):
@@ -247,19 +529,20 @@ def tree_parse(raw):
 
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b''
+    ret = list()
     for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path.encode('utf-8')
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, 'big')
-        
-    return ret
+        # Git stores tree modes without the leading zero
+        ret.append(i.mode.lstrip(b'0'))
+        ret.append(b' ')
+        ret.append(i.path.encode('utf-8'))
+        ret.append(b'\x00')
+        ret.append(bytes.fromhex(i.sha))
+
+    return b''.join(ret)
 
 def tree_leaf_sort_key(leaf):
-    return leaf.path + ('' if leaf.path.startswith(b'10') else '/')
+    # Only trees sort as if their name ended with a slash
+    return leaf.path + ('/' if leaf.mode == b'040000' else '')
 
 def repo_path(repo, *path): 
     """Compute path under repo's gitdir."""
@@ -347,7 +630,7 @@ def repo_find(path=".", required=True):
     #check if the path contains the .git directory
     path_to_check = path.joinpath(".git")
     if path_to_check.is_dir():
-        return GitObject(path)
+        return repo_open(str(path))
 
     #if it doesn't try to get the parent directory of path
     parent = path.joinpath("..").resolve()
@@ -363,41 +646,546 @@ def repo_find(path=".", required=True):
     return repo_find(parent, required)
 
   
+# Repositories opened by repo_open, by worktree path, least recently
+# used first, as (GitRepository, config modification time) pairs
+repo_pool = collections.OrderedDict()
+repo_pool_lock = threading.Lock()
+repo_pool_size = 256
+
+def repo_open(path):
+    """Return the GitRepository of the worktree at path, shared by the
+whole process: its opened packs, multi-pack-index and commit cache then
+serve every command and thread using it, instead of being read again
+for each.  The repo_pool_size most recently used repositories are kept;
+one whose config changed since is opened again."""
+    path = os.path.realpath(path)
+    try:
+        mtime = os.stat(os.path.join(path, ".git", "config")).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        # Let GitRepository report what is missing
+        return GitRepository(path)
+
+    with repo_pool_lock:
+        pooled = repo_pool.get(path)
+        if pooled and pooled[1] == mtime:
+            repo_pool.move_to_end(path)
+            return pooled[0]
+
+    repo = GitRepository(path)
+    with repo_pool_lock:
+        repo_pool[path] = (repo, mtime)
+        repo_pool.move_to_end(path)
+        # Evicted repositories stay usable by whoever holds them, their
+        # files are closed once nobody does
+        while len(repo_pool) > repo_pool_size:
+            repo_pool.popitem(last=False)
+    return repo
+
 def object_read(repo, sha):
+    raw = object_read_raw(repo, sha)
+
+    if raw is None:
+        return None
+
+    fmt, data = raw
+
+    # Pick the correct constructor depending on the type read above
+    match fmt:
+        case b'commit' : c=GitCommit
+        case b'tree'   : c=GitTree
+        case b'tag'    : c=GitTag
+        case b'blob'   : c=GitBlob
+        case _:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+
+    # Construct and return an instance of the corresponding Git object type
+    return c(data)
+
+class GitObjectCache(object):
+    """A least recently used cache of inflated objects, as (fmt, data)
+pairs, bounded by their total size and shared by the threads of the
+process.  Keys are the path of a loose object, or the (pack path,
+offset) of a packed one: both name content which never changes, so
+nothing needs invalidating, and repositories never see each other's
+objects.  Delta bases are cached too, so reading a chain of deltas
+doesn't inflate its bases again."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+        if value is not None and trace_file:
+            trace_count("object_cache_hits")
+        return value
+
+    def put(self, key, value):
+        size = len(value[1])
+        # A big blob would evict everything else, to be read once
+        if size > self.limit // 8:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.limit:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old[1])
+
+# Inflated objects of every repository of the process, 32MiB at most
+object_cache = GitObjectCache(32 << 20)
+
+def object_read_raw(repo, sha):
+    """Return the (fmt, data) pair of object sha, whether it is loose or
+packed, or None if the repository doesn't have it."""
 
     #read file .git/objects where first two are the directory name, the rest as the file name 
     path = repo_file(repo, "objects", sha[0:2], sha[2:])
 
-    if not os.path.isfile(path):
-        return None
+    cached = object_cache.get(path)
+    if cached:
+        return cached
+
+    if path and os.path.isfile(path):
+        with open (path, "rb") as f:
+            raw = zlib.decompress(f.read())
+        if trace_file:
+            trace_count("objects_read")
+            trace_count("loose_objects_read")
+            trace_count("bytes_inflated", len(raw))
+        obj = object_parse_loose(raw, sha)
+        object_cache.put(path, obj)
+        return obj
+
+    found = pack_locate(repo, sha)
+    if not found and pack_rescan(repo):
+        found = pack_locate(repo, sha)
+    if found:
+        if trace_file:
+            trace_count("objects_read")
+            trace_count("packed_objects_read")
+        return pack_read(repo, *found)
+
+    for alt in repo_alternates(repo):
+        raw = object_read_raw(alt, sha)
+        if raw:
+            return raw
 
-    with open (path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    return None
 
-        # Read object type "commit", "tree", "blob", "tag"
-        x = raw.find(b' ')
-        fmt = raw[0:x]
+def repo_alternates(repo):
+    """Return the object stores listed in objects/info/alternates, each as
+a repository whose gitdir holds that objects directory."""
+    if repo.alternates is None:
+        alternates = list()
+        path = repo_file(repo, "objects", "info", "alternates")
+        if path and os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    objects = os.path.normpath(os.path.join(repo_path(repo, "objects"), line))
+                    alt = GitRepository(os.path.dirname(objects), force=True)
+                    alt.worktree = None
+                    alt.gitdir = os.path.dirname(objects)
+                    alternates.append(alt)
+        repo.alternates = alternates
+    return repo.alternates
+
+def object_header(repo, sha):
+    """Return the (fmt, size) of object sha, or None, inflating no more
+than the few bytes holding them."""
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
 
-        # Read and validate object size
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f:
+            d = zlib.decompressobj()
+            raw = d.decompress(f.read(512), 64)
+        x = raw.find(b' ')
         y = raw.find(b'\x00', x)
-        size = int(raw[x:y].decode("ascii"))
-        if size != len(raw)-y-1:
-            raise Exception("Malformed object {0}: bad length".format(sha))
-
-        # Pick the correct constructor depending on the type read above
-        match fmt:
-            case b'commit' : c=GitCommit
-            case b'tree'   : c=GitTree
-            case b'tag'    : c=GitTag
-            case b'blob'   : c=GitBlob
-            case _:
-                raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+        return raw[0:x], int(raw[x+1:y])
+
+    found = pack_locate(repo, sha)
+    if not found and pack_rescan(repo):
+        found = pack_locate(repo, sha)
+    if found:
+        pack, offset = found
+        kind, size, pos, _ = pack_header(pack, offset)
+        return pack_type(repo, pack, offset), pack_object_size(pack, kind, size, pos)
+
+    for alt in repo_alternates(repo):
+        header = object_header(alt, sha)
+        if header:
+            return header
+
+    return None
+
+def object_parse_loose(raw, sha):
+    """Split the inflated content of a loose object into (fmt, data)."""
+    # Read object type "commit", "tree", "blob", "tag"
+    x = raw.find(b' ')
+    fmt = raw[0:x]
+
+    # Read and validate object size
+    y = raw.find(b'\x00', x)
+    size = int(raw[x:y].decode("ascii"))
+    if size != len(raw)-y-1:
+        raise Exception("Malformed object {0}: bad length".format(sha))
+
+    return fmt, raw[y+1:]
+
+class GitPack(object):
+    """A packfile and its version 2 index, both kept mmapped."""
+    path = None
+    # Cumulative object counts by first byte of the SHA
+    fanout = None
+    # Sorted binary SHAs, 20 bytes each
+    names = None
+    offsets = None
+    large_offsets = None
+    idx = None
+    data = None
+    # The GitBitmap of the pack, False if it has none, None until read
+    bitmap = None
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path + ".idx", "rb") as f:
+            idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if idx[0:4] != b'\xfftOc' or int.from_bytes(idx[4:8], "big") != 2:
+            raise Exception("Unsupported pack index {0}".format(path + ".idx"))
+
+        self.fanout = [ int.from_bytes(idx[8+4*i:12+4*i], "big") for i in range(256) ]
+        count = self.fanout[255]
+        names = 1032
+        offsets = names + 24 * count
+        self.names = idx[names:names + 20*count]
+        self.offsets = idx[offsets:offsets + 4*count]
+        self.large_offsets = idx[offsets + 4*count:len(idx) - 40]
+        self.idx = idx
+
+        with open(path + ".pack", "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def pack_list(repo, rescan=False):
+    """Return the packs of repo, opening them on first use.  With rescan,
+the list is read again, keeping the packs already opened.  The list is
+only published complete, so other threads never see part of it."""
+    if repo.packs is None or rescan:
+        with repo.packs_lock:
+            known = { pack.path: pack for pack in repo.packs or () }
+            packs = list()
+            path = repo_dir(repo, "objects", "pack")
+            if path:
+                repo.packs_mtime = os.stat(path).st_mtime_ns
+                for f in sorted(os.listdir(path)):
+                    if f.endswith(".idx"):
+                        name = os.path.join(path, f[:-4])
+                        packs.append(known.get(name) or GitPack(name))
+            repo.packs = packs
+    return repo.packs
+
+def pack_rescan(repo):
+    """List the packs of repo again if objects/pack changed since they
+were listed, as when another process wrote one; tell if it did.  Long
+lived repositories call it when an object is missing."""
+    path = repo_dir(repo, "objects", "pack")
+    with repo.packs_lock:
+        if repo.packs is None or not path or os.stat(path).st_mtime_ns == repo.packs_mtime:
+            return False
+        pack_list(repo, rescan=True)
+        # Read again with the new packs, which it may cover
+        repo.midx = None
+    return True
+
+def pack_locate(repo, sha):
+    """Return the (pack, offset) holding sha, or None.  The multi-pack
+index answers for the packs it covers with one binary search; packs
+added since it was written are searched one by one.  If a pack it
+covers is gone, the objects it placed there may be in any other pack,
+so all of them are searched."""
+    midx = midx_read(repo)
+    packs = pack_list(repo)
+    if midx:
+        found = midx_find(repo, midx, sha)
+        if found:
+            return found
+        covered, others = midx_packs(repo, midx)
+        if None not in covered:
+            packs = others
+
+    for pack in packs:
+        offset = pack_find(pack, sha)
+        if offset is not None:
+            return pack, offset
+    return None
+
+def pack_find(pack, sha):
+    """Return the offset of sha in pack, or None."""
+    i = sha_search(pack.names, 0, pack.fanout, bytes.fromhex(sha))
+    return None if i is None else pack_offset(pack, i)
+
+def sha_search(buf, base, fanout, name):
+    """Return the position of the binary SHA name in the sorted table of
+20 bytes SHAs at base of buf, or None.  The binary search only covers
+the slice the fanout table gives for the first byte of name."""
+    lo = fanout[name[0] - 1] if name[0] else 0
+    hi = fanout[name[0]]
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        cur = buf[base + 20*mid:base + 20*mid + 20]
+        if cur < name:
+            lo = mid + 1
+        elif cur > name:
+            hi = mid
+        else:
+            return mid
+    return None
 
-        # Construct and return an instance of the corresponding Git object type
-        return c(raw[y+1:])
+def pack_offset(pack, i):
+    """Return the offset in the packfile of the i-th object of the index."""
+    offset = int.from_bytes(pack.offsets[4*i:4*i + 4], "big")
+    if offset & 0x80000000:
+        i = offset & 0x7FFFFFFF
+        offset = int.from_bytes(pack.large_offsets[8*i:8*i + 8], "big")
+    return offset
+
+def pack_header(pack, offset):
+    """Parse the header of the entry at offset in pack.  Returns (kind,
+size, pos, base): pos is where the compressed data starts, and base the
+offset (OFS_DELTA) or SHA (REF_DELTA) of the delta base, or None."""
+    data = pack.data
+    c = data[offset]
+    kind = (c >> 4) & 7
+    size = c & 15
+    shift = 4
+    pos = offset + 1
+    while c & 0x80:
+        c = data[pos]
+        size |= (c & 0x7F) << shift
+        shift += 7
+        pos += 1
+
+    base = None
+    if kind == 6:
+        # OFS_DELTA: the base is earlier in this pack
+        c = data[pos]
+        delta = c & 0x7F
+        pos += 1
+        while c & 0x80:
+            c = data[pos]
+            delta = ((delta + 1) << 7) | (c & 0x7F)
+            pos += 1
+        base = offset - delta
+    elif kind == 7:
+        # REF_DELTA: the base is named by its SHA
+        base = data[pos:pos + 20].hex()
+        pos += 20
+    elif kind not in (1, 2, 3, 4):
+        raise Exception("Unknown type {0} at offset {1} of {2}".format(kind, offset, pack.path))
+
+    return kind, size, pos, base
+
+def pack_type(repo, pack, offset):
+    """Return the type of the object at offset in pack without inflating
+anything, by following delta bases through their headers.  A REF_DELTA
+base outside the pack has only its own header read."""
+    kind, _, _, base = pack_header(pack, offset)
+    while kind >= 6:
+        if kind == 7:
+            found = pack_find(pack, base)
+            if found is None:
+                return object_header(repo, base)[0]
+            base = found
+        kind, _, _, base = pack_header(pack, base)
+    return [ None, b'commit', b'tree', b'blob', b'tag' ][kind]
+
+def pack_object_size(pack, kind, size, pos):
+    """Return the size of the object whose entry pack_header parsed as
+(kind, size, pos).  That is size, unless the entry is a delta: a delta
+starts with the sizes of its base and result, so only its first bytes
+are inflated."""
+    if kind < 6:
+        return size
+    d = zlib.decompressobj()
+    delta = d.decompress(pack.data[pos:pos + 64], 20)
+    # A block with its own Huffman tables needs more input for any output
+    end = pos + 64
+    while len(delta) < 20 and not d.eof and end < len(pack.data):
+        delta += d.decompress(d.unconsumed_tail + pack.data[end:end + 1024], 20 - len(delta))
+        end += 1024
+    _, x = delta_varint(delta, 0)
+    return delta_varint(delta, x)[0]
+
+def pack_chain(repo, pack, offset, memo):
+    """Return the (fmt, depth) of the object at offset in pack: its type,
+and how many deltas lead to it from a whole object, from entry headers
+alone.  memo maps the offsets already followed to their (fmt, depth)."""
+    chain = list()
+    while offset not in memo:
+        kind, _, _, base = pack_header(pack, offset)
+        if kind < 6:
+            memo[offset] = ([ None, b'commit', b'tree', b'blob', b'tag' ][kind], 0)
+            break
+        chain.append(offset)
+        if kind == 7:
+            base_offset = pack_find(pack, base)
+            if base_offset is None:
+                # A base out of this pack counts as a whole object
+                memo[offset] = (object_header(repo, base)[0], 1)
+                chain.pop()
+                break
+            base = base_offset
+        offset = base
+
+    fmt, depth = memo[offset]
+    for o in reversed(chain):
+        depth += 1
+        memo[o] = (fmt, depth)
+    return memo[chain[0]] if chain else memo[offset]
+
+def pack_read(repo, pack, offset):
+    """Return the (fmt, data) of the object at offset in pack, applying
+deltas against their base."""
+    cached = object_cache.get((pack.path, offset))
+    if cached:
+        return cached
+
+    kind, size, pos, base = pack_header(pack, offset)
+
+    match kind:
+        case 6: fmt, base = pack_read(repo, pack, base)
+        case 7: fmt, base = object_read_raw(repo, base)
+        case _: fmt = [ None, b'commit', b'tree', b'blob', b'tag' ][kind]
+
+    raw = pack_inflate(pack.data, pos, size)
+    if trace_file:
+        trace_count("bytes_inflated", len(raw))
+    if len(raw) != size:
+        raise Exception("Malformed object at offset {0} of {1}: bad length".format(offset, pack.path))
+
+    if kind >= 6:
+        raw = delta_apply(base, raw)
+    object_cache.put((pack.path, offset), (fmt, raw))
+    return fmt, raw
+
+def pack_inflate(data, pos, size):
+    """Inflate the zlib stream at pos, reading only as much as needed."""
+    d = zlib.decompressobj()
+    ret = b''
+    chunk = size + 64
+    while not d.eof and pos < len(data):
+        ret += d.decompress(data[pos:pos + chunk])
+        pos += chunk
+    return ret
+
+def delta_varint(delta, pos):
+    ret = shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7F) << shift
+        shift += 7
+        if not c & 0x80:
+            return ret, pos
+
+def delta_apply(base, delta):
+    """Rebuild an object from its base and a git delta."""
+    base_size, pos = delta_varint(delta, 0)
+    if base_size != len(base):
+        raise Exception("Delta base size mismatch")
+    size, pos = delta_varint(delta, pos)
+
+    ret = bytearray()
+    while pos < len(delta):
+        c = delta[pos]
+        pos += 1
+        if c & 0x80:
+            # Copy from base: bits 0-3 select offset bytes, 4-6 size bytes
+            copy_offset = copy_size = 0
+            for i in range(4):
+                if c & (1 << i):
+                    copy_offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if c & (1 << (4 + i)):
+                    copy_size |= delta[pos] << (8 * i)
+                    pos += 1
+            ret += base[copy_offset:copy_offset + (copy_size or 0x10000)]
+        elif c:
+            # Insert the next c bytes of the delta
+            ret += delta[pos:pos + c]
+            pos += c
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(ret) != size:
+        raise Exception("Delta result size mismatch")
+    return bytes(ret)
+
+def delta_varint_encode(n):
+    ret = bytearray()
+    while n >= 0x80:
+        ret.append(0x80 | (n & 0x7F))
+        n >>= 7
+    ret.append(n)
+    return ret
 
-def object_hash(fd, fmt, repo=None):
-    """Hash object, writing it to repo if provided."""
+def delta_create(base_size, size, ops):
+    """Build a git delta from ops, each either the (offset, size) of a
+copy from the base, or bytes to insert.  Adjacent ops are merged."""
+    merged = list()
+    for op in ops:
+        last = merged[-1] if merged else None
+        if type(op) == tuple:
+            if type(last) == tuple and last[0] + last[1] == op[0]:
+                merged[-1] = (last[0], last[1] + op[1])
+            else:
+                merged.append(op)
+        elif type(last) == bytearray:
+            last += op
+        else:
+            merged.append(bytearray(op))
+
+    ret = delta_varint_encode(base_size) + delta_varint_encode(size)
+    for op in merged:
+        if type(op) == bytearray:
+            # Inserts carry at most 127 bytes
+            for i in range(0, len(op), 127):
+                chunk = op[i:i + 127]
+                ret.append(len(chunk))
+                ret += chunk
+            continue
+        offset, size = op
+        while size:
+            n = min(size, 0xFFFFFF)
+            c = 0x80
+            args = bytearray()
+            for i in range(4):
+                if (offset >> (8 * i)) & 0xFF:
+                    c |= 1 << i
+                    args.append((offset >> (8 * i)) & 0xFF)
+            for i in range(3):
+                if (n >> (8 * i)) & 0xFF:
+                    c |= 1 << (4 + i)
+                    args.append((n >> (8 * i)) & 0xFF)
+            ret.append(c)
+            ret += args
+            offset += n
+            size -= n
+    return bytes(ret)
+
+def object_hash(fd, fmt, repo=None, writer=None):
+    """Hash object, writing it to repo, or through writer, if provided."""
     data = fd.read()
 
     # Choose constructor according to fmt argument
@@ -408,6 +1196,8 @@ def object_hash(fd, fmt, repo=None):
         case b'blob'   : obj=GitBlob(data)
         case _: raise Exception("Unknown type %s!" % fmt)
 
+    if writer:
+        return writer.write(obj)
     return object_write(obj, repo)
       
 def object_write(obj, repo=None):
@@ -424,47 +1214,260 @@ def object_write(obj, repo=None):
 
         #Extra check before writing
         if not os.path.exists(path):
-            with open(path, 'wb') as f:
-                # Compress and write
-                f.write(zlib.compress(result))
+            # Compress and write
+            object_write_file(path, zlib.compress(result, repo_compression(repo, "loose")))
     return sha
- 
-def object_find(repo, name, fmt=None, follow=True):
-    """Just temporary, will implement this fully soon"""
-    return name
-  
 
-def cmd_ls_files(args):
-    repo = repo_find()
-    index = index_read(repo)
+def object_write_file(path, data, mode=0o444):
+    """Write data to path through a temporary file in the same directory,
+renamed into place, so nobody ever reads a partial object.  Objects are
+read-only, as git writes them."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix="tmp_obj_")
+    try:
+        with open(fd, "wb") as f:
+            f.write(data)
+        # mkstemp creates the file 0600, too strict for shared repositories
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def repo_compression(repo, kind):
+    """Return the zlib level for "loose" objects or "pack" entries.  As in
+git, core.looseCompression and pack.compression override
+core.compression; loose objects default to the fastest level."""
+    section, option = ("core", "looseCompression") if kind == "loose" else ("pack", "compression")
+    for section, option in ((section, option), ("core", "compression")):
+        if repo.conf.has_option(section, option):
+            level = repo.conf.getint(section, option)
+            if not -1 <= level <= 9:
+                raise Exception("Bad zlib compression level {0} for {1}.{2}".format(level, section, option))
+            return level
+    return 1 if kind == "loose" else -1
+
+def repo_big_file_threshold(repo):
+    """Return core.bigFileThreshold in bytes: bigger files are not
+searched or diffed.  As in git, it defaults to 512m."""
+    value = repo.conf.get("core", "bigFileThreshold", fallback="512m").strip().lower()
+    units = { "k": 1 << 10, "m": 1 << 20, "g": 1 << 30 }
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+class GitObjectWriter(object):
+    """Write many objects in a row, either as loose objects or streamed
+into one new packfile.
+
+Loose objects are written through temporary files renamed into place,
+and fan-out directories are created once.  With pack=True entries are
+appended to a temporary pack, undeltified; close() writes its trailer
+and index and moves both into objects/pack, and checkpoint() does the
+same then starts another pack.  Until then, objects of the pack are only
+readable through read_raw()."""
+    repo = None
+    pack = False
+    level = None
+    # SHAs written so far, and the fan-out directories known to exist
+    written = None
+    dirs = None
+    # Temporary pack file, (binary sha, offset, crc32) of its entries, and
+    # SHA -> (fmt, offset, position and length of the compressed data,
+    # delta base or None, delta depth) of each
+    path = None
+    file = None
+    entries = None
+    located = None
+    # As git's pack.depth
+    max_depth = 50
+
+    def __init__(self, repo, pack=False):
+        self.repo = repo
+        self.pack = pack
+        self.written = set()
+        if pack:
+            self.level = repo_compression(repo, "pack")
+            self.pack_start()
+        else:
+            self.level = repo_compression(repo, "loose")
+            self.dirs = set(os.listdir(repo_dir(repo, "objects")))
+
+    def pack_start(self):
+        path = repo_dir(self.repo, "objects", "pack", mkdir=True)
+        fd, self.path = tempfile.mkstemp(dir=path, prefix="tmp_pack_")
+        self.file = open(fd, "w+b")
+        # The object count is only known at close()
+        self.file.write(b"PACK" + (2).to_bytes(4, "big") + (0).to_bytes(4, "big"))
+        self.entries = list()
+        self.located = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        elif self.file:
+            self.file.close()
+            os.remove(self.path)
+
+    def write(self, obj):
+        """Write obj and return its SHA."""
+        return self.write_raw(obj.fmt, obj.serialize())
+
+    def write_raw(self, fmt, data, base=None, delta=None):
+        """Write an object of type fmt with content data, return its SHA.
+In a pack, if delta is given, the object is stored as that delta against
+base, which must be deltifiable()."""
+        header = fmt + b' ' + str(len(data)).encode() + b'\x00'
+        h = hashlib.sha1(header)
+        h.update(data)
+        sha = h.hexdigest()
+
+        if sha in self.written:
+            return sha
+        self.written.add(sha)
 
-    if args.verbose:
-        print("Index file format v{}, containing {} entries.".format(index.version, len(index.entries)))
-    
-    for entry in index.entries:
-        print(entry.name)
-        if args.verbose:
-            print("  {} with perms: {:o}".format(
-            {0b1000: "regular file",
-            0b1010: "symlink",
-            0b1110: "git link"}[entry.mode_type],
-        entry.mode_perms))
-        print("  on blob: {}".format(entry.sha))
-        print("  created: {}.{}, modified: {}.{}".format(
-            datetime.fromtimestamp(entry.ctime[0]),
-            entry.ctime[1], 
-            datetime.fromtimestamp(entry.mtime[0]), 
-            entry.mtime[1]))
-        print("  device: {}, inode: {}".format(entry.dev, entry.ino))
-        print("  user: {} ({})  group: {} ({})".format(
-            pwd.getpwuid(entry.uid).pw_name,
-            entry.uid,
-            grp.getgrgid(entry.gid).gr_name,
-            entry.gid))
-        print("  flags: stage={} assume_valid={}".format(
-        entry.flag_stage,
-        entry.flag_assume_valid))
+        if self.pack:
+            self.write_pack_entry(sha, fmt, data, base, delta)
+            return sha
 
+        if sha[0:2] not in self.dirs:
+            os.makedirs(repo_path(self.repo, "objects", sha[0:2]), exist_ok=True)
+            self.dirs.add(sha[0:2])
+        path = repo_path(self.repo, "objects", sha[0:2], sha[2:])
+        if not os.path.exists(path):
+            object_write_file(path, zlib.compress(header + data, self.level))
+        return sha
+
+    def deltifiable(self, base):
+        """Whether objects can be stored as deltas against base."""
+        return self.pack and base in self.located and self.located[base][5] < self.max_depth
+
+    def write_pack_entry(self, sha, fmt, data, base=None, delta=None):
+        depth = 0
+        if delta is not None:
+            kind = 6
+            data = delta
+            depth = self.located[base][5] + 1
+        else:
+            kind = { b'commit': 1, b'tree': 2, b'blob': 3, b'tag': 4 }[fmt]
+            base = None
+        size = len(data)
+        c = (kind << 4) | (size & 15)
+        size >>= 4
+        entry = bytearray()
+        while size:
+            entry.append(c | 0x80)
+            c = size & 0x7F
+            size >>= 7
+        entry.append(c)
+        offset = self.file.tell()
+        if base:
+            # OFS_DELTA: the distance back to the base entry
+            n = offset - self.located[base][1]
+            distance = [ n & 0x7F ]
+            n >>= 7
+            while n:
+                n -= 1
+                distance.append(0x80 | (n & 0x7F))
+                n >>= 7
+            entry += bytes(reversed(distance))
+        header = len(entry)
+        entry += zlib.compress(data, self.level)
+
+        self.entries.append((bytes.fromhex(sha), offset, zlib.crc32(entry)))
+        self.located[sha] = (fmt, offset, offset + header, len(entry) - header, base, depth)
+        self.file.write(entry)
+
+    def read_raw(self, sha):
+        """Return the (fmt, data) of object sha, like object_read_raw(),
+but also seeing the entries of the pack being written."""
+        if not self.pack or sha not in self.located:
+            return object_read_raw(self.repo, sha)
+        fmt, _, pos, length, base, _ = self.located[sha]
+        self.file.seek(pos)
+        data = zlib.decompress(self.file.read(length))
+        self.file.seek(0, os.SEEK_END)
+        if base:
+            data = delta_apply(self.read_raw(base)[1], data)
+        return fmt, data
+
+    def checkpoint(self):
+        """Finish the current pack, making its objects readable by
+everyone, and start a new one.  Return the path of the finished pack,
+as close() does."""
+        path = self.close()
+        if self.pack:
+            self.pack_start()
+        return path
+
+    def close(self):
+        """Finish writing.  For a pack, write the object count, checksum
+and index, then return the path of the pack (without extension), or
+None when no object was written."""
+        if not self.pack:
+            return None
+
+        f = self.file
+        self.file = None
+        if not self.entries:
+            f.close()
+            os.remove(self.path)
+            return None
+
+        f.seek(8)
+        f.write(len(self.entries).to_bytes(4, "big"))
+        f.seek(0)
+        h = hashlib.sha1()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+        checksum = h.digest()
+        f.write(checksum)
+        f.close()
+
+        path = repo_path(self.repo, "objects", "pack", "pack-" + checksum.hex())
+        object_write_file(path + ".idx", pack_index_serialize(self.entries, checksum))
+        os.chmod(self.path, 0o444)
+        os.replace(self.path, path + ".pack")
+
+        # Let the next lookups see the new pack
+        self.repo.midx = None
+        pack_list(self.repo, rescan=True)
+        return path
+
+def pack_index_serialize(entries, checksum):
+    """Build a version 2 pack index from (binary sha, offset, crc32)
+entries, for the pack whose checksum is checksum."""
+    entries = sorted(entries)
+    fanout = [0] * 256
+    for name, _, _ in entries:
+        fanout[name[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    ret = b'\xfftOc' + (2).to_bytes(4, "big")
+    ret += b''.join(n.to_bytes(4, "big") for n in fanout)
+    ret += b''.join(name for name, _, _ in entries)
+    ret += b''.join(crc.to_bytes(4, "big") for _, _, crc in entries)
+
+    # Offsets past 2GiB go to a table of 8 bytes offsets
+    offsets = list()
+    large = list()
+    for _, offset, _ in entries:
+        if offset < 0x80000000:
+            offsets.append(offset.to_bytes(4, "big"))
+        else:
+            offsets.append((0x80000000 | len(large)).to_bytes(4, "big"))
+            large.append(offset)
+    ret += b''.join(offsets)
+    ret += b''.join(offset.to_bytes(8, "big") for offset in large)
+
+    ret += checksum
+    ret += hashlib.sha1(ret).digest()
+    return ret
+ 
+def object_find(repo, name, fmt=None, follow=True):
     sha = object_resolve(repo, name)
 
     if not sha:
@@ -484,7 +1487,6 @@ def cmd_ls_files(args):
             return sha
         if not follow:
             return None
-        sha = obj.oid
 
         if obj.fmt == b'tag':
             sha = obj.kvlm[b'object'].decode("ascii")
@@ -492,7 +1494,42 @@ def cmd_ls_files(args):
             sha = obj.kvlm[b'tree'].decode("ascii")
         else:
             return None
+  
+
+def cmd_ls_files(args):
+    repo = repo_find()
+    index = index_read(repo)
+
+    if args.verbose:
+        print("Index file format v{}, containing {} entries.".format(index.version, len(index.entries)))
+
+    for entry in index_entries_limited(index, args.paths):
+        print(entry.name)
+        if not args.verbose:
+            continue
+        print("  {} with perms: {:o}".format(
+            {0b1000: "regular file",
+            0b1010: "symlink",
+            0b1110: "git link",
+            0b0100: "sparse directory"}[entry.mode_type],
+        entry.mode_perms))
+        print("  on blob: {}".format(entry.sha))
+        print("  created: {}.{}, modified: {}.{}".format(
+            datetime.fromtimestamp(entry.ctime[0]),
+            entry.ctime[1], 
+            datetime.fromtimestamp(entry.mtime[0]), 
+            entry.mtime[1]))
+        print("  device: {}, inode: {}".format(entry.dev, entry.ino))
+        print("  user: {} ({})  group: {} ({})".format(
+            pwd.getpwuid(entry.uid).pw_name,
+            entry.uid,
+            grp.getgrgid(entry.gid).gr_name,
+            entry.gid))
+        print("  flags: stage={} assume_valid={}".format(
+        entry.flag_stage,
+        entry.flag_assume_valid))
 
+@traced("index", "read")
 def index_read(repo):
     index_file = repo_file(repo, "index")
 
@@ -507,41 +1544,39 @@ def index_read(repo):
     signature = header[:4]
     assert signature == b"DIRC" # DirCache
     version = int.from_bytes(header[4:8], 'big')
-    # Tft only supports index file version 2
-    assert version == 2
+    # Tft supports index file versions 2 and 3, which adds extended flags
+    assert version in (2, 3)
     count = int.from_bytes(header[8:12], "big")
 
     entries = list()
 
     content = raw[12:]
-    index = 0
+    idx = 0
     for i in range(count):
-        
-        ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
+        # The fixed size fields, in one go: with a million entries, the
+        # parsing is most of the time of a command limited to a few paths
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, unused, mode,
+         uid, gid, fsize, sha, flags) = struct.unpack_from(">6I2H3I20sH", content, idx)
         assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
         mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
+        # 0b0100 is a sparse directory entry, for a whole tree
+        assert mode_type in [0b1000, 0b1010, 0b1110, 0b0100]
         mode_perms = mode & 0b0000000111111111
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
+        sha = sha.hex()
         flag_assume_valid = (flags & 0b1000000000000000) != 0
         flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
         flag_stage =  flags & 0b0011000000000000
         name_length = flags & 0b0000111111111111
-        
+
         idx += 62
 
+        flag_skip_worktree = False
+        if flag_extended:
+            assert version == 3
+            extended = int.from_bytes(content[idx: idx+2], "big")
+            flag_skip_worktree = (extended & 0b0100000000000000) != 0
+            idx += 2
+
         if name_length < 0xFFF:
             assert content[idx + name_length] == 0x00
             raw_name = content[idx:idx+name_length]
@@ -570,13 +1605,125 @@ def index_read(repo):
                                      sha=sha,
                                      flag_assume_valid=flag_assume_valid,
                                      flag_stage=flag_stage,
-                                     name=name))
-
-    return GitIndex(version=version, entries=entries)
+                                     name=name,
+                                     flag_skip_worktree=flag_skip_worktree))
+
+    # Optional extensions follow the entries, then a 20 bytes checksum
+    cache_tree = dict()
+    sparse = False
+    end = len(content) - 20
+    while idx + 8 <= end:
+        signature = content[idx:idx+4]
+        size = int.from_bytes(content[idx+4:idx+8], "big")
+        if signature == b"TREE":
+            index_read_cache_tree(content[idx+8:idx+8+size], cache_tree)
+        elif signature == b"sdir":
+            sparse = True
+        idx += 8 + size
+
+    return GitIndex(version=version, entries=entries, cache_tree=cache_tree, sparse=sparse)
+
+def index_read_cache_tree(raw, cache_tree, start=0, prefix=""):
+    """Parse one node of the TREE extension and, recursively, its
+subtrees.  Only valid nodes (entry count >= 0) are kept in cache_tree,
+keyed by their full directory path ("" for the root)."""
+    x = raw.find(b'\x00', start)
+    name = raw[start:x].decode("utf8")
+    path = prefix + "/" + name if prefix else name
+    y = raw.find(b' ', x)
+    entry_count = int(raw[x+1:y])
+    z = raw.find(b'\n', y)
+    subtrees = int(raw[y+1:z])
+    pos = z + 1
+
+    if entry_count >= 0:
+        cache_tree[path] = format(int.from_bytes(raw[pos:pos+20], "big"), "040x")
+        pos += 20
+
+    for i in range(subtrees):
+        pos = index_read_cache_tree(raw, cache_tree, pos, path)
+
+    return pos
+
+@traced("index", "write")
+def index_write(repo, index):
+    """Write index to .git/index, through a lock file renamed into place.
+Version 3 is used only when some entry has extended flags."""
+    extended = any(e.flag_skip_worktree for e in index.entries)
+    version = 3 if extended else min(index.version, 2)
+    content = [ b"DIRC", version.to_bytes(4, "big"), len(index.entries).to_bytes(4, "big") ]
+
+    for e in index.entries:
+        # Stat data is truncated to 32 bits, like git does
+        content.append(struct.pack(">10I20s",
+                                   e.ctime[0], e.ctime[1], e.mtime[0], e.mtime[1],
+                                   e.dev & 0xFFFFFFFF, e.ino & 0xFFFFFFFF,
+                                   (e.mode_type << 12) | e.mode_perms,
+                                   e.uid, e.gid, e.fsize & 0xFFFFFFFF,
+                                   bytes.fromhex(e.sha)))
+
+        name = e.name.encode("utf8")
+        flags = (0b1000000000000000 if e.flag_assume_valid else 0) | e.flag_stage
+        flags |= min(len(name), 0xFFF)
+        size = 62
+        if e.flag_skip_worktree:
+            flags |= 0b0100000000000000
+            content.append(flags.to_bytes(2, "big"))
+            content.append((0b0100000000000000).to_bytes(2, "big"))
+            size += 2
+        else:
+            content.append(flags.to_bytes(2, "big"))
+
+        # The name is NUL terminated, then padded to a multiple of 8
+        content.append(name)
+        content.append(b'\x00' * (8 * ceil((size + len(name) + 1) / 8) - size - len(name)))
+
+    if index.cache_tree:
+        tree = index_write_cache_tree(index)
+        content.append(b"TREE" + len(tree).to_bytes(4, "big") + tree)
+
+    if index.sparse:
+        # An empty extension, telling git the index has sparse directories
+        content.append(b"sdir" + (0).to_bytes(4, "big"))
+
+    content = b''.join(content)
+    content += hashlib.sha1(content).digest()
+
+    lock = repo_file(repo, "index.lock")
+    with open(lock, "xb") as f:
+        f.write(content)
+    os.replace(lock, repo_file(repo, "index"))
+
+def index_write_cache_tree(index):
+    """Serialize index.cache_tree as a TREE extension.  Directories
+missing from cache_tree are written as invalid nodes."""
+    counts = collections.Counter()
+    subtrees = collections.defaultdict(set)
+    for e in index.entries:
+        counts[""] += 1
+        # A sparse directory "a/b/" counts as one entry of "a"
+        parts = e.name.rstrip("/").split("/")[:-1]
+        for i in range(len(parts)):
+            path = "/".join(parts[:i+1])
+            counts[path] += 1
+            subtrees["/".join(parts[:i])].add(path)
+
+    def node(path):
+        name = path.rsplit("/", 1)[-1] if path else ""
+        sha = index.cache_tree.get(path)
+        ret = name.encode("utf8") + b'\x00'
+        ret += "{0} {1}\n".format(counts[path] if sha else -1, len(subtrees[path])).encode("ascii")
+        if sha:
+            ret += int(sha, 16).to_bytes(20, "big")
+        for sub in sorted(subtrees[path]):
+            ret += node(sub)
+        return ret
+
+    return node("")
 
 def object_resolve(repo, name):
     candidates = list()
-    hashRe = re.compile(b'^[0-9A-Fa-f]{4,40}$') # Hex string matcher
+    hashRe = re.compile(r'^[0-9A-Fa-f]{4,40}$') # Hex string matcher
   
     if not name.strip(): # Empty string
         return None
@@ -586,14 +1733,7 @@ def object_resolve(repo, name):
 
     if hashRe.match(name):# Short or long hash
         name = name.lower()
-        prefix = name[0:2]
-        path = repo_dir(repo, "objects", prefix)
-
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    candidates.append(prefix + f)
+        candidates = object_resolve_hash(repo, name)
 
     as_tag = ref_resolve(repo, "refs/tags/" + name)
     if as_tag: # Ref case
@@ -604,6 +1744,42 @@ def object_resolve(repo, name):
         candidates.append(as_branch)
     return candidates
 
+def object_resolve_hash(repo, name):
+    """Return the SHAs starting with name, in the loose objects, the packs
+and the alternates of repo."""
+    candidates = list()
+    prefix = name[0:2]
+    path = repo_dir(repo, "objects", prefix)
+
+    if path:
+        rem = name[2:]
+        for f in os.listdir(path):
+            if f.startswith(rem):
+                candidates.append(prefix + f)
+
+    for pack in pack_list(repo):
+        for sha in pack_prefix_matches(pack, name):
+            if sha not in candidates:
+                candidates.append(sha)
+
+    for alt in repo_alternates(repo):
+        for sha in object_resolve_hash(alt, name):
+            if sha not in candidates:
+                candidates.append(sha)
+    return candidates
+
+def pack_prefix_matches(pack, prefix):
+    """Return the SHAs of pack that start with the hex string prefix."""
+    first = int(prefix[0:2], 16)
+    lo = pack.fanout[first - 1] if first else 0
+    hi = pack.fanout[first]
+    ret = list()
+    for i in range(lo, hi):
+        sha = pack.names[20*i:20*i + 20].hex()
+        if sha.startswith(prefix):
+            ret.append(sha)
+    return ret
+
 def kvlm_parse(raw, start=0, dct=None):
     # dct initialization
     if not dct:
@@ -647,8 +1823,8 @@ def kvlm_parse(raw, start=0, dct=None):
 def ref_resolve(repo, ref):
     path = repo_file(repo, ref)
 
-    if not os.path.isfile(path):
-        return None
+    if not path or not os.path.isfile(path):
+        return packed_refs_read(repo).get(ref)
 
     with open(path, 'r') as fp:
         data = fp.read()[:-1]
@@ -658,8 +1834,26 @@ def ref_resolve(repo, ref):
     else:
         return data
 
+def packed_refs_read(repo):
+    """Return the refs of .git/packed-refs, as a dict of name to SHA."""
+    ret = dict()
+    path = repo_file(repo, "packed-refs")
+
+    if not os.path.isfile(path):
+        return ret
+
+    with open(path, 'r') as fp:
+        for line in fp:
+            # Skip the header and the peeled values of annotated tags
+            if line.startswith("#") or line.startswith("^"):
+                continue
+            sha, name = line.split()
+            ret[name] = sha
+    return ret
+
 def ref_list(repo, path=None):
-    if not path:
+    top = not path
+    if top:
         path = repo_dir(repo, "refs")
     ret = collections.OrderedDict()
 
@@ -670,6 +1864,15 @@ def ref_list(repo, path=None):
         else:
             ret[f] = ref_resolve(repo, can)
 
+    if top:
+        # Loose refs take precedence over the packed ones
+        for name, sha in sorted(packed_refs_read(repo).items()):
+            node = ret
+            parts = name.split("/")[1:]
+            for part in parts[:-1]:
+                node = node.setdefault(part, collections.OrderedDict())
+            node.setdefault(parts[-1], sha)
+
     return ret
 
 def show_ref(repo, refs, with_hash=True, prefix=''):
@@ -699,8 +1902,8 @@ def kvlm_serialize(kvlm):
         for v in val:
             res += key + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
 
-    # Append message
-    res += b'\n' + kvlm[None] + b'\n'
+    # Append message, which kvlm_parse keeps with its final newline
+    res += b'\n' + kvlm[None]
 
     return res
 
@@ -719,30 +1922,271 @@ def tree_to_dict(repo, ref, prefix=""):
 
     for leaf in tree.items:
         full_path = os.path.join(prefix, leaf.path)
-        is_subtree = leaf.mode.startswith('04')
+        is_subtree = leaf.mode.startswith(b'04')
         if is_subtree:
             ret.update(tree_to_dict(repo, leaf.sha, full_path))
         else:
             ret[full_path] = leaf.sha
     return ret
+
+def path_limit_match(paths, path, is_tree=False):
+    """Tell if path is selected by the path limits in paths.  A path
+matches a limit if it is the limit itself or lives under it; a tree
+also matches if a limit lives under it, so we know to descend into it.
+No limits select everything.
+
+A limit with a glob character (*, ? or [) is a pattern the whole path
+must match, "*" matching "/" too as in git.  A tree matches it if it
+may hold such a path, from the literal part of the pattern."""
+    if not paths:
+        return True
+    for p in paths:
+        literal = path_limit_literal(p)
+        if literal != p:
+            if fnmatchcase(path, p):
+                return True
+            if is_tree and (literal.startswith(path + "/") or (path + "/").startswith(literal)):
+                return True
+            continue
+        p = p.rstrip("/")
+        if path == p or path.startswith(p + "/"):
+            return True
+        if is_tree and p.startswith(path + "/"):
+            return True
+    return False
+
+def path_limit_literal(path):
+    """Return the part of the path limit before its first glob character."""
+    m = re.search(r"[*?[]", path)
+    return path[:m.start()] if m else path
+
+def path_limit_below(paths, path):
+    """Tell if some limit in paths selects entries strictly inside the
+directory path, and not the directory itself."""
+    for p in paths or ():
+        literal = path_limit_literal(p)
+        if literal.startswith(path + "/"):
+            return True
+    return False
+
+def index_slices(names, paths):
+    """Return the (lo, hi) ranges of the sorted index entry names which
+may match the limits in paths, in order and without overlaps.
+
+The entries under a path are contiguous in the index, so each limit
+selects one range, found by bisection on the literal part of the limit;
+only the entries of these ranges need to be checked with
+path_limit_match."""
+    ranges = list()
+    for p in paths or ():
+        literal = path_limit_literal(p)
+        if literal == p:
+            literal = p.rstrip("/")
+        if not literal:
+            return [ (0, len(names)) ]
+        lo = bisect.bisect_left(names, literal)
+        # The first name after every name starting with literal
+        hi = bisect.bisect_left(names, literal[:-1] + chr(ord(literal[-1]) + 1), lo)
+        ranges.append((lo, hi))
+    if not paths:
+        return [ (0, len(names)) ]
+
+    merged = list()
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+def path_limit_roots(paths):
+    """Return the paths, relative to the worktree, of the files and
+directories which hold everything the limits in paths can match: the
+limits themselves, or the directory of the literal part of globs.  No
+limits, or a glob at the top, give the whole worktree ("")."""
+    roots = set()
+    for p in paths or [ "" ]:
+        literal = path_limit_literal(p)
+        if literal != p:
+            literal = literal.rsplit("/", 1)[0] if "/" in literal else ""
+        roots.add(literal.rstrip("/"))
+
+    if "" in roots:
+        return [ "" ]
+    # Drop the roots inside another one
+    return sorted(r for r in roots if not any(q in roots for q in path_parents(r)))
+
+def index_entries_limited(index, paths):
+    """Yield the entries of index matching the limits in paths, in index
+order, reading only the slices of the index which can match them."""
+    if not paths:
+        yield from index.entries
+        return
+    names = [ e.name for e in index.entries ]
+    for lo, hi in index_slices(names, paths):
+        for entry in index.entries[lo:hi]:
+            if path_limit_match(paths, entry.name):
+                yield entry
+
+def diff_tree_items(repo, sha):
+    """Return the leaves of tree sha, or nothing for the empty side of a diff."""
+    if not sha:
+        return list()
+    return object_read(repo, sha).items
+
+def diff_tree_tree(repo, old, new, paths=None, prefix=""):
+    """Compare the trees old and new (either may be None) and yield a
+(status, path, old_sha, new_sha) tuple for every changed blob, where
+status is one of "A", "D" or "M".
+
+Both trees are walked in lockstep, in git tree order.  Subtrees with the
+same SHA on both sides are skipped without being read, and so are
+subtrees outside paths."""
+    if old == new:
+        return
+
+    old_items = diff_tree_items(repo, old)
+    new_items = diff_tree_items(repo, new)
+    i = j = 0
+
+    while i < len(old_items) or j < len(new_items):
+        a = old_items[i] if i < len(old_items) else None
+        b = new_items[j] if j < len(new_items) else None
+
+        if a and b:
+            ka = tree_leaf_sort_key(a)
+            kb = tree_leaf_sort_key(b)
+            if ka < kb: b = None
+            elif kb < ka: a = None
+
+        if a: i += 1
+        if b: j += 1
+
+        leaf = a or b
+        path = prefix + leaf.path
+        is_tree = leaf.mode.startswith(b'04')
+        if not path_limit_match(paths, path, is_tree):
+            continue
+
+        if a and b and a.sha == b.sha and a.mode == b.mode:
+            continue
+
+        if is_tree:
+            yield from diff_tree_tree(repo, a.sha if a else None, b.sha if b else None, paths, path + "/")
+        elif a and b:
+            yield ("M", path, a.sha, b.sha)
+        elif a:
+            yield ("D", path, a.sha, None)
+        else:
+            yield ("A", path, None, b.sha)
+
+def index_entry_mode(entry):
+    """Return the mode of an index entry the way trees store it."""
+    return "{:06o}".format((entry.mode_type << 12) | entry.mode_perms).encode("ascii")
+
+def diff_tree_index(repo, tree, index, paths=None):
+    """Compare tree (or None) with the entries of index, the same way
+diff_tree_tree compares two trees.
+
+The index is sorted by path, so the entries below a directory are a
+contiguous slice we can find by bisection.  When the index cache tree
+says that slice hashes to the same tree as HEAD, the whole directory is
+skipped without reading it."""
+    names = [e.name for e in index.entries]
+    yield from diff_tree_index_slice(repo, tree, index, names, 0, len(names), paths, "")
+
+def diff_tree_index_slice(repo, tree, index, names, lo, hi, paths, prefix):
+    if tree and index.cache_tree.get(prefix.rstrip("/")) == tree:
+        if trace_file:
+            trace_count("cache_tree_hits")
+        return
+
+    items = diff_tree_items(repo, tree)
+    i = 0
+    j = lo
+
+    while i < len(items) or j < hi:
+        a = items[i] if i < len(items) else None
+
+        # Key of the next index entry at this level: either a file, or
+        # the directory holding a whole slice of entries.
+        b = None
+        if j < hi:
+            rest = names[j][len(prefix):]
+            slash = rest.find("/")
+            kb = rest if slash < 0 else rest[:slash + 1]
+
+        if a and j < hi:
+            ka = tree_leaf_sort_key(a)
+            if ka <= kb: i += 1
+            if kb <= ka: b = kb
+            if kb < ka: a = None
+        elif a:
+            i += 1
+        else:
+            b = kb
+
+        if b is None:
+            key = a.path + ("/" if a.mode.startswith(b'04') else "")
+        else:
+            key = b
+        path = prefix + key.rstrip("/")
+        is_tree = key.endswith("/")
+
+        if is_tree:
+            # "0" sorts right after "/", so this finds the end of the slice
+            end = bisect.bisect_left(names, prefix + key[:-1] + "0", j, hi) if b else j
+            if b and names[j] == prefix + key:
+                # A sparse directory entry stands for the whole tree
+                sha = index.entries[j].sha
+                if path_limit_match(paths, path, True) and (not a or a.sha != sha):
+                    yield from diff_tree_tree(repo, a.sha if a else None, sha, paths, path + "/")
+            elif path_limit_match(paths, path, True):
+                yield from diff_tree_index_slice(repo, a.sha if a else None, index, names, j, end, paths, path + "/")
+            j = end
+            continue
+
+        if b is not None:
+            entry = index.entries[j]
+            j += 1
+
+        if not path_limit_match(paths, path):
+            continue
+
+        if a and b is not None:
+            if a.sha != entry.sha or a.mode != index_entry_mode(entry):
+                yield ("M", path, a.sha, entry.sha)
+        elif a:
+            yield ("D", path, a.sha, None)
+        else:
+            yield ("A", path, None, entry.sha)
   
-def ls_tree(repo, ref, recursive=None, prefix=''):
+def ls_tree(repo, ref, recursive=None, prefix='', paths=None):
+    """Print the entries of the tree ref, as tree_entries lists them."""
+    for mode, type, sha, path in tree_entries(repo, ref, recursive, prefix, paths):
+        print("{0} {1} {2}\t{3}".format(mode, type, sha, path))
+
+def tree_entries(repo, ref, recursive=None, prefix='', paths=None):
+    """Yield the (mode, type, sha, path) of the entries of the tree ref,
+recursively or not.  Only the entries matching the limits of paths are
+yielded, and only the subtrees which may hold some are read."""
     obj = object_read(repo, object_find(repo, ref, fmt=b'tree'))
     for item in obj.items:
-        type = item.mode[0:(1 if len(item.mode) == 5 else 2)]
+        path = os.path.join(prefix, item.path)
+        is_tree = item.mode.startswith(b'04')
+        if not path_limit_match(paths, path, is_tree):
+            continue
+        type = item.mode[0:2]
         match (type):
-            case '04': type = 'tree'
-            case '10': type = 'blob'
-            case '12': type = 'blob'
-            case '16': type = 'blob'
+            case b'04': type = 'tree'
+            case b'10': type = 'blob'
+            case b'12': type = 'blob'
+            case b'16': type = 'commit'
             case _: raise Exception("Unknown type %s!" % type)
-        if not (recursive and type == 'tree'):
-            print("{0} {1} {2}\t{3}".format(
-                "0" * (6 - len(item.mode)) + item.mode.decode("ascii"), type,
-                item.sha,
-                os.path.join(prefix, item.path)))
+        if type == 'tree' and (recursive or path_limit_below(paths, path)):
+            yield from tree_entries(repo, item.sha, recursive, prefix=path, paths=paths)
         else:
-            ls_tree(repo, item.sha, recursive, prefix=os.path.join(prefix, item.path))
+            yield "0" * (6 - len(item.mode)) + item.mode.decode("ascii"), type, item.sha, path
 
 def cat_file(repo, obj, fmt=None):
     obj = object_read(repo, object_find(repo, obj, fmt=fmt))
@@ -758,16 +2202,51 @@ def cmd_log(args):
 
     print("digraph wyaglog{")
     print("  node[shape=rect]")
-    log_graphviz(repo, object_find(repo, args.commit), set())
+    log_graphviz(repo, object_find(repo, args.commit), dict(), args.paths)
     print("}")
 
-def log_graphviz(repo, sha, seen):
-
+def commit_parents(commit):
+    """Return the list of parent SHAs of commit."""
+    parents = commit.kvlm.get(b'parent', list())
+    if type(parents) != list:
+        parents = [ parents ]
+    return [ p.decode("ascii") for p in parents ]
+
+def commit_touches_paths(repo, commit, paths):
+    """Tell if commit changed anything in paths compared to each of its
+parents, so that merges taking one side unchanged are not shown."""
+    tree = commit.kvlm[b'tree'].decode("ascii")
+    parents = commit_parents(commit)
+    if not parents:
+        return any(diff_tree_tree(repo, None, tree, paths))
+    for p in parents:
+        parent_tree = object_read(repo, p).kvlm[b'tree'].decode("ascii")
+        if not any(diff_tree_tree(repo, parent_tree, tree, paths)):
+            return False
+    return True
+
+def log_graphviz(repo, sha, seen, paths=None, child=None):
+    # seen maps each visited commit to whether it was drawn.  With path
+    # limits, child is the closest drawn descendant, which we link to.
     if sha in seen:
+        if child and seen[sha]:
+            print ("  c_{0} -> c_{1};".format(child, sha))
         return
-    seen.add(sha)
 
     commit = object_read(repo, sha)
+    assert commit.fmt==b'commit'
+    drawn = not paths or commit_touches_paths(repo, commit, paths)
+    seen[sha] = drawn
+
+    if drawn:
+        if child:
+            print ("  c_{0} -> c_{1};".format(child, sha))
+        child = sha
+    else:
+        for p in commit_parents(commit):
+            log_graphviz(repo, p, seen, paths, child)
+        return
+
     short_hash = sha[0:8]
     message = commit.kvlm[None].decode("utf8").strip()
     message = message.replace("\\", "\\\\")
@@ -777,21 +2256,9 @@ def log_graphviz(repo, sha, seen):
         message = message[:message.index("\n")]
 
     print("  c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
-    assert commit.fmt==b'commit'
-
-    if not b'parent' in commit.kvlm.keys():
-        # Base case: the initial commit.
-        return
-
-    parents = commit.kvlm[b'parent']
-
-    if type(parents) != list:
-        parents = [ parents ]
 
-    for p in parents:
-        p = p.decode("ascii")
-        print ("  c_{0} -> c_{1};".format(sha, p))
-        log_graphviz(repo, p, seen)
+    for p in commit_parents(commit):
+        log_graphviz(repo, p, seen, paths, child)
 
 def cmd_hash_object(args):
     """Bridge function to compute the hash-name of object and optionally create the blob"""
@@ -800,81 +2267,191 @@ def cmd_hash_object(args):
     else:
         repo = None
 
-    with open(args.path, "rb") as fd:
-        sha = object_hash(fd, args.type.encode(), repo)
-        print(sha)
+    if len(args.path) == 1:
+        with open(args.path[0], "rb") as fd:
+            print(object_hash(fd, args.type.encode(), repo))
+        return
 
-def cmd_status(_):
+    # Many files: write them through a single bulk writer
+    writer = GitObjectWriter(repo) if repo else None
+    for path in args.path:
+        with open(path, "rb") as fd:
+            print(object_hash(fd, args.type.encode(), None, writer))
+    if writer:
+        writer.close()
+
+def cmd_status(args):
     repo = repo_find()
-    index = index_read(repo)
-    
-    cmd_status_branch(repo)
-    cmd_status_head_index(repo, index)
-    print()
-    cmd_status_index_worktree(repo, index)
+    st = status(repo, args.paths)
 
-def cmd_status_branch(repo):
-    branch = branch_get_active(repo)
-    if branch:
-        print("On branch: {}".format(branch))
+    if st.branch:
+        print("On branch: {}".format(st.branch))
     else:
         print("HEAD detached at: {}".format(object_find(repo, "HEAD")))
 
-def cmd_status_head_index(repo, index):
+    labels = { "A": "added:", "D": "deleted:", "M": "modified:" }
     print("Changes to be committed: ")
+    for change, path in st.staged:
+        print(" ", labels[change], path)
+    print()
 
-    head = tree_to_dict(repo, "HEAD")
-    for entry in index.entries:
-        if entry.name in head:
-            if head[entry.name] != entry.sha:
-                print("  modified:", entry.name)
-            # Delete the entry in the index if it exists in HEAD
-            del head[entry.name]
-        else:
-            print("  added:", entry.name)
+    print("Changes not staged for commit: ")
+    for change, path in st.unstaged:
+        print(" ", labels[change], path)
 
-    # Deleted files
-    for entry in head:
-        print("  deleted:", entry)
+    print("\nUntracked files: ")
+    for f in st.untracked:
+        print(" ", f)
 
-def cmd_status_index_worktree(repo, index):
-    print("Changes not staged for commit: ")
+class GitStatus(object):
+    """The state of a worktree, as status shows it."""
+    # The active branch, or None with a detached HEAD
+    branch = None
+    # (change, path) pairs, change being "A", "D" or "M": HEAD against
+    # the index, then the index against the worktree
+    staged = None
+    unstaged = None
+    # Paths of the files which are neither tracked nor ignored
+    untracked = None
+
+    def __init__(self, branch=None, staged=None, unstaged=None, untracked=None):
+        self.branch = branch
+        self.staged = staged if staged is not None else list()
+        self.unstaged = unstaged if unstaged is not None else list()
+        self.untracked = untracked if untracked is not None else list()
+
+def status(repo, paths=None):
+    """Return the GitStatus of the worktree of repo, limited to paths."""
+    index = index_read(repo)
+    branch = branch_get_active(repo)
+    return GitStatus(branch.decode("utf8") if branch else None,
+                     status_head_index(repo, index, paths),
+                     *status_index_worktree(repo, index, paths))
+
+@traced("status", "head_index")
+def status_head_index(repo, index, paths=None):
+    """Return the (change, path) of the files staged in index."""
+    return [ (change, path) for change, path, _, _ in diff_tree_index(repo, head_tree(repo), index, paths) ]
+
+def head_tree(repo):
+    """Return the SHA of the tree of HEAD, or None on an unborn branch."""
+    if not ref_resolve(repo, "HEAD"):
+        return None
+    return object_find(repo, "HEAD", fmt=b'tree')
 
+def status_index_worktree(repo, index, paths=None):
+    """Return the (change, path) of the index entries changed or deleted
+in the worktree, and the untracked files.  With path limits, only the
+directories they name are walked and only the slices of the index under
+them are checked."""
     ignore = gitignore_read(repo)
 
     gitdir_prefix = repo.gitdir + os.path.sep
 
     files = list()
 
-    for (root, _, filenames) in os.walk(repo.worktree, True):
-        if root == repo.gitdir or root.startswith(gitdir_prefix): continue
-        for f in filenames:
-            files.append(os.path.relpath(os.path.join(root, f), repo.worktree))
+    with trace_region("status", "walk"):
+        for base in path_limit_roots(paths):
+            top = os.path.join(repo.worktree, base)
+            if not os.path.isdir(top):
+                if os.path.lexists(top):
+                    files.append(base)
+                continue
+            for (root, _, filenames) in os.walk(top, True):
+                if root == repo.gitdir or root.startswith(gitdir_prefix): continue
+                if trace_file:
+                    trace_count("dirs_walked")
+                for f in filenames:
+                    files.append(os.path.relpath(os.path.join(root, f), repo.worktree))
+        if paths:
+            files = [ f for f in files if path_limit_match(paths, f) ]
+
+    changes = [ (change, path) for change, path, _, _ in diff_index_worktree(repo, index, paths) ]
+    # Outside the sparse checkout: not in the worktree, on purpose
+    tracked = set(e.name for e in index_entries_limited(index, paths) if not e.flag_skip_worktree)
+
+    untracked = [ f for f in files if f not in tracked and not check_ignore(ignore, f) ]
+    return changes, untracked
+
+def diff_index_worktree(repo, index, paths=None):
+    """Return the (change, path, index sha, worktree sha) of the index
+entries changed ("M") or deleted ("D") in the worktree, as diff_tree_tree
+does for two trees.  Only files whose stat data differs from their entry
+are hashed again."""
+    changes = list()
+
+    with trace_region("status", "index_worktree"):
+        for entry in index_entries_limited(index, paths):
+            # Outside the sparse checkout: not in the worktree, on purpose
+            if entry.flag_skip_worktree:
+                continue
+            full_path = os.path.join(repo.worktree, entry.name)
+
+            if trace_file:
+                trace_count("stats")
+            if not os.path.exists(full_path):
+                changes.append(("D", entry.name, entry.sha, None))
+            else:
+                stat = os.stat(full_path)
+                if trace_file:
+                    trace_count("stats")
+
+                ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
+                mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
+
+                if stat.st_ctime_ns != ctime_ns or stat.st_mtime_ns != mtime_ns:
+                    if trace_file:
+                        trace_count("rehashed")
+                    with open(full_path, "rb") as f:
+                        sha = object_hash(f, b'blob', None)
+
+                        if entry.sha != sha:
+                            changes.append(("M", entry.name, entry.sha, sha))
+
+    return changes
+
+def diff_tree_worktree(repo, tree, index, paths=None):
+    """Compare tree with the worktree, going through the index: the
+changes from tree to index and from index to worktree are joined by
+path."""
+    staged = { path: (old, new) for _, path, old, new in diff_tree_index(repo, tree, index, paths) }
+    unstaged = { path: (old, new) for _, path, old, new in diff_index_worktree(repo, index, paths) }
+
+    changes = list()
+    for path in sorted(staged.keys() | unstaged.keys()):
+        old = staged[path][0] if path in staged else unstaged[path][0]
+        new = unstaged[path][1] if path in unstaged else staged[path][1]
+        if old == new:
+            continue
+        status = "A" if old is None else "D" if new is None else "M"
+        changes.append((status, path, old, new))
+    return changes
+
+def cmd_diff(args):
+    """Bridge function to list the paths changed between two trees."""
+    repo = repo_find()
 
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
+    if len(args.commit) > 2:
+        raise Exception("Too many commits: {0}".format(" ".join(args.commit)))
+
+    if len(args.commit) == 2:
+        old = object_find(repo, args.commit[0], fmt=b'tree')
+        new = object_find(repo, args.commit[1], fmt=b'tree')
+        changes = diff_tree_tree(repo, old, new, args.paths)
+    elif args.cached:
+        old = object_find(repo, args.commit[0], fmt=b'tree') if args.commit else head_tree(repo)
+        changes = diff_tree_index(repo, old, index_read(repo), args.paths)
+    elif args.commit:
+        old = object_find(repo, args.commit[0], fmt=b'tree')
+        changes = diff_tree_worktree(repo, old, index_read(repo), args.paths)
+    else:
+        changes = diff_index_worktree(repo, index_read(repo), args.paths)
 
-        if not os.path.exists(full_path):
-            print("  deleted:", entry.name)
+    for status, path, _, _ in changes:
+        if args.name_status:
+            print("{0}\t{1}".format(status, path))
         else:
-            stat = os.stat(full_path)
-
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-
-            if stat.st_ctime_ns != ctime_ns or stat.st_mtime_ns != mtime_ns:
-                with open(full_path, "rb") as f:
-                    sha = object_hash(f, b'blob', None)
-
-                    if entry.sha != sha:
-                        print("  modified:", entry.name)
-        if entry.name in files:
-            files.remove(entry.name)
-
-    print("\nUntracked files: ")
-    for f in files:
-        if check_ignore(ignore, f): continue
-        print(" ", f)
+            print(path)
 
 #Check-ignore function
 def cmd_check_ignore(args):
@@ -914,11 +2491,12 @@ class GitIgnore(object):
         self.absolute = absolute
         self.scoped = scoped
 
+@traced("status", "gitignore_read")
 def gitignore_read(repo):
     ret = GitIgnore(absolute=list(), scoped=dict())
 
     #read local configuration: .git/info/exclude
-    repo_file = os.path.join(repo.gitfir, "info/exclude")
+    repo_file = os.path.join(repo.gitdir, "info/exclude")
     if os.path.exists(repo_file):
         with open(repo_file, "r") as f:
             ret.absolute.append(gitignore_parse(f.readlines()))
@@ -937,7 +2515,7 @@ def gitignore_read(repo):
     # .gitignore files in the index
     index = index_read(repo)
     for entry in index.entries:
-        if entry.name == ".gitignore" or entry.name.endswitch("/.gitignore"):
+        if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
             dir_name = os.path.dirname(entry.name)
             contents = object_read(repo, entry.sha)
             lines = contents.blobdata.decode("utf8").splitlines()
@@ -1026,7 +2604,7 @@ def tag_create(repo, name, ref, create_tag_object=False):
         ref_create(repo, "tags/" + name, sha)
 
 def ref_create(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), 'w') as fp:
+    with open(repo_file(repo, "refs", *ref_name.split("/"), mkdir=True), 'w') as fp:
         fp.write(sha + "\n")
 
 def cmd_show_ref(args):
@@ -1038,5 +2616,2618 @@ def cmd_show_ref(args):
 def cmd_ls_tree(args):
     """Bridge function to list the contents of a tree object."""
     repo = repo_find()
-    ls_tree(repo, args.tree, args.recursive)
+    ls_tree(repo, args.tree, args.recursive, paths=args.paths)
+
+
+def cmd_checkout(args):
+    """Bridge function to materialize a commit, in parallel, either in the
+worktree (updating the index and HEAD) or in an empty directory."""
+    repo = repo_find()
+    sha = object_find(repo, args.commit)
+    tree = object_find(repo, sha, fmt=b'tree')
+
+    if args.path:
+        if os.path.exists(args.path):
+            if not os.path.isdir(args.path):
+                raise Exception("Not a directory {0}!".format(args.path))
+            if os.listdir(args.path):
+                raise Exception("Not empty {0}!".format(args.path))
+        tree_checkout(repo, tree, os.path.realpath(args.path), args.jobs)
+        return
+
+    worktree_checkout(repo, tree, args.jobs, args.force)
+
+    if ref_resolve(repo, "refs/heads/" + args.commit) == sha:
+        head = "ref: refs/heads/{0}\n".format(args.commit)
+    else:
+        head = sha + "\n"
+    with open(repo_file(repo, "HEAD"), "w") as f:
+        f.write(head)
+
+def worktree_checkout(repo, tree, jobs=None, force=False):
+    """Make the worktree and the index match tree, within the sparse
+checkout if there is one.  Files of the previous index which are not in
+tree, or are now outside the sparse checkout, are removed.  Unless
+force, nothing is written if a file to update or remove has local
+changes."""
+    old = index_read(repo)
+    index = tree_checkout(repo, tree, repo.worktree, jobs, sparse_checkout_read(repo), old, force)
+    index_write(repo, index)
+    return index
+
+@traced("checkout", "tree_checkout")
+def tree_checkout(repo, tree, path, jobs=None, sparse=None, old=None, force=False):
+    """Write the content of tree under path and return the index matching
+it, stat data included.
+
+This is a pipeline: the trees are read first to list every blob and
+directory, directories are created in one pass, then blobs are inflated
+and written by a pool of jobs threads (zlib releases the GIL while
+inflating).  The cache tree of the returned index is complete, since we
+know the SHA of every directory.
+
+With a sparse checkout, only the directories of its cone are written;
+the rest gets skip-worktree entries, one per file, or one per directory
+with a sparse index, whose trees are then not even read.
+
+With old, the index of a worktree at path, we update that worktree:
+see checkout_update."""
+    blobs = list()
+    dirs = list()
+    cache_tree = dict()
+    skipped = list()
+    checkout_enumerate(repo, tree, "", blobs, dirs, cache_tree, sparse, skipped)
+
+    kept = list()
+    if old:
+        blobs, kept, skipped = checkout_update(repo, path, old, blobs, skipped, force)
+
+    for d in dirs:
+        full_path = os.path.join(path, d)
+        # An untracked file where the tree now has a directory
+        if os.path.islink(full_path) or (os.path.lexists(full_path) and not os.path.isdir(full_path)):
+            os.remove(full_path)
+        os.makedirs(full_path, exist_ok=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        entries = list(pool.map(lambda blob: checkout_blob(repo, path, *blob), blobs))
+
+    entries += kept
+    entries += [ checkout_skipped(*leaf) for leaf in skipped ]
+
+    # The index is sorted by path bytes, trees by their own order
+    entries.sort(key=lambda e: e.name.encode("utf8"))
+    return GitIndex(entries=entries, cache_tree=cache_tree, sparse=bool(sparse and sparse.index))
+
+def checkout_enumerate(repo, tree, prefix, blobs, dirs, cache_tree, sparse=None, skipped=None):
+    """Collect the (path, mode, sha) of every blob below tree, the
+directories to create and the SHA of each directory.  Directories
+outside sparse go to skipped instead: as a single "dir/" leaf with a
+sparse index, else as all the blobs below them."""
+    cache_tree[prefix.rstrip("/")] = tree
+    for leaf in object_read(repo, tree).items:
+        path = prefix + leaf.path
+        if leaf.mode.startswith(b'04'):
+            cone = sparse.directory(path) if sparse else "recursive"
+            if cone is None and sparse.index:
+                skipped.append((path + "/", leaf.mode, leaf.sha))
+            elif cone is None:
+                checkout_enumerate(repo, leaf.sha, path + "/", skipped, list(), cache_tree)
+            else:
+                dirs.append(path)
+                checkout_enumerate(repo, leaf.sha, path + "/", blobs, dirs, cache_tree,
+                                   sparse if cone == "parent" else None, skipped)
+        else:
+            blobs.append((path, leaf.mode, leaf.sha))
+
+def checkout_update(repo, root, old, blobs, skipped, force=False):
+    """Compare the (path, mode, sha) blobs and skipped leaves of a checkout
+with old, the index of the worktree at root.  Return the blobs to write,
+the entries of old to keep and the skipped leaves left: unchanged files
+keep their entries, and their local changes, as in git.
+
+Before anything is written, every file old tracks which the checkout
+updates or removes is checked for local changes, by its stat data, then
+by its content.  Unless force, we refuse to go on if any has some; and
+always if a directory to replace by a file holds untracked files.  A
+modified file which only leaves the sparse checkout is not removed but
+kept, with its entry, as git does.  Only then are the files old tracks
+and the checkout drops removed."""
+    tracked = dict((e.name, e) for e in old.entries if not e.flag_skip_worktree)
+    write = list()
+    kept = list()
+    for blob in blobs:
+        entry = tracked.get(blob[0])
+        if not force and entry and (index_entry_mode(entry), entry.sha) == blob[1:]:
+            kept.append(entry)
+        else:
+            write.append(blob)
+
+    names = set(blob[0] for blob in blobs)
+    unchanged = set(e.name for e in kept)
+    changed = [ e for e in tracked.values() if e.name not in unchanged ]
+    dirty = list() if force else [ e for e in changed if worktree_modified(root, e) ]
+
+    # Files leaving the worktree for the sparse checkout, one by one or
+    # with their directory
+    leaving = set(name for name, _, _ in skipped)
+    spared = [ e for e in dirty if e.name in leaving or any(d + "/" in leaving for d in path_parents(e.name)) ]
+    if spared:
+        for e in spared:
+            print("warning: not removing {0}, which is modified".format(e.name), file=sys.stderr)
+        names_spared = set(e.name for e in spared)
+        skipped = checkout_unskip(repo, skipped, names_spared)
+        kept += spared
+        changed = [ e for e in changed if e.name not in names_spared ]
+        dirty = [ e for e in dirty if e.name not in names_spared ]
+
+    dirty = [ e.name for e in dirty ]
+    if dirty:
+        raise Exception("Your local changes to the following files would be overwritten by checkout:\n\t{0}\n"
+                        "Commit them, or checkout with --force to discard them.".format("\n\t".join(sorted(dirty))))
+
+    blocked = list()
+    for name, mode, _ in write:
+        full_path = os.path.join(root, name)
+        if mode.startswith(b'16') or os.path.islink(full_path) or not os.path.isdir(full_path):
+            continue
+        for dirpath, _, filenames in os.walk(full_path):
+            for f in filenames:
+                f = os.path.relpath(os.path.join(dirpath, f), root).replace(os.path.sep, "/")
+                if f not in tracked:
+                    blocked.append(f)
+    if blocked:
+        raise Exception("Updating the following directories would lose untracked files in them:\n\t{0}".format(
+            "\n\t".join(sorted(blocked))))
+
+    # Remove the files the previous checkout left behind
+    for entry in changed:
+        if entry.name in names:
+            continue
+        full_path = os.path.join(root, entry.name)
+        if os.path.islink(full_path) or (os.path.lexists(full_path) and not os.path.isdir(full_path)):
+            os.remove(full_path)
+        try:
+            os.removedirs(os.path.dirname(full_path))
+        except OSError:
+            pass
+
+    return write, kept, skipped
+
+def checkout_unskip(repo, skipped, names):
+    """Return the skipped leaves of a sparse checkout without the files
+names: directories holding some of them are replaced by their files."""
+    ret = list()
+    for leaf in skipped:
+        if leaf[0] in names:
+            continue
+        if leaf[0].endswith("/") and any(name.startswith(leaf[0]) for name in names):
+            files = list()
+            checkout_enumerate(repo, leaf[2], leaf[0], files, list(), dict())
+            ret += [ f for f in files if f[0] not in names ]
+        else:
+            ret.append(leaf)
+    return ret
+
+def worktree_modified(root, entry):
+    """Return whether the file of index entry in the worktree at root has
+local changes: its stat data differs, and so does its content.  A
+deleted file has nothing left to lose."""
+    full_path = os.path.join(root, entry.name)
+    try:
+        st = os.lstat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+    if (st.st_ctime_ns == entry.ctime[0] * 10**9 + entry.ctime[1]
+        and st.st_mtime_ns == entry.mtime[0] * 10**9 + entry.mtime[1]
+        and st.st_size == entry.fsize):
+        return False
+
+    if entry.mode_type == 0b1110:
+        # A submodule: we only left an empty directory for it
+        return False
+    if os.path.islink(full_path):
+        data = os.fsencode(os.readlink(full_path))
+    elif os.path.isdir(full_path):
+        return True
+    else:
+        with open(full_path, "rb") as f:
+            data = f.read()
+    return object_write(GitBlob(data)) != entry.sha
+
+def checkout_skipped(name, mode, sha):
+    """Return the skip-worktree index entry of a blob, or of a whole
+directory, left out of a sparse checkout.  It has no stat data."""
+    mode = int(mode, 8)
+    return GitIndexEntry(ctime=(0, 0), mtime=(0, 0), dev=0, ino=0,
+                         mode_type=mode >> 12,
+                         mode_perms=mode & 0o777,
+                         uid=0, gid=0, fsize=0,
+                         sha=sha,
+                         flag_assume_valid=False,
+                         flag_stage=0,
+                         name=name,
+                         flag_skip_worktree=True)
+
+def checkout_blob(repo, root, name, mode, sha):
+    """Write blob sha at root/name and return its index entry."""
+    full_path = os.path.join(root, name)
+    if os.path.islink(full_path) or (os.path.lexists(full_path) and not os.path.isdir(full_path)):
+        os.remove(full_path)
+    elif os.path.isdir(full_path) and not mode.startswith(b'16'):
+        # A directory the tree turned into a file: checkout_update removed
+        # the files in it, and made sure no untracked one is left
+        shutil.rmtree(full_path)
+
+    match mode[0:2]:
+        case b'12':
+            mode_type, mode_perms = 0b1010, 0
+            os.symlink(os.fsdecode(object_read(repo, sha).blobdata), full_path)
+        case b'16':
+            # A submodule: we only leave an empty directory for it
+            mode_type, mode_perms = 0b1110, 0
+            os.makedirs(full_path, exist_ok=True)
+        case _:
+            mode_type, mode_perms = 0b1000, int(mode[3:], 8)
+            data = object_read(repo, sha).blobdata
+            fd = os.open(full_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o777 if mode_perms & 0o100 else 0o666)
+            with open(fd, "wb") as f:
+                f.write(data)
+
+    st = os.lstat(full_path)
+    return GitIndexEntry(ctime=(st.st_ctime_ns // 10**9, st.st_ctime_ns % 10**9),
+                         mtime=(st.st_mtime_ns // 10**9, st.st_mtime_ns % 10**9),
+                         dev=st.st_dev,
+                         ino=st.st_ino,
+                         mode_type=mode_type,
+                         mode_perms=mode_perms,
+                         uid=st.st_uid,
+                         gid=st.st_gid,
+                         fsize=st.st_size,
+                         sha=sha,
+                         flag_assume_valid=False,
+                         flag_stage=0,
+                         name=name)
+
+def cmd_sparse_checkout(args):
+    """Bridge function to list, set or disable the directories of a cone
+mode sparse checkout, then update the worktree and index to match."""
+    repo = repo_find()
+    sparse = sparse_checkout_read(repo)
+
+    match args.action:
+        case "list":
+            if not sparse:
+                raise Exception("This worktree is not sparse")
+            for d in sorted(sparse.recursive):
+                print(d)
+            return
+        case "set":
+            sparse = GitSparseCheckout(args.dirs, sparse.index if sparse else False)
+        case "add":
+            if not sparse:
+                raise Exception("No sparse checkout to add to, use set")
+            sparse = GitSparseCheckout(sparse.recursive | set(args.dirs), sparse.index)
+        case "disable":
+            sparse = None
+
+    if sparse and args.sparse_index is not None:
+        sparse.index = args.sparse_index
+    sparse_checkout_write(repo, sparse)
+
+    if ref_resolve(repo, "HEAD"):
+        worktree_checkout(repo, head_tree(repo), args.jobs)
+
+class GitSparseCheckout(object):
+    """The directories of a cone mode sparse checkout.  Every file below
+a recursive directory is checked out, and so are the files directly in
+one of their parents (the root included); other directories are not."""
+    def __init__(self, dirs=(), index=False):
+        dirs = set(d.strip("/") for d in dirs if d.strip("/"))
+        # Directories inside another one add nothing
+        self.recursive = set(d for d in dirs if not any(p in dirs for p in path_parents(d)))
+        self.parents = set([ "" ])
+        for d in self.recursive:
+            self.parents.update(path_parents(d))
+        # Whether the index collapses the other directories
+        self.index = index
+
+    def directory(self, path):
+        """Return "recursive" for a directory entirely in the checkout,
+"parent" for one holding some of it, or None for one outside it."""
+        if path in self.parents:
+            return "parent"
+        if path in self.recursive or any(p in self.recursive for p in path_parents(path)):
+            return "recursive"
+        return None
+
+def path_parents(path):
+    """Return the directories holding path, outermost first: "a", "a/b"
+for "a/b/c"."""
+    parts = path.split("/")
+    return [ "/".join(parts[:i]) for i in range(1, len(parts)) ]
+
+def sparse_checkout_read(repo):
+    """Return the GitSparseCheckout of repo, from the cone mode patterns
+of .git/info/sparse-checkout, or None if it has none."""
+    if not repo.conf.getboolean("core", "sparseCheckout", fallback=False):
+        return None
+    path = repo_file(repo, "info", "sparse-checkout")
+    if not os.path.isfile(path):
+        return None
+
+    recursive = set()
+    parents = set()
+    with open(path) as f:
+        for line in f.read().splitlines():
+            line = line.strip()
+            if not line or line.startswith("#") or line in ("/*", "!/*/"):
+                continue
+            # Cone patterns escape the glob characters of names
+            name = re.sub(r"\\(.)", r"\1", line)
+            if name.startswith("!/") and name.endswith("/*/"):
+                parents.add(name[2:-3])
+            elif name.startswith("/") and name.endswith("/") and len(name) > 2:
+                recursive.add(name[1:-1])
+            else:
+                raise Exception("Not a cone mode sparse-checkout pattern: {0}".format(line))
+
+    return GitSparseCheckout(recursive - parents,
+                             repo.conf.getboolean("index", "sparse", fallback=False))
+
+def sparse_checkout_write(repo, sparse):
+    """Write sparse as cone mode patterns, in the layout git uses, and
+enable it in the config; or disable sparse checkout if it is None."""
+    if sparse:
+        lines = [ "/*", "!/*/" ]
+        escape = lambda d: re.sub(r"([\\*?\[\]])", r"\\\1", d)
+        for d in sorted(sparse.parents - set([ "" ])):
+            lines += [ "/{0}/".format(escape(d)), "!/{0}/*/".format(escape(d)) ]
+        lines += [ "/{0}/".format(escape(d)) for d in sorted(sparse.recursive) ]
+        with open(repo_file(repo, "info", "sparse-checkout", mkdir=True), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    for section, option, value in (("core", "sparseCheckout", bool(sparse)),
+                                   ("core", "sparseCheckoutCone", bool(sparse)),
+                                   ("index", "sparse", bool(sparse and sparse.index))):
+        if not repo.conf.has_section(section):
+            repo.conf.add_section(section)
+        repo.conf.set(section, option, "true" if value else "false")
+    with open(repo_file(repo, "config"), "w") as f:
+        repo.conf.write(f)
+
+def cmd_fsck(args):
+    """Bridge function to verify every object of the repository.
+
+Inflating and hashing is spread over a process pool; workers send back
+the links of each object, so the connectivity and reachability checks
+don't read anything again."""
+    repo = repo_find()
+    start = time.perf_counter()
+    tasks = fsck_list_objects(repo)
+    objects = dict()
+    # Objects already reported as unreadable, not to report them missing
+    broken = set()
+    errors = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                initializer=fsck_worker_init,
+                                                initargs=(repo.worktree,)) as pool:
+        for error in pool.map(fsck_pack, [ p.path for p in pack_list(repo) ]):
+            if error:
+                print("error: {0}".format(error))
+                errors += 1
+
+        for sha, fmt, links, error in pool.map(fsck_object, tasks, chunksize=256):
+            if error:
+                print("error in object {0}: {1}".format(sha, error))
+                broken.add(sha)
+                errors += 1
+            else:
+                objects[sha] = (fmt, links)
+
+    # Connectivity
+    missing = set()
+    for sha, (fmt, links) in sorted(objects.items()):
+        for kind, target in links:
+            if target not in objects:
+                if target in broken:
+                    continue
+                if any(object_header(alt, target) for alt in repo_alternates(repo)):
+                    continue
+                if target not in missing:
+                    print("missing {0} {1}".format(kind, target))
+                    missing.add(target)
+                    errors += 1
+            elif objects[target][0] != kind.encode("ascii"):
+                print("error in {0} {1}: {2} is a {3}, not a {4}".format(
+                    fmt.decode("ascii"), sha, target, objects[target][0].decode("ascii"), kind))
+                errors += 1
+
+    # Reachability
+    reachable = set()
+    stack = [ sha for sha in fsck_roots(repo) if sha in objects ]
+    while stack:
+        sha = stack.pop()
+        if sha in reachable:
+            continue
+        reachable.add(sha)
+        stack.extend(target for _, target in objects[sha][1] if target in objects)
+
+    unreachable = set(objects) - reachable
+    referenced = set(target for sha in unreachable for _, target in objects[sha][1])
+    for sha in sorted(unreachable):
+        if args.unreachable:
+            print("unreachable {0} {1}".format(objects[sha][0].decode("ascii"), sha))
+        elif sha not in referenced:
+            print("dangling {0} {1}".format(objects[sha][0].decode("ascii"), sha))
+
+    elapsed = time.perf_counter() - start
+    print("Checked {0} objects in {1:.2f}s ({2:.0f} objects/sec)".format(
+        len(tasks), elapsed, len(tasks) / elapsed if elapsed else 0), file=sys.stderr)
+
+    if errors:
+        sys.exit(1)
+
+def fsck_list_objects(repo):
+    """Return a (sha, pack path, offset) task for every loose object (with
+no pack) and every packed object."""
+    ret = list()
+    path = repo_dir(repo, "objects")
+    for d in sorted(os.listdir(path)):
+        if len(d) != 2 or not os.path.isdir(os.path.join(path, d)):
+            continue
+        for f in sorted(os.listdir(os.path.join(path, d))):
+            if len(f) == 38:
+                ret.append((d + f, None, None))
+
+    for pack in pack_list(repo):
+        for i in range(pack.fanout[255]):
+            ret.append((pack.names[20*i:20*i + 20].hex(), pack.path, pack_offset(pack, i)))
+    return ret
+
+def fsck_roots(repo):
+    """Return the SHAs reachability starts from: HEAD, every ref and the
+blobs of the index."""
+    return ref_tips(repo) + [ e.sha for e in index_read(repo).entries ]
+
+def ref_tips(repo):
+    """Return the SHAs of HEAD and of every ref."""
+    ret = list()
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        ret.append(head)
+
+    stack = [ ref_list(repo) ]
+    while stack:
+        for val in stack.pop().values():
+            if type(val) == str:
+                ret.append(val)
+            elif val:
+                stack.append(val)
+    return ret
+
+# The repository each fsck worker process reads from
+fsck_worker_repo = None
+
+def fsck_worker_init(worktree):
+    global fsck_worker_repo
+    fsck_worker_repo = GitRepository(worktree)
+
+def fsck_pack(path):
+    """Verify the trailing checksums of a pack and its index."""
+    repo = fsck_worker_repo
+    pack = next(p for p in pack_list(repo) if p.path == path)
+    # Views hash the maps in place, slices would copy them
+    with memoryview(pack.data) as data:
+        if hashlib.sha1(data[:-20]).digest() != pack.data[-20:]:
+            return "{0}.pack: bad checksum".format(path)
+    with memoryview(pack.idx) as idx:
+        if hashlib.sha1(idx[:-20]).digest() != pack.idx[-20:]:
+            return "{0}.idx: bad checksum".format(path)
+    if pack.idx[-40:-20] != pack.data[-20:]:
+        return "{0}.idx: does not match its pack".format(path)
+    return None
+
+def fsck_object(task):
+    """Read, rehash and parse one object.  Returns (sha, fmt, links,
+error) where links lists the (type, sha) the object points to."""
+    sha, path, offset = task
+    repo = fsck_worker_repo
+    try:
+        if path is None:
+            with open(repo_file(repo, "objects", sha[0:2], sha[2:]), "rb") as f:
+                fmt, data = object_parse_loose(zlib.decompress(f.read()), sha)
+        else:
+            pack = next(p for p in pack_list(repo) if p.path == path)
+            fmt, data = pack_read(repo, pack, offset)
+
+        h = hashlib.sha1(fmt + b' ' + str(len(data)).encode() + b'\x00')
+        h.update(data)
+        if h.hexdigest() != sha:
+            return sha, fmt, None, "hash mismatch, content hashes to {0}".format(h.hexdigest())
+
+        return sha, fmt, fsck_links(fmt, data), None
+    except Exception as e:
+        return sha, None, None, str(e) or type(e).__name__
+
+def fsck_links(fmt, data):
+    """Check the structure of an object and return what it points to."""
+    links = list()
+    match fmt:
+        case b'tree':
+            items = tree_parse(data)
+            for prev, leaf in zip([ None ] + items, items):
+                if prev and tree_leaf_sort_key(prev) >= tree_leaf_sort_key(leaf):
+                    raise Exception("not properly sorted")
+                match leaf.mode[0:2]:
+                    case b'04': links.append(("tree", leaf.sha))
+                    case b'10' | b'12': links.append(("blob", leaf.sha))
+                    # Submodule commits live in another repository
+                    case b'16': pass
+                    case _: raise Exception("bad mode {0}".format(leaf.mode.decode("ascii")))
+        case b'commit':
+            commit = GitCommit(data)
+            if b'tree' not in commit.kvlm:
+                raise Exception("missing tree")
+            links.append(("tree", commit.kvlm[b'tree'].decode("ascii")))
+            links.extend(("commit", p) for p in commit_parents(commit))
+        case b'tag':
+            tag = GitTag(data)
+            links.append((tag.kvlm[b'type'].decode("ascii"), tag.kvlm[b'object'].decode("ascii")))
+        case b'blob':
+            pass
+        case _:
+            raise Exception("unknown type {0}".format(fmt.decode("ascii")))
+    return links
+
+class GitBitmap(object):
+    """The reachability bitmaps of a pack.  Bit i stands for the i-th
+object of the pack in offset order; bitmaps are decoded to Python ints,
+so set operations are plain bitwise operations."""
+    pack = None
+    # SHA of each bit, and bit of each SHA
+    shas = None
+    positions = None
+    # Bitmaps of all the commits, trees, blobs and tags of the pack
+    types = None
+    # Commit SHA -> bitmap of every object it reaches
+    commits = None
+
+    def __init__(self, pack):
+        self.pack = pack
+        count = pack.fanout[255]
+        order = sorted(range(count), key=lambda i: pack_offset(pack, i))
+        self.shas = [ pack.names[20*i:20*i + 20].hex() for i in order ]
+        self.positions = { sha: bit for bit, sha in enumerate(self.shas) }
+        self.types = dict()
+        self.commits = dict()
+
+def ewah_read(raw, pos):
+    """Decode the EWAH bitmap at pos of raw.  Returns (bits, next pos)."""
+    words = int.from_bytes(raw[pos + 4:pos + 8], "big")
+    pos += 8
+    end = pos + 8 * words
+
+    # Rebuild the bitmap as little endian bytes, then as an int
+    out = bytearray()
+    while pos < end:
+        rlw = int.from_bytes(raw[pos:pos + 8], "big")
+        pos += 8
+        run = (rlw >> 1) & 0xFFFFFFFF
+        literals = rlw >> 33
+        out += (b'\xff' if rlw & 1 else b'\x00') * (8 * run)
+        for i in range(literals):
+            out += raw[pos:pos + 8][::-1]
+            pos += 8
+
+    # Skip the position of the last running length word
+    return int.from_bytes(out, "little"), end + 4
+
+def ewah_write(bits, size):
+    """Encode the first size bits of bits as an EWAH bitmap."""
+    count = ceil(size / 64)
+    raw = bits.to_bytes(8 * count, "little")
+    words = [ int.from_bytes(raw[8*i:8*i + 8], "little") for i in range(count) ]
+
+    out = list()
+    last_rlw = 0
+    i = 0
+    while i < count:
+        # A run of empty or full words, then the literal words after it
+        fill = words[i] if words[i] in (0, 0xFFFFFFFFFFFFFFFF) else 0
+        run = 0
+        while i < count and words[i] == fill and run < 0xFFFFFFFF:
+            run += 1
+            i += 1
+        start = i
+        while i < count and words[i] not in (0, 0xFFFFFFFFFFFFFFFF) and i - start < 0x7FFFFFFF:
+            i += 1
+        last_rlw = len(out)
+        out.append(((i - start) << 33) | (run << 1) | (1 if fill else 0))
+        out.extend(words[start:i])
+
+    ret = size.to_bytes(4, "big") + len(out).to_bytes(4, "big")
+    ret += b''.join(w.to_bytes(8, "big") for w in out)
+    ret += last_rlw.to_bytes(4, "big")
+    return ret
+
+def bitmap_read(pack):
+    """Return the GitBitmap of pack, or None if it has no .bitmap file."""
+    if pack.bitmap is None:
+        pack.bitmap = False
+        path = pack.path + ".bitmap"
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                raw = f.read()
+            if raw[0:4] != b"BITM" or int.from_bytes(raw[4:6], "big") != 1:
+                raise Exception("Unsupported bitmap {0}".format(path))
+            if raw[12:32] != pack.data[-20:]:
+                raise Exception("Bitmap {0} does not match its pack".format(path))
+
+            bm = GitBitmap(pack)
+            count = int.from_bytes(raw[8:12], "big")
+            pos = 32
+            for fmt in (b'commit', b'tree', b'blob', b'tag'):
+                bm.types[fmt], pos = ewah_read(raw, pos)
+
+            # Each bitmap may be XORed with one of the previous entries
+            entries = list()
+            for i in range(count):
+                sha = pack.names[20*int.from_bytes(raw[pos:pos + 4], "big"):][:20].hex()
+                xor = raw[pos + 4]
+                bits, pos = ewah_read(raw, pos + 6)
+                if xor:
+                    bits ^= entries[i - xor]
+                entries.append(bits)
+                bm.commits[sha] = bits
+            pack.bitmap = bm
+
+    return pack.bitmap or None
+
+def bitmap_fill(repo, bm, tips, extra):
+    """Return the bitmap of everything reachable from tips.
+
+We walk the graph, but stop at commits which have a bitmap and at
+objects already marked.  Objects outside the pack of bm can't have a
+bit: they are added to the extra set instead."""
+    bits = 0
+    seen = set()
+    stack = [ (None, sha) for sha in tips ]
+
+    while stack:
+        fmt, sha = stack.pop()
+        bit = bm.positions.get(sha)
+        if bit is None:
+            if sha in extra:
+                continue
+            extra.add(sha)
+        else:
+            if bit in seen or bits >> bit & 1:
+                continue
+            if sha in bm.commits:
+                bits |= bm.commits[sha]
+                continue
+            seen.add(bit)
+
+        # Blobs have no links, no need to read them
+        if fmt == b'blob':
+            continue
+        fmt, data = object_read_raw(repo, sha)
+        for kind, target in fsck_links(fmt, data):
+            stack.append((kind.encode("ascii"), target))
+
+    walked = bytearray(ceil(len(bm.shas) / 8))
+    for bit in seen:
+        walked[bit >> 3] |= 1 << (bit & 7)
+    return bits | int.from_bytes(walked, "little")
+
+def reachable_objects(repo, include, exclude=None, fmt=None):
+    """Return the set of SHAs reachable from include but not from exclude,
+only those of type fmt if given.
+
+With a bitmapped pack, this is a difference of two bitmaps, plus a walk
+of whatever the bitmaps don't cover; the type bitmaps then select fmt,
+and only the objects outside them have their header read.  Without one,
+it is a graph walk."""
+    if exclude is None:
+        exclude = list()
+    bm = None
+    for pack in pack_list(repo):
+        bm = bitmap_read(pack)
+        if bm:
+            break
+
+    if not bm:
+        excluded = set()
+        objects_walk(repo, exclude, excluded)
+        ret = set()
+        objects_walk(repo, include, ret, excluded)
+        if fmt:
+            ret = set(sha for sha in ret if object_header(repo, sha)[0] == fmt)
+        return ret
+
+    exclude_extra = set()
+    exclude_bits = bitmap_fill(repo, bm, exclude, exclude_extra)
+    include_extra = set()
+    include_bits = bitmap_fill(repo, bm, include, include_extra)
+
+    bits = include_bits & ~exclude_bits
+    ret = include_extra - exclude_extra
+    if fmt:
+        bits &= bm.types[fmt]
+        ret = set(sha for sha in ret if object_header(repo, sha)[0] == fmt)
+    raw = bits.to_bytes(ceil(len(bm.shas) / 8), "little")
+    for i, byte in enumerate(raw):
+        while byte:
+            low = byte & -byte
+            ret.add(bm.shas[8*i + low.bit_length() - 1])
+            byte ^= low
+    return ret
+
+def objects_walk(repo, tips, seen, stop=None):
+    """Add to seen every object reachable from tips, not crossing stop."""
+    if stop is None:
+        stop = set()
+    stack = [ (None, sha) for sha in tips ]
+    while stack:
+        fmt, sha = stack.pop()
+        if sha in seen or sha in stop:
+            continue
+        seen.add(sha)
+        if fmt == b'blob':
+            continue
+        fmt, data = object_read_raw(repo, sha)
+        for kind, target in fsck_links(fmt, data):
+            stack.append((kind.encode("ascii"), target))
+
+def bitmap_write(repo, pack, interval=100):
+    """Write pack.bitmap, with a bitmap for every ref and one commit
+every interval commits.  Commits are processed parents first, so each
+bitmap is the union of the bitmaps below it plus a short walk."""
+    bm = GitBitmap(pack)
+    types = { fmt: bytearray(ceil(len(bm.shas) / 8)) for fmt in (b'commit', b'tree', b'blob', b'tag') }
+    for bit, sha in enumerate(bm.shas):
+        types[pack_type(repo, pack, pack_find(pack, sha))][bit >> 3] |= 1 << (bit & 7)
+    for fmt, bits in types.items():
+        bm.types[fmt] = int.from_bytes(bits, "little")
+
+    # Peel the refs to commits, and list those commits parents first
+    tips = list()
+    for sha in ref_tips(repo):
+        obj = object_read(repo, sha)
+        while obj and obj.fmt == b'tag':
+            sha = obj.kvlm[b'object'].decode("ascii")
+            obj = object_read(repo, sha)
+        if obj and obj.fmt == b'commit' and sha not in tips:
+            tips.append(sha)
+    order = commits_topo_order(repo, tips)
+
+    selected = set(tips) | set(order[interval - 1::interval])
+    for sha in order:
+        if sha not in selected or sha not in bm.positions:
+            continue
+        extra = set()
+        bits = bitmap_fill(repo, bm, [ sha ], extra)
+        # A bitmap must cover everything the commit reaches
+        if not extra:
+            bm.commits[sha] = bits
+
+    size = len(bm.shas)
+    names = { pack.names[20*i:20*i + 20].hex(): i for i in range(size) }
+    raw = b"BITM" + (1).to_bytes(2, "big")
+    # Option flags: BITMAP_OPT_FULL_DAG
+    raw += (1).to_bytes(2, "big")
+    raw += len(bm.commits).to_bytes(4, "big")
+    raw += pack.data[-20:]
+    for fmt in (b'commit', b'tree', b'blob', b'tag'):
+        raw += ewah_write(bm.types[fmt], size)
+    for sha, bits in bm.commits.items():
+        raw += names[sha].to_bytes(4, "big") + b'\x00\x00' + ewah_write(bits, size)
+    raw += hashlib.sha1(raw).digest()
+
+    object_write_file(pack.path + ".bitmap", raw)
+    pack.bitmap = bm
+    return len(bm.commits)
+
+def commits_topo_order(repo, tips):
+    """Return the commits reachable from tips, every parent before its
+children."""
+    ret = list()
+    done = set()
+    stack = [ (sha, False) for sha in tips ]
+    while stack:
+        sha, expanded = stack.pop()
+        if expanded:
+            ret.append(sha)
+            continue
+        if sha in done:
+            continue
+        done.add(sha)
+        stack.append((sha, True))
+        for p in commit_parents(object_read(repo, sha)):
+            if p not in done:
+                stack.append((p, False))
+    return ret
+
+def cmd_bitmap(args):
+    """Bridge function to write the reachability bitmaps of the biggest pack."""
+    repo = repo_find()
+    packs = pack_list(repo)
+    if not packs:
+        raise Exception("No pack to write bitmaps for.")
+    pack = max(packs, key=lambda p: p.fanout[255])
+    count = bitmap_write(repo, pack, args.interval)
+    print("Wrote {0} bitmaps to {1}.bitmap".format(count, pack.path))
+
+def cmd_rev_list(args):
+    """Bridge function to list what some commits reach but others don't."""
+    repo = repo_find()
+    include = list()
+    exclude = list()
+    for name in args.commit:
+        if name.startswith("^"):
+            exclude.append(object_find(repo, name[1:]))
+        else:
+            include.append(object_find(repo, name))
+
+    objects = reachable_objects(repo, include, exclude, None if args.objects else b'commit')
+
+    if args.count:
+        print(len(objects))
+    else:
+        for sha in sorted(objects):
+            print(sha)
+
+def cmd_merge_base(args):
+    """Bridge function to print the merge bases of commits, or test
+whether one is an ancestor of another."""
+    repo = repo_find()
+    commits = [ object_find(repo, name, fmt=b'commit') for name in args.commit ]
+
+    if args.is_ancestor:
+        if len(commits) != 2:
+            raise Exception("--is-ancestor takes exactly two commits")
+        sys.exit(0 if is_ancestor(repo, commits[0], commits[1]) else 1)
+
+    if len(commits) < 2:
+        raise Exception("merge-base needs at least two commits")
+    bases = merge_bases(repo, commits[0], commits[1:])
+    if not bases:
+        sys.exit(1)
+    for sha in bases if args.all else bases[:1]:
+        print(sha)
+
+def commit_links(repo, sha):
+    """Return the (parents, commit time, tree) of commit sha, parsed from
+its header alone and cached in repo.commits: ancestry queries need
+nothing else, and visit the same commits again and again."""
+    commits = repo.commits
+    if commits is None:
+        commits = repo.commits = GitCommitCache(commit_cache_size)
+    links = commits.get(sha)
+    if links:
+        return links
+    links = commit_read_links(repo, sha)
+    commits.put(sha, links)
+    return links
+
+def commit_read_links(repo, sha):
+    """Read the (parents, commit time, tree) of commit sha, without caching
+them: walks of the whole history use it, not to evict what ancestry
+queries keep."""
+    raw = object_read_raw(repo, sha)
+    if not raw or raw[0] != b'commit':
+        raise Exception("Not a commit {0}".format(sha))
+    data = raw[1]
+    end = data.find(b'\n\n')
+    parents = list()
+    date = 0
+    tree = None
+    for line in data[:end if end >= 0 else len(data)].split(b'\n'):
+        if line.startswith(b'tree '):
+            tree = line[5:].decode("ascii")
+        elif line.startswith(b'parent '):
+            parents.append(line[7:].decode("ascii"))
+        elif line.startswith(b'committer '):
+            date = int(line.rsplit(b' ', 2)[1])
+    if trace_file:
+        trace_count("commits_parsed")
+
+    return (parents, date, tree)
+
+class GitCommitCache(object):
+    """A least recently used cache of the commit_links of a repository,
+bounded by a number of commits and shared by the threads using it.
+Pooled repositories live as long as the process, so the commits walked
+through them must not pile up."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, sha):
+        with self.lock:
+            links = self.entries.get(sha)
+            if links is not None:
+                self.entries.move_to_end(sha)
+        return links
+
+    def put(self, sha, links):
+        with self.lock:
+            self.entries[sha] = links
+            while len(self.entries) > self.limit:
+                self.entries.popitem(last=False)
+
+# Commits whose links each repository keeps
+commit_cache_size = 1 << 16
+
+# Flags painted on commits by merge_base_paint
+MERGE_BASE_PARENT1 = 1
+MERGE_BASE_PARENT2 = 2
+MERGE_BASE_STALE = 4
+
+def merge_base_paint(repo, one, twos):
+    """Paint the ancestors of one and of twos down to their common ones,
+the way git does, and return (candidates, flags): the common commits
+found first, newest first, and the flags of every commit visited.
+
+Commits are visited newest first from a priority queue on commit time
+(there is no commit-graph, hence no generation number).  Every commit
+reachable from both sides is a candidate, and its ancestors are painted
+stale: they cannot be a best base.  The walk stops as soon as only
+stale commits are queued, so it never goes much further back than the
+bases themselves.  A candidate later reached as stale, which happens
+with clock skew only, is dropped."""
+    flags = collections.defaultdict(int)
+    queue = list()
+    # Entries per commit in the queue, and how many are not stale
+    queued = collections.Counter()
+    nonstale = 0
+    counter = itertools.count()
+
+    def push(sha):
+        nonlocal nonstale
+        heapq.heappush(queue, (-commit_links(repo, sha)[1], next(counter), sha))
+        queued[sha] += 1
+        if not flags[sha] & MERGE_BASE_STALE:
+            nonstale += 1
+
+    flags[one] |= MERGE_BASE_PARENT1
+    push(one)
+    for two in twos:
+        flags[two] |= MERGE_BASE_PARENT2
+        push(two)
+
+    candidates = list()
+    while nonstale:
+        _, _, sha = heapq.heappop(queue)
+        queued[sha] -= 1
+        f = flags[sha]
+        if not f & MERGE_BASE_STALE:
+            nonstale -= 1
+        f &= MERGE_BASE_PARENT1 | MERGE_BASE_PARENT2 | MERGE_BASE_STALE
+        if f == MERGE_BASE_PARENT1 | MERGE_BASE_PARENT2:
+            if sha not in candidates:
+                candidates.append(sha)
+            f |= MERGE_BASE_STALE
+
+        for parent in commit_links(repo, sha)[0]:
+            if flags[parent] & f == f:
+                continue
+            if f & MERGE_BASE_STALE and not flags[parent] & MERGE_BASE_STALE:
+                # Its entries already queued are stale from now on
+                nonstale -= queued[parent]
+            flags[parent] |= f
+            push(parent)
+
+    if trace_file:
+        trace_count("commits_painted", len(flags))
+    return [ sha for sha in candidates if not flags[sha] & MERGE_BASE_STALE ], flags
+
+def merge_bases(repo, one, twos):
+    """Return the best common ancestors of one and of (a merge of) the
+commits in twos, newest first: the common ancestors which are not
+ancestors of another common ancestor."""
+    twos = list(twos)
+    if one in twos:
+        return [ one ]
+    candidates, _ = merge_base_paint(repo, one, twos)
+    candidates.sort(key=lambda sha: -commit_links(repo, sha)[1])
+    if len(candidates) < 2:
+        return candidates
+
+    # A candidate reachable from another one is not a best base
+    redundant = set()
+    for sha in candidates:
+        if sha in redundant:
+            continue
+        others = [ c for c in candidates if c != sha and c not in redundant ]
+        if not others:
+            break
+        _, flags = merge_base_paint(repo, sha, others)
+        if flags[sha] & MERGE_BASE_PARENT2:
+            redundant.add(sha)
+        redundant.update(c for c in others if flags[c] & MERGE_BASE_PARENT1)
+    return [ sha for sha in candidates if sha not in redundant ]
+
+def is_ancestor(repo, ancestor, commit):
+    """Tell if ancestor is reachable from commit (or is commit): if the
+paint from commit reaches it.  None of the other candidates can be a
+better base than ancestor, so there is nothing to reduce."""
+    if ancestor == commit:
+        return True
+    _, flags = merge_base_paint(repo, ancestor, [ commit ])
+    return bool(flags[ancestor] & MERGE_BASE_PARENT2)
+
+def commits_walk(repo, tips):
+    """Yield the (sha, GitCommit) of the commits reachable from tips,
+newest first by commit time, each once."""
+    seen = set(tips)
+    queue = [ (-commit_links(repo, sha)[1], sha) for sha in seen ]
+    heapq.heapify(queue)
+    while queue:
+        _, sha = heapq.heappop(queue)
+        yield sha, object_read(repo, sha)
+        for parent in commit_links(repo, sha)[0]:
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(queue, (-commit_links(repo, parent)[1], parent))
+
+class GitMultiPackIndex(object):
+    """The objects/pack/multi-pack-index file: one fanout table and one
+sorted OID list over many packs, each OID with its pack and offset.
+The file is kept mmapped and searched in place."""
+    data = None
+    pack_names = None
+    fanout = None
+    count = None
+    # Offsets of the OIDL, OOFF and LOFF chunks in data (LOFF may be None)
+    oids = None
+    offsets = None
+    large_offsets = None
+    # Opened pack of each pack name, and the packs it doesn't cover
+    packs = None
+    others = None
+
+def midx_packs(repo, midx):
+    """Return the GitPack of each pack name of midx (None if missing) and
+the list of packs midx doesn't cover."""
+    if midx.packs is None:
+        by_name = { os.path.basename(p.path) + ".idx": p for p in pack_list(repo) }
+        midx.packs = [ by_name.pop(name, None) for name in midx.pack_names ]
+        midx.others = list(by_name.values())
+    return midx.packs, midx.others
+
+def midx_read(repo):
+    """Return the GitMultiPackIndex of repo, or None if it has none."""
+    if repo.midx is None:
+        midx = False
+        path = repo_file(repo, "objects", "pack", "multi-pack-index")
+        if path and os.path.isfile(path):
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if data[0:4] != b"MIDX" or data[4] != 1 or data[5] != 1:
+                raise Exception("Unsupported multi-pack-index {0}".format(path))
+
+            chunks = dict()
+            for i in range(data[6]):
+                entry = 12 + 12 * i
+                chunks[bytes(data[entry:entry + 4])] = int.from_bytes(data[entry + 4:entry + 12], "big")
+
+            midx = GitMultiPackIndex()
+            midx.data = data
+            pack_count = int.from_bytes(data[8:12], "big")
+            names = chunks[b"PNAM"]
+            midx.pack_names = data[names:names + 1024 * pack_count].split(b'\x00')[:pack_count]
+            midx.pack_names = [ n.decode("utf8") for n in midx.pack_names ]
+            fanout = chunks[b"OIDF"]
+            midx.fanout = [ int.from_bytes(data[fanout + 4*i:fanout + 4*i + 4], "big") for i in range(256) ]
+            midx.count = midx.fanout[255]
+            midx.oids = chunks[b"OIDL"]
+            midx.offsets = chunks[b"OOFF"]
+            midx.large_offsets = chunks.get(b"LOFF")
+        repo.midx = midx
+
+    return repo.midx or None
+
+def midx_entry(midx, i):
+    """Return the (pack number, offset) of the i-th OID of midx."""
+    pos = midx.offsets + 8 * i
+    pack = int.from_bytes(midx.data[pos:pos + 4], "big")
+    offset = int.from_bytes(midx.data[pos + 4:pos + 8], "big")
+    if midx.large_offsets is not None and offset & 0x80000000:
+        pos = midx.large_offsets + 8 * (offset & 0x7FFFFFFF)
+        offset = int.from_bytes(midx.data[pos:pos + 8], "big")
+    return pack, offset
+
+def midx_find(repo, midx, sha):
+    """Return the (pack, offset) of sha according to midx, or None."""
+    i = sha_search(midx.data, midx.oids, midx.fanout, bytes.fromhex(sha))
+    if i is None:
+        return None
+    pack, offset = midx_entry(midx, i)
+    pack = midx_packs(repo, midx)[0][pack]
+    return (pack, offset) if pack else None
+
+@traced("midx", "write")
+def midx_write(repo):
+    """Write a multi-pack-index covering every pack, and return how many
+packs it covers.  Packs the previous multi-pack-index already covered
+are taken from it instead of re-reading their indexes; entries of packs
+which don't exist anymore are dropped."""
+    packs = { os.path.basename(p.path) + ".idx": p for p in pack_list(repo) }
+    names = sorted(packs)
+    number = { name: i for i, name in enumerate(names) }
+
+    entries = dict()
+    old = midx_read(repo)
+    if old:
+        for i in range(old.count):
+            pack, offset = midx_entry(old, i)
+            name = old.pack_names[pack]
+            if name in number:
+                oid = old.data[old.oids + 20*i:old.oids + 20*i + 20]
+                entries[oid] = (number[name], offset)
+
+    for name in names:
+        if old and name in old.pack_names:
+            continue
+        pack = packs[name]
+        for i in range(pack.fanout[255]):
+            entries.setdefault(pack.names[20*i:20*i + 20], (number[name], pack_offset(pack, i)))
+
+    oids = sorted(entries)
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[oid[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    # Offsets past 2GiB only need a large offset chunk when they don't
+    # fit in 32 bits at all
+    need_large = any(offset >= 1 << 32 for _, offset in entries.values())
+    large = list()
+    ooff = bytearray()
+    for oid in oids:
+        pack, offset = entries[oid]
+        ooff += pack.to_bytes(4, "big")
+        if need_large and offset >= 0x80000000:
+            ooff += (0x80000000 | len(large)).to_bytes(4, "big")
+            large.append(offset)
+        else:
+            ooff += offset.to_bytes(4, "big")
+
+    pnam = b''.join(name.encode("utf8") + b'\x00' for name in names)
+    pnam += b'\x00' * (-len(pnam) % 4)
+    chunks = [ (b"PNAM", pnam),
+               (b"OIDF", b''.join(n.to_bytes(4, "big") for n in fanout)),
+               (b"OIDL", b''.join(oids)),
+               (b"OOFF", bytes(ooff)) ]
+    if need_large:
+        chunks.append((b"LOFF", b''.join(o.to_bytes(8, "big") for o in large)))
+
+    raw = b"MIDX" + bytes([ 1, 1, len(chunks), 0 ]) + len(names).to_bytes(4, "big")
+    offset = len(raw) + 12 * (len(chunks) + 1)
+    for chunk_id, chunk in chunks:
+        raw += chunk_id + offset.to_bytes(8, "big")
+        offset += len(chunk)
+    raw += b'\x00' * 4 + offset.to_bytes(8, "big")
+    raw += b''.join(chunk for _, chunk in chunks)
+    raw += hashlib.sha1(raw).digest()
+
+    # Threads still reading the old one keep its map, which goes away
+    # with the last of them
+    repo.midx = None
+    object_write_file(repo_path(repo, "objects", "pack", "multi-pack-index"), raw)
+    return len(names)
+
+def midx_verify(repo):
+    """Check the multi-pack-index and return a list of errors."""
+    midx = midx_read(repo)
+    if not midx:
+        return [ "no multi-pack-index" ]
+
+    errors = list()
+    data = midx.data
+    if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+        errors.append("bad checksum")
+
+    packs = { os.path.basename(p.path) + ".idx": p for p in pack_list(repo) }
+    for name in midx.pack_names:
+        if name not in packs:
+            errors.append("missing pack {0}".format(name))
+    if midx.pack_names != sorted(midx.pack_names):
+        errors.append("pack names are not sorted")
+
+    prev = None
+    count = 0
+    for i in range(midx.count):
+        oid = data[midx.oids + 20*i:midx.oids + 20*i + 20]
+        if prev is not None and prev >= oid:
+            errors.append("OIDs out of order at {0}".format(i))
+        prev = oid
+        while count < 256 and midx.fanout[count] <= i:
+            count += 1
+        if oid[0] != count:
+            errors.append("fanout mismatch for {0}".format(oid.hex()))
+
+        pack, offset = midx_entry(midx, i)
+        p = packs.get(midx.pack_names[pack]) if pack < len(midx.pack_names) else None
+        if p is None:
+            continue
+        if pack_find(p, oid.hex()) != offset:
+            errors.append("bad offset for {0} in {1}".format(oid.hex(), midx.pack_names[pack]))
+    return errors
+
+def cmd_multi_pack_index(args):
+    """Bridge function to write or verify the multi-pack-index."""
+    repo = repo_find()
+    match args.action:
+        case "write":
+            print("Indexed {0} packs.".format(midx_write(repo)))
+        case "verify":
+            errors = midx_verify(repo)
+            for error in errors:
+                print("error: {0}".format(error))
+            if errors:
+                sys.exit(1)
+
+def cmd_clone(args):
+    """Bridge function to clone a local repository."""
+    if "://" in args.repository:
+        raise Exception("Only local repositories can be cloned: {0}".format(args.repository))
+    # Exactly the repository at that path, not one of its parents
+    source = repo_open(args.repository)
+    path = args.directory or os.path.basename(os.path.normpath(source.worktree))
+    clone_local(source, path, shared=args.shared, checkout=args.checkout, jobs=args.jobs, link=args.local)
+
+@traced("clone", "local")
+def clone_local(source, path, shared=False, checkout=True, jobs=None, link=True):
+    """Clone source to path without copying objects: they are hardlinked
+(copied across filesystems, or without link), or, if shared, read from
+source through objects/info/alternates.
+
+As git does, the clone gets a fresh config with source as its origin
+remote; the branches of source become remote-tracking branches of
+origin, tags are copied, and the branch of HEAD is the only local one.
+The index is built by the checkout."""
+    repo = repo_create(path)
+    objects = os.path.realpath(repo_path(source, "objects"))
+
+    # The alternates of source are relative to its own objects directory
+    alternates = [ os.path.realpath(repo_path(alt, "objects")) for alt in repo_alternates(source) ]
+    if shared:
+        alternates.insert(0, objects)
+    else:
+        clone_link_tree(objects, repo_path(repo, "objects"), link)
+        # A link to the file of source, which must not be written through
+        if os.path.lexists(repo_path(repo, "objects", "info", "alternates")):
+            os.remove(repo_path(repo, "objects", "info", "alternates"))
+    if alternates:
+        with open(repo_file(repo, "objects", "info", "alternates", mkdir=True), "w") as f:
+            f.write("".join(alt + "\n" for alt in alternates))
+
+    stack = [ ("", ref_list(source)) ]
+    while stack:
+        prefix, refs = stack.pop()
+        for name, val in refs.items():
+            if type(val) != str:
+                if val:
+                    stack.append((prefix + name + "/", val))
+            elif prefix.startswith("heads/"):
+                ref_create(repo, "remotes/origin/" + prefix[len("heads/"):] + name, val)
+            elif prefix.startswith("tags/"):
+                ref_create(repo, prefix + name, val)
+
+    repo.conf = repo_default_config()
+    repo.conf["remote \"origin\""] = { "url": os.path.realpath(source.worktree),
+                                        "fetch": "+refs/heads/*:refs/remotes/origin/*" }
+
+    head = ref_resolve(source, "HEAD")
+    branch = branch_get_active(source)
+    if branch:
+        branch = branch.decode("utf8")
+        repo.conf["branch \"{0}\"".format(branch)] = { "remote": "origin", "merge": "refs/heads/" + branch }
+        if head:
+            ref_create(repo, "heads/" + branch, head)
+            with open(repo_file(repo, "refs", "remotes", "origin", "HEAD", mkdir=True), "w") as f:
+                f.write("ref: refs/remotes/origin/{0}\n".format(branch))
+        head = "ref: refs/heads/" + branch
+    if head:
+        with open(repo_file(repo, "HEAD"), "w") as f:
+            f.write(head + "\n")
+
+    with open(repo_file(repo, "config"), "w") as f:
+        repo.conf.write(f)
+
+    if checkout and ref_resolve(repo, "HEAD"):
+        index_write(repo, tree_checkout(repo, head_tree(repo), repo.worktree, jobs))
+    return repo
+
+def clone_link_tree(src, dst, link=True):
+    """Recreate the files of src in dst, as hardlinks if link.  Each
+directory is created once, before the files in it."""
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for f in files:
+            # Leftovers of interrupted writes
+            if f.startswith("tmp_"):
+                continue
+            if link:
+                try:
+                    os.link(os.path.join(root, f), os.path.join(target, f))
+                    continue
+                except FileExistsError:
+                    continue
+                except OSError:
+                    # Another filesystem, or links are not allowed
+                    pass
+            shutil.copy2(os.path.join(root, f), os.path.join(target, f))
+
+class GitTreeNode(object):
+    """A directory of a GitTreeBuilder, read from the tree sha only when
+first needed.  items maps each name to a GitTreeNode or to a (mode, sha)
+pair, and entries to its serialized tree entry, but for the names in
+dirty.  order is the names in tree order, or None when they changed,
+and index the position of each name in order.
+sha is None while the directory has unwritten changes.  base is the last
+version read or written, and offsets the position of each entry in it."""
+    def __init__(self, sha=None):
+        self.sha = sha
+        self.items = None if sha else dict()
+        self.entries = None if sha else dict()
+        self.dirty = set()
+        self.order = None if sha else list()
+        self.base = sha
+        self.base_size = 0
+        self.offsets = dict()
+        # Name -> position in order, when needed
+        self.index = None
+
+class GitTreeBuilder(object):
+    """A mutable tree of paths, starting from the tree sha (or empty),
+whose trees are read and written through writer.
+
+Only the trees of the directories on changed paths are ever read, and
+write() only hashes and writes those again.  A directory keeps its
+serialized entries, so rewriting it only serializes the changed ones,
+and in a pack the new tree is a delta copying the others from the last
+version.  reuse is a builder no longer used, whose loaded directories are
+taken over instead of read again."""
+    def __init__(self, writer, sha=None, reuse=None):
+        self.writer = writer
+        self.root = GitTreeNode(sha)
+        # SHA -> loaded and unchanged directory of reuse
+        self.reusable = dict()
+        if reuse:
+            stack = [ reuse.root ]
+            while stack:
+                node = stack.pop()
+                if node.items is None:
+                    continue
+                if node.sha:
+                    self.reusable[node.sha] = node
+                stack.extend(item for item in node.items.values() if type(item) == GitTreeNode)
+
+    def load(self, node):
+        if node.items is None and node.sha in self.reusable:
+            old = self.reusable.pop(node.sha)
+            # Not its subdirectories, which may be taken over elsewhere too
+            node.items = { name: GitTreeNode(item.sha) if type(item) == GitTreeNode else item
+                           for name, item in old.items.items() }
+            node.entries = old.entries
+            node.order = old.order
+            node.index = old.index
+            node.offsets = old.offsets
+            node.base_size = old.base_size
+        if node.items is None:
+            fmt, raw = self.writer.read_raw(node.sha)
+            node.items = dict()
+            node.entries = dict()
+            node.order = list()
+            pos = 0
+            while pos < len(raw):
+                x = raw.find(b' ', pos)
+                y = raw.find(b'\x00', x)
+                mode = raw[pos:x]
+                name = raw[x + 1:y].decode("utf8")
+                sha = raw[y + 1:y + 21].hex()
+                node.items[name] = GitTreeNode(sha) if mode == b'40000' else (mode.rjust(6, b'0'), sha)
+                node.entries[name] = raw[pos:y + 21]
+                node.offsets[name] = pos
+                node.order.append(name)
+                pos = y + 21
+            node.base_size = len(raw)
+        return node.items
+
+    def lookup(self, path, create=False):
+        """Return the directories from the root down to the parent of
+path, creating the missing ones if create, or return None."""
+        nodes = [ self.root ]
+        for part in path.split("/")[:-1]:
+            items = self.load(nodes[-1])
+            child = items.get(part)
+            if type(child) != GitTreeNode:
+                if not create:
+                    return None
+                child = GitTreeNode()
+                self.link(nodes[-1], part, child)
+            nodes.append(child)
+        self.load(nodes[-1])
+        return nodes
+
+    def link(self, node, name, item):
+        """Set name to item in node, keeping the tree order if we can."""
+        old = node.items.get(name)
+        if old is None or (type(old) == GitTreeNode) != (type(item) == GitTreeNode):
+            node.order = None
+        node.items[name] = item
+        node.dirty.add(name)
+
+    def get(self, path):
+        """Return the (mode, sha) or GitTreeNode at path, or None."""
+        nodes = self.lookup(path)
+        return nodes[-1].items.get(path.rsplit("/", 1)[-1]) if nodes else None
+
+    def put(self, path, item):
+        nodes = self.lookup(path, create=True)
+        parts = path.split("/")
+        for i, node in enumerate(nodes[:-1]):
+            node.sha = None
+            node.dirty.add(parts[i])
+        nodes[-1].sha = None
+        self.link(nodes[-1], parts[-1], item)
+
+    def set(self, path, mode, sha):
+        self.put(path, GitTreeNode(sha) if mode == b'040000' else (mode, sha))
+
+    def remove(self, path):
+        """Remove path and the directories it leaves empty, and return
+what was there, or None."""
+        nodes = self.lookup(path)
+        parts = path.split("/")
+        if not nodes or parts[-1] not in nodes[-1].items:
+            return None
+        item = nodes[-1].items.pop(parts[-1])
+        # Drop the directories left empty
+        while len(nodes) > 1 and not nodes[-1].items:
+            nodes.pop()
+            parts.pop()
+            del nodes[-1].items[parts[-1]]
+        nodes[-1].order = None
+        for i, node in enumerate(nodes):
+            node.sha = None
+            node.dirty.add(parts[i])
+        return item
+
+    def clear(self):
+        self.root = GitTreeNode()
+
+    def write(self):
+        """Write the changed trees, and return the SHA of the root."""
+        return self.write_node(self.root)
+
+    def write_node(self, node):
+        if node.sha:
+            return node.sha
+        changed = node.dirty
+        node.dirty = set()
+        for name in changed:
+            item = node.items.get(name)
+            if item is None:
+                node.entries.pop(name, None)
+                continue
+            if type(item) == GitTreeNode:
+                mode, sha = b'40000', self.write_node(item)
+            else:
+                # Git stores tree modes without the leading zero
+                mode, sha = item[0].lstrip(b'0'), item[1]
+            node.entries[name] = mode + b' ' + name.encode("utf8") + b'\x00' + bytes.fromhex(sha)
+        if node.order is None:
+            node.index = None
+            # Only trees sort as if their name ended with a slash
+            node.order = sorted(node.items, key=lambda name: name + "/" if type(node.items[name]) == GitTreeNode else name)
+        entries = [ node.entries[name] for name in node.order ]
+        data = b''.join(entries)
+
+        positions = list(itertools.accumulate(map(len, entries), initial=0))
+
+        # Small trees compress faster than they deltify, and read faster whole
+        delta = None
+        if node.base and node.base_size >= 4096 and self.writer.deltifiable(node.base):
+            delta = delta_create(node.base_size, len(data), self.delta_ops(node, changed, entries, positions))
+        node.sha = self.writer.write_raw(b'tree', data, node.base, delta)
+
+        node.base = node.sha
+        node.base_size = len(data)
+        node.offsets = dict(zip(node.order, positions))
+        return node.sha
+
+    def delta_ops(self, node, changed, entries, positions):
+        """Return the delta_create() ops rebuilding the entries of node from
+its base: the changed entries are inserted, and the runs of entries
+between them copied."""
+        order = node.order
+        if node.index is None:
+            node.index = dict(zip(order, range(len(order))))
+        cuts = sorted(node.index[name] for name in changed if name in node.index)
+        cuts.append(len(order))
+
+        ops = list()
+        start = 0
+        for cut in cuts:
+            if start < cut:
+                old = node.offsets[order[start]]
+                size = positions[cut] - positions[start]
+                if node.offsets[order[cut - 1]] + len(entries[cut - 1]) - old == size:
+                    ops.append((old, size))
+                else:
+                    # Entries removed from the run, copy each one
+                    ops.extend((node.offsets[order[i]], len(entries[i])) for i in range(start, cut))
+            if cut < len(order):
+                ops.append(entries[cut])
+            start = cut + 1
+        return ops
+
+def cmd_fast_import(args):
+    """Bridge function to import a fast-import stream from stdin."""
+    repo = repo_find()
+    start = time.perf_counter()
+    importer = fast_import(repo, sys.stdin.buffer, args.import_marks, args.export_marks, args.force)
+    elapsed = time.perf_counter() - start
+    print("Imported {0} objects ({1} commits) in {2:.2f}s ({3:.0f} objects/sec)".format(
+        importer.objects, importer.commits, elapsed, importer.objects / elapsed if elapsed else 0),
+          file=sys.stderr)
+
+@traced("fast-import", "import")
+def fast_import(repo, stream, import_marks=None, export_marks=None, force=False):
+    importer = GitFastImport(repo, stream, import_marks, export_marks, force)
+    importer.run()
+    return importer
+
+class GitFastImport(object):
+    """An import of a git fast-import stream (blob, commit, tag, reset,
+checkpoint, progress, feature, option and done commands, with raw
+dates), written into one new pack per checkpoint.
+
+Each branch keeps a GitTreeBuilder between its commits, so a commit only
+rewrites the trees along the paths it changes.  Refs and the marks file
+are updated at each checkpoint and at the end; as in git, unless force,
+a branch only moves to a commit containing its current tip."""
+    # Escapes of C-style quoted paths
+    escapes = { ord('a'): 7, ord('b'): 8, ord('f'): 12, ord('n'): 10, ord('r'): 13,
+                ord('t'): 9, ord('v'): 11, ord('\\'): 92, ord('"'): 34 }
+    modes = { b'644': b'100644', b'100644': b'100644', b'755': b'100755', b'100755': b'100755',
+              b'120000': b'120000', b'160000': b'160000', b'40000': b'040000', b'040000': b'040000' }
+
+    def __init__(self, repo, stream, import_marks=None, export_marks=None, force=False):
+        self.repo = repo
+        self.stream = stream
+        self.force = force
+        self.export_marks = export_marks
+        self.import_marks = import_marks
+        # Mark number -> SHA
+        self.marks = dict()
+        # SHA -> type of the objects we know without reading them
+        self.types = dict()
+        # Updated refs -> SHA, or None for a branch reset to nothing
+        self.refs = dict()
+        # Refs the last update refused to move
+        self.rejected = list()
+        # Branch ref -> GitTreeBuilder of its tip, and the last builder
+        # dropped, whose trees the next new builder reuses
+        self.builders = dict()
+        self.spare = None
+        # Commit SHA -> tree SHA, of the commits we wrote
+        self.commit_trees = dict()
+        self.line = None
+        self.done = False
+        self.objects = 0
+        self.commits = 0
+        self.writer = GitObjectWriter(repo, pack=True)
+        if import_marks:
+            self.read_marks(import_marks)
+
+    def run(self):
+        try:
+            self.parse()
+        except BaseException:
+            self.writer.__exit__(*sys.exc_info())
+            raise
+        self.writer.close()
+        self.update()
+        if self.rejected:
+            raise Exception("Not updating {0}: their new tips don't contain the old ones, import with --force to overwrite them".format(
+                ", ".join(self.rejected)))
+
+    def parse(self):
+        while True:
+            line = self.read_line()
+            if line is None:
+                if self.done:
+                    raise Exception("fast-import stream ended without \"done\"")
+                return
+            if not line:
+                continue
+            command, _, arg = line.partition(b' ')
+            match command:
+                case b'blob'       : self.cmd_blob()
+                case b'commit'     : self.cmd_commit(arg.decode("utf8"))
+                case b'tag'        : self.cmd_tag(arg.decode("utf8"))
+                case b'reset'      : self.cmd_reset(arg.decode("utf8"))
+                case b'checkpoint' : self.checkpoint()
+                case b'progress'   : print(line.decode("utf8", "replace"), flush=True)
+                case b'feature'    : self.cmd_feature(arg)
+                case b'option'     : pass
+                case b'done'       : return
+                case _: raise Exception("Unsupported fast-import command: {0}".format(line.decode("utf8", "replace")))
+
+    def read_line(self):
+        """Return the next line without its newline, or None at the end
+of the stream.  Comments are skipped."""
+        if self.line is not None:
+            line, self.line = self.line, None
+            return line
+        while True:
+            line = self.stream.readline()
+            if not line:
+                return None
+            if line.endswith(b'\n'):
+                line = line[:-1]
+            if not line.startswith(b'#'):
+                return line
+
+    def unread_line(self, line):
+        self.line = line
+
+    def read_data(self):
+        """Read a data command, exact byte count or <<delimited."""
+        line = self.read_line()
+        if line is None or not line.startswith(b'data '):
+            raise Exception("Expected data, got: {0}".format(line))
+        arg = line[5:]
+        if arg.startswith(b'<<'):
+            delim = arg[2:] + b'\n'
+            lines = list()
+            for l in iter(self.stream.readline, b''):
+                if l == delim:
+                    return b''.join(lines)
+                lines.append(l)
+            raise Exception("Data not terminated by {0}".format(arg[2:].decode("utf8", "replace")))
+        size = int(arg)
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise Exception("Truncated data: expected {0} bytes, got {1}".format(size, len(data)))
+        return data
+
+    def read_optional(self, prefix):
+        """Return what follows prefix on the next line, if it starts with
+it, or None."""
+        line = self.read_line()
+        if line is not None and line.startswith(prefix):
+            return line[len(prefix):]
+        self.unread_line(line)
+        return None
+
+    def write(self, fmt, data):
+        sha = self.writer.write_raw(fmt, data)
+        self.types[sha] = fmt
+        self.objects = len(self.writer.written)
+        return sha
+
+    def set_mark(self, mark, sha):
+        if mark is not None:
+            self.marks[int(mark[1:])] = sha
+
+    def resolve(self, name):
+        """Return the SHA of a :mark, a SHA, or a ref."""
+        if name.startswith(b':'):
+            mark = int(name[1:])
+            if mark not in self.marks:
+                raise Exception("Unknown mark: {0}".format(name.decode("ascii")))
+            return self.marks[mark]
+        name = name.decode("utf8")
+        if re.fullmatch(r"[0-9a-f]{40}", name):
+            return name
+        if self.refs.get(name):
+            return self.refs[name]
+        # How a stream continues a branch of the repository
+        if name.startswith("refs/") and ref_resolve(self.repo, name):
+            return ref_resolve(self.repo, name)
+        return object_find(self.repo, name, follow=False)
+
+    def commit_tree(self, sha):
+        if sha not in self.commit_trees:
+            self.commit_trees[sha] = object_find(self.repo, sha, fmt=b'tree')
+        return self.commit_trees[sha]
+
+    def cmd_blob(self):
+        mark = self.read_optional(b'mark ')
+        self.read_optional(b'original-oid ')
+        self.set_mark(mark, self.write(b'blob', self.read_data()))
+
+    def cmd_commit(self, ref):
+        if not ref.startswith("refs/"):
+            raise Exception("Not a ref: {0}".format(ref))
+        mark = self.read_optional(b'mark ')
+        self.read_optional(b'original-oid ')
+        author = self.read_optional(b'author ')
+        committer = self.read_optional(b'committer ')
+        if committer is None:
+            raise Exception("Commit to {0} has no committer".format(ref))
+        encoding = self.read_optional(b'encoding ')
+        message = self.read_data()
+
+        # Without from, a branch this stream did not touch yet starts a new
+        # root, whatever the repository has under that name
+        tip = self.refs.get(ref)
+        builder = self.builders.get(ref)
+        start = self.read_optional(b'from ')
+        if start is not None:
+            start = self.resolve(start)
+            if start == "0" * 40:
+                start = None
+            if start != tip:
+                tip = start
+                self.spare = self.builders.pop(ref, None) or self.spare
+                builder = None
+        if builder is None:
+            builder = GitTreeBuilder(self.writer, self.commit_tree(tip) if tip else None, self.spare)
+            self.builders[ref] = builder
+            self.spare = None
+
+        parents = [ tip ] if tip else list()
+        while True:
+            merge = self.read_optional(b'merge ')
+            if merge is None:
+                break
+            parents.append(self.resolve(merge))
+
+        self.read_changes(builder)
+
+        kvlm = collections.OrderedDict()
+        kvlm[b'tree'] = builder.write().encode("ascii")
+        if parents:
+            kvlm[b'parent'] = [ p.encode("ascii") for p in parents ] if len(parents) > 1 else parents[0].encode("ascii")
+        # As in git, the author defaults to the committer
+        kvlm[b'author'] = author if author is not None else committer
+        kvlm[b'committer'] = committer
+        if encoding is not None:
+            kvlm[b'encoding'] = encoding
+        kvlm[None] = message
+        sha = self.write(b'commit', kvlm_serialize(kvlm))
+        self.commit_trees[sha] = builder.root.sha
+        self.set_mark(mark, sha)
+        self.refs[ref] = sha
+        self.commits += 1
+
+    def read_changes(self, builder):
+        """Apply the file changes of a commit to builder."""
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            if not line:
+                continue
+            match line[:2]:
+                case b'M ':
+                    mode, dataref, path = line[2:].split(b' ', 2)
+                    if mode not in self.modes:
+                        raise Exception("Bad file mode: {0}".format(mode.decode("utf8", "replace")))
+                    path, _ = self.read_path(path, last=True)
+                    if dataref == b'inline':
+                        sha = self.write(b'blob', self.read_data())
+                    else:
+                        sha = self.resolve(dataref)
+                    if path:
+                        builder.set(path, self.modes[mode], sha)
+                    elif self.modes[mode] == b'040000':
+                        builder.root = GitTreeNode(sha)
+                    else:
+                        raise Exception("Empty path in: {0}".format(line.decode("utf8", "replace")))
+                case b'D ':
+                    path, _ = self.read_path(line[2:], last=True)
+                    if path:
+                        builder.remove(path)
+                    else:
+                        builder.clear()
+                case b'C ' | b'R ':
+                    source, rest = self.read_path(line[2:])
+                    target, _ = self.read_path(rest, last=True)
+                    item = builder.remove(source) if line[:1] == b'R' else builder.get(source)
+                    if item is None:
+                        raise Exception("Path not in branch: {0}".format(source))
+                    if type(item) == GitTreeNode:
+                        # Copies share the written tree, not the node
+                        item = GitTreeNode(builder.write_node(item))
+                    builder.put(target, item)
+                case _ if line == b'deleteall':
+                    builder.clear()
+                case _:
+                    self.unread_line(line)
+                    return
+
+    def read_path(self, raw, last=False):
+        """Return a path, unquoting C-style quotes, and what follows it.
+Unless it is quoted, the last path of a line takes all of it."""
+        if not raw.startswith(b'"'):
+            if last:
+                return raw.decode("utf8"), b''
+            path, _, rest = raw.partition(b' ')
+            return path.decode("utf8"), rest
+
+        path = bytearray()
+        i = 1
+        while raw[i] != ord('"'):
+            c = raw[i]
+            if c == ord('\\'):
+                i += 1
+                if raw[i] in self.escapes:
+                    c = self.escapes[raw[i]]
+                else:
+                    c = int(raw[i:i + 3], 8)
+                    i += 2
+            path.append(c)
+            i += 1
+        return path.decode("utf8"), raw[i + 1:].lstrip(b' ')
+
+    def cmd_tag(self, name):
+        mark = self.read_optional(b'mark ')
+        target = self.read_optional(b'from ')
+        if target is None:
+            raise Exception("Tag {0} has no from".format(name))
+        target = self.resolve(target)
+        self.read_optional(b'original-oid ')
+        tagger = self.read_optional(b'tagger ')
+        message = self.read_data()
+
+        fmt = self.types.get(target) or object_header(self.repo, target)[0]
+        kvlm = collections.OrderedDict()
+        kvlm[b'object'] = target.encode("ascii")
+        kvlm[b'type'] = fmt
+        kvlm[b'tag'] = name.encode("utf8")
+        if tagger is not None:
+            kvlm[b'tagger'] = tagger
+        kvlm[None] = message
+        sha = self.write(b'tag', kvlm_serialize(kvlm))
+        self.set_mark(mark, sha)
+        self.refs["refs/tags/" + name] = sha
+
+    def cmd_reset(self, ref):
+        start = self.read_optional(b'from ')
+        self.refs[ref] = self.resolve(start) if start is not None else None
+        self.spare = self.builders.pop(ref, None) or self.spare
+
+    def cmd_feature(self, arg):
+        name, _, value = arg.decode("utf8").partition("=")
+        match name:
+            case "done":
+                self.done = True
+            case "import-marks" | "import-marks-if-exists":
+                # Command line options win over the stream
+                if not self.import_marks and (name == "import-marks" or os.path.exists(value)):
+                    self.import_marks = value
+                    self.read_marks(value)
+            case "export-marks":
+                self.export_marks = self.export_marks or value
+            case "date-format":
+                if value != "raw":
+                    raise Exception("Unsupported date format: {0}".format(value))
+            case "force":
+                self.force = True
+            case _:
+                raise Exception("Unsupported fast-import feature: {0}".format(name))
+
+    def read_marks(self, path):
+        with open(path) as f:
+            for line in f:
+                mark, sha = line.split()
+                self.marks[int(mark[1:])] = sha
+
+    def checkpoint(self):
+        """Finish the current pack, so everything so far can be read, and
+update refs and marks.  The next objects go to a new pack."""
+        self.writer.checkpoint()
+        self.update()
+
+    def update(self):
+        self.rejected = list()
+        for ref, sha in self.refs.items():
+            if not sha:
+                continue
+            old = ref_resolve(self.repo, ref)
+            if old == sha:
+                continue
+            if old and not self.force and not ref.startswith("refs/tags/") and not is_ancestor(self.repo, old, sha):
+                print("warning: Not updating {0} (new tip {1} does not contain {2})".format(ref, sha, old), file=sys.stderr)
+                self.rejected.append(ref)
+                continue
+            ref_create(self.repo, ref[len("refs/"):], sha)
+        if self.export_marks:
+            marks = "".join(":{0} {1}\n".format(mark, sha) for mark, sha in sorted(self.marks.items()))
+            object_write_file(os.path.abspath(self.export_marks), marks.encode("ascii"), 0o644)
+
+def cmd_grep(args):
+    """Bridge function to search the worktree, the index or a commit.
+
+Each distinct file content is read and searched once, by a process pool;
+matches are printed in path order as soon as they are known.  Files over
+core.bigFileThreshold are skipped from their object header (or stat)
+alone, binary ones once read."""
+    repo = repo_find()
+    flags = re.MULTILINE | (re.IGNORECASE if args.ignore_case else 0)
+    threshold = repo_big_file_threshold(repo)
+
+    # (path, task), task being (sha, None) for a blob, or (None, path) for
+    # a worktree file
+    prefix = ""
+    if args.rev:
+        prefix = args.rev + ":"
+        files = [ (path, (sha, None)) for path, mode, sha in grep_tree_files(repo, object_find(repo, args.rev, fmt=b'tree'), args.paths) ]
+    else:
+        files = list()
+        for e in index_read(repo).entries:
+            # As in git, symlinks, submodules and files outside the sparse
+            # checkout are not searched
+            if e.mode_type != 0b1000 or e.flag_skip_worktree or not path_limit_match(args.paths, e.name):
+                continue
+            files.append((e.name, (e.sha, None) if args.cached else (None, e.name)))
+
+    results = dict()
+    tasks = list()
+    for task in dict.fromkeys(task for _, task in files):
+        sha, path = task
+        if sha:
+            header = object_header(repo, sha)
+            if header is None:
+                raise Exception("bad object {0}".format(sha))
+            size = header[1]
+        else:
+            try:
+                size = os.lstat(os.path.join(repo.worktree, path)).st_size
+            except FileNotFoundError:
+                size = None
+        if size is None or size > threshold:
+            results[task] = None
+        else:
+            tasks.append(task)
+
+    matched = False
+    out = sys.stdout.buffer
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                initializer=grep_worker_init,
+                                                initargs=(repo.worktree, args.pattern, flags)) as pool:
+        found = zip(tasks, pool.map(grep_search, tasks, chunksize=64))
+        for path, task in files:
+            while task not in results:
+                done, lines = next(found)
+                results[done] = lines
+            lines = results[task]
+            if not lines:
+                continue
+            matched = True
+            name = (prefix + path).encode("utf8")
+            if args.files_with_matches:
+                out.write(name + b'\n')
+                continue
+            for lineno, line in lines:
+                if args.line_number:
+                    out.write(b"%s:%d:%s\n" % (name, lineno, line))
+                else:
+                    out.write(b"%s:%s\n" % (name, line))
+    out.flush()
+
+    if not matched:
+        sys.exit(1)
+
+def grep_tree_files(repo, tree, paths, prefix=""):
+    """Yield the (path, mode, sha) of the blobs of tree selected by the
+path limits, in path order, without reading the trees they prune.
+Symlinks and submodules are left out."""
+    for leaf in object_read(repo, tree).items:
+        path = prefix + leaf.path
+        if leaf.mode == b'040000':
+            if path_limit_match(paths, path, is_tree=True):
+                yield from grep_tree_files(repo, leaf.sha, paths, path + "/")
+        elif leaf.mode.startswith(b'100') and path_limit_match(paths, path):
+            yield path, leaf.mode, leaf.sha
+
+def grep_worker_init(worktree, pattern, flags):
+    global grep_worker_repo, grep_worker_regex
+    grep_worker_repo = GitRepository(worktree)
+    grep_worker_regex = re.compile(pattern.encode("utf8"), flags)
+
+def grep_search(task):
+    """Return the (line number, line) of the matching lines of a blob or
+worktree file, or None if it is binary or gone."""
+    sha, path = task
+    repo = grep_worker_repo
+    if sha:
+        data = object_read_raw(repo, sha)[1]
+    else:
+        try:
+            with open(os.path.join(repo.worktree, path), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+    # As git, call binary what has a NUL in its first 8000 bytes
+    if b'\x00' in data[:8000]:
+        return None
+    return grep_lines(grep_worker_regex, data)
+
+def grep_lines(regex, data):
+    """Return the (line number, line) of each line of data matching regex."""
+    ret = list()
+    pos = 0
+    lineno = 1
+    counted = 0
+    while pos < len(data):
+        m = regex.search(data, pos)
+        if not m:
+            break
+        start = data.rfind(b'\n', 0, m.start()) + 1
+        end = data.find(b'\n', m.start())
+        if end < 0:
+            end = len(data)
+        lineno += data.count(b'\n', counted, start)
+        counted = start
+        ret.append((lineno, data[start:end]))
+        pos = end + 1
+    return ret
+
+def cmd_archive(args):
+    """Bridge function to archive a commit or tree.
 
+The archive is streamed: entries are written in path order as their
+blobs arrive, while a thread pool reads the next few ahead, so memory
+holds a bounded window of blobs, not the tree."""
+    repo = repo_find()
+    fmt = args.format
+    if not fmt:
+        fmt = next((f for f in ("tar.gz", "tgz", "zip") if args.output and args.output.endswith("." + f)), "tar")
+
+    # As in git, every entry gets the time of the commit, or the current
+    # time when archiving a tree
+    commit = object_find(repo, args.rev, fmt=b'commit')
+    mtime = int(time.time())
+    if commit:
+        mtime = int(object_read(repo, commit).kvlm[b'committer'].split()[-2])
+    tree = object_find(repo, args.rev, fmt=b'tree')
+
+    # Path limits are relative to the tree, not to the prefix
+    entries = ((args.prefix + path, mode, sha) for path, mode, sha in archive_entries(repo, tree, args.paths))
+    if args.prefix.endswith("/"):
+        # As in git, a directory prefix gets an entry of its own, first
+        entries = itertools.chain([ (args.prefix, b'040000', None) ], entries)
+    entries = archive_read_ahead(repo, entries, args.jobs)
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        if fmt == "zip":
+            archive_zip(out, entries, mtime)
+        else:
+            archive_tar(out, entries, mtime, fmt != "tar", commit)
+    finally:
+        if args.output:
+            out.close()
+        else:
+            out.flush()
+
+def archive_entries(repo, tree, paths, prefix=""):
+    """Yield the (path, mode, sha) of every entry of tree selected by the
+path limits, directories first, in path order."""
+    for leaf in object_read(repo, tree).items:
+        path = prefix + leaf.path
+        if leaf.mode == b'040000':
+            if path_limit_match(paths, path, is_tree=True):
+                yield path + "/", leaf.mode, leaf.sha
+                yield from archive_entries(repo, leaf.sha, paths, path + "/")
+        elif path_limit_match(paths, path):
+            yield path, leaf.mode, leaf.sha
+
+def archive_read_ahead(repo, entries, jobs=None, window=None):
+    """Yield (path, mode, data) for each (path, mode, sha) of entries, in
+order.  Blobs are read by a thread pool up to window entries ahead;
+directories and submodules have no data."""
+    jobs = jobs or os.cpu_count() or 1
+    window = window or 4 * jobs
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for path, mode, sha in entries:
+            future = None
+            if mode.startswith(b'10') or mode == b'120000':
+                future = pool.submit(object_read_raw, repo, sha)
+            pending.append((path, mode, future))
+            while len(pending) > window or (pending and pending[0][2] is None):
+                path, mode, future = pending.popleft()
+                yield path, mode, future.result()[1] if future else None
+        while pending:
+            path, mode, future = pending.popleft()
+            yield path, mode, future.result()[1] if future else None
+
+def archive_tar(out, entries, mtime, gzip=False, commit=None):
+    """Stream a tar of entries to out.  As git archive, it has a pax
+comment with the commit, and files owned by root."""
+    pax = { "comment": commit } if commit else {}
+    with tarfile.open(fileobj=out, mode="w|gz" if gzip else "w|", format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
+        for path, mode, data in entries:
+            info = tarfile.TarInfo(path.rstrip("/"))
+            info.mtime = mtime
+            info.uname = info.gname = "root"
+            if data is None:
+                # Directories, and submodules as empty directories
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o775
+                tar.addfile(info)
+            elif mode == b'120000':
+                info.type = tarfile.SYMTYPE
+                info.mode = 0o777
+                info.linkname = data.decode("utf8")
+                tar.addfile(info)
+            else:
+                info.mode = 0o775 if mode == b'100755' else 0o664
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+def archive_zip(out, entries, mtime):
+    """Stream a zip of entries to out, which need not be seekable."""
+    # Zip can't date anything before 1980
+    date_time = time.localtime(max(mtime, 315532800))[:6]
+    with zipfile.ZipFile(out, "w") as z:
+        for path, mode, data in entries:
+            if data is None:
+                # Submodules too are directories, and zip names them so
+                path = path.rstrip("/") + "/"
+            info = zipfile.ZipInfo(path, date_time)
+            info.create_system = 3
+            if data is None:
+                info.external_attr = (0o40775 << 16) | 0x10
+                z.writestr(info, b'')
+            elif mode == b'120000':
+                info.external_attr = 0o120777 << 16
+                z.writestr(info, data)
+            else:
+                info.external_attr = (0o100775 if mode == b'100755' else 0o100664) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                z.writestr(info, data)
+
+def cmd_count_objects(args):
+    """Bridge function to count the loose and packed objects, and the
+disk space they use, as git count-objects does."""
+    repo = repo_find()
+    counts = count_objects(repo)
+    if not args.verbose:
+        print("{0} objects, {1} kilobytes".format(counts["count"], counts["size"]))
+        return
+    for key, value in counts.items():
+        print("{0}: {1}".format(key, value))
+    for alt in repo_alternates(repo):
+        print("alternate: {0}".format(repo_path(alt, "objects")))
+
+def count_objects(repo):
+    """Return the counts of git count-objects -v, in its order: loose
+objects and their disk usage in KiB, packed objects, packs and their
+size in KiB, loose objects also in a pack, and garbage files.  Only
+directory listings and stats are read."""
+    counts = { "count": 0, "size": 0, "in-pack": 0, "packs": 0, "size-pack": 0,
+               "prune-packable": 0, "garbage": 0, "size-garbage": 0 }
+    path = repo_dir(repo, "objects")
+    loose = 0
+    garbage = 0
+    for d in sorted(os.listdir(path)):
+        if len(d) != 2 or not os.path.isdir(os.path.join(path, d)):
+            continue
+        with os.scandir(os.path.join(path, d)) as it:
+            for f in it:
+                if len(f.name) == 38 and re.fullmatch(r"[0-9a-f]{38}", f.name):
+                    counts["count"] += 1
+                    loose += f.stat().st_blocks * 512
+                    if pack_locate(repo, d + f.name):
+                        counts["prune-packable"] += 1
+                elif not f.name.startswith("tmp_obj_"):
+                    counts["garbage"] += 1
+                    garbage += f.stat().st_size
+
+    for pack in pack_list(repo):
+        counts["in-pack"] += pack.fanout[255]
+        counts["packs"] += 1
+        counts["size-pack"] += len(pack.data) + len(pack.idx)
+
+    # Files of objects/pack which no pack explains
+    known = (".pack", ".idx", ".keep", ".bitmap", ".rev", ".promisor", ".mtimes")
+    pack_dir = repo_dir(repo, "objects", "pack")
+    for f in sorted(os.listdir(pack_dir)) if pack_dir else ():
+        full_path = os.path.join(pack_dir, f)
+        if f == "multi-pack-index" or f.startswith("tmp_") or not os.path.isfile(full_path):
+            continue
+        if not f.endswith(known) or not os.path.exists(os.path.splitext(full_path)[0] + ".idx"):
+            counts["garbage"] += 1
+            garbage += os.path.getsize(full_path)
+
+    counts["size"] = loose // 1024
+    counts["size-pack"] //= 1024
+    counts["size-garbage"] = garbage // 1024
+    return counts
+
+def cmd_sizer(args):
+    """Bridge function to report what takes space in the repository."""
+    repo = repo_find()
+    start = time.perf_counter()
+    report = sizer(repo, args.top, args.jobs)
+    elapsed = time.perf_counter() - start
+
+    store = report.store
+    print("Object store")
+    print("  {0:<24} {1:>12}   {2}".format("loose objects", store["count"], format_size(store["size"] * 1024)))
+    print("  {0:<24} {1:>12}   {2} in {3} packs".format("packed objects", store["in-pack"], format_size(store["size-pack"] * 1024), store["packs"]))
+    for fmt in (b'commit', b'tree', b'blob', b'tag'):
+        print("  {0:<24} {1:>12}   {2}".format(fmt.decode("ascii") + "s", report.types[fmt], format_size(report.type_sizes[fmt])))
+    depths = report.delta_depths
+    packed = sum(depths.values())
+    print("  {0:<24} {1:>12}   mean {2:.2f}".format("max delta chain depth", max(depths, default=0),
+                                                    sum(d * n for d, n in depths.items()) / packed if packed else 0))
+    for lo, hi in ((0, 0), (1, 9), (10, 49), (50, None)):
+        n = sum(count for d, count in depths.items() if d >= lo and (hi is None or d <= hi))
+        label = "depth {0}".format(lo) if lo == hi else "depth {0}+".format(lo) if hi is None else "depth {0}-{1}".format(lo, hi)
+        print("    {0:<22} {1:>12}".format(label, n))
+
+    print("\nReachable history")
+    print("  {0:<24} {1:>12}".format("refs", report.refs))
+    print("  {0:<24} {1:>12}".format("commits", report.commits))
+    print("  {0:<24} {1:>12}".format("history depth", report.history_depth))
+    print("  {0:<24} {1:>12}".format("max parents", report.max_parents))
+    print("  {0:<24} {1:>12}   {2} entries".format("trees", report.trees, report.tree_entries))
+    print("  {0:<24} {1:>12}   {2}".format("blobs", report.blobs, format_size(report.blob_size)))
+
+    tables = (("Largest paths (every version)", [ (format_size(size), "{0} versions".format(n), path) for size, n, path in report.paths ]),
+              ("Largest directories", [ (format_size(size), "", path) for size, path in report.directories ]),
+              ("Largest blobs", [ (format_size(size), sha[:12], path) for size, sha, path in report.largest_blobs ]),
+              ("Widest trees", [ ("{0} entries".format(n), sha[:12], path + "/") for n, sha, path in report.widest_trees ]),
+              ("Largest objects", [ (format_size(size), sha[:12], fmt.decode("ascii")) for size, sha, fmt in report.largest_objects ]))
+    for title, rows in tables:
+        print("\n" + title)
+        for row in rows:
+            print("  {0:>12}  {1:<14} {2}".format(*row))
+
+    print("Sized {0} objects in {1:.2f}s".format(store["count"] + store["in-pack"], elapsed), file=sys.stderr)
+
+def format_size(n):
+    """Return n bytes in a readable unit, as "1.5 MiB"."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024:
+            return "{0:.1f} {1}".format(n, unit) if unit != "B" else "{0} B".format(n)
+        n /= 1024
+    return "{0:.1f} TiB".format(n)
+
+class GitSizerReport(object):
+    """What sizer found.  Sizes are those of inflated objects; top lists
+are biggest first."""
+    # count_objects of the object store
+    store = None
+    # Objects of each type in the store, and their total size
+    types = None
+    type_sizes = None
+    # Packed objects by length of their delta chain, 0 for whole objects
+    delta_depths = None
+    # (size, sha, fmt) of the biggest objects of the store
+    largest_objects = None
+    # The graph reachable from the refs
+    refs = 0
+    commits = 0
+    # Commits in the longest chain of parents
+    history_depth = 0
+    max_parents = 0
+    trees = 0
+    tree_entries = 0
+    blobs = 0
+    blob_size = 0
+    # (entries, sha, path) of the widest trees
+    widest_trees = None
+    # (size, sha, path) of the biggest blobs, at the first path seen
+    largest_blobs = None
+    # (size, versions, path): every blob is counted once, at the first
+    # path it is seen at
+    paths = None
+    # (size, path) of top level directories ("dir/"), or "." for the
+    # files of the root
+    directories = None
+
+@traced("sizer", "sizer")
+def sizer(repo, top=10, jobs=None):
+    """Return the GitSizerReport of repo.
+
+Everything streams, so no object content is kept: first the object
+store, where packs are split in ranges of entries and every object is
+sized and typed from its header alone (delta chains are followed
+through entry headers only); then the graph reachable from the refs.
+Commits are walked from their headers; trees are read level by level,
+each distinct tree once, and each distinct blob is sized from its
+header.  Both the store and the tree levels are spread over a process
+pool.  Memory grows with the number of distinct reachable objects (a
+set of binary SHAs) and of distinct paths, not with their sizes."""
+    report = GitSizerReport()
+    report.store = count_objects(repo)
+    report.types = collections.Counter()
+    report.type_sizes = collections.Counter()
+    report.delta_depths = collections.Counter()
+
+    tasks = list()
+    path = repo_dir(repo, "objects")
+    for d in sorted(os.listdir(path)):
+        if len(d) == 2 and os.path.isdir(os.path.join(path, d)):
+            tasks.append((None, d, None))
+    for pack in pack_list(repo):
+        for lo in range(0, pack.fanout[255], 4096):
+            tasks.append((pack.path, lo, min(lo + 4096, pack.fanout[255])))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                initializer=sizer_worker_init,
+                                                initargs=(repo.worktree, top)) as pool:
+        largest = list()
+        for types, sizes, depths, biggest in pool.map(sizer_store, tasks):
+            report.types.update(types)
+            report.type_sizes.update(sizes)
+            report.delta_depths.update(depths)
+            largest = heapq.nlargest(top, largest + biggest)
+        report.largest_objects = largest
+
+        roots = sizer_commits(repo, report)
+        sizer_trees(repo, report, roots, pool, top)
+
+    return report
+
+def sizer_commits(repo, report):
+    """Walk the commits reachable from the refs, peeling tags, into
+report, and return the (tree, path) of the root trees to walk."""
+    tips = list(dict.fromkeys(ref_tips(repo)))
+    report.refs = len(tips)
+    roots = list()
+    parents = dict()
+    stack = list()
+    for sha in tips:
+        fmt = object_header(repo, sha)[0]
+        while fmt == b'tag':
+            sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+            fmt = object_header(repo, sha)[0]
+        if fmt == b'commit':
+            stack.append(sha)
+        elif fmt == b'tree':
+            roots.append((sha, ""))
+
+    while stack:
+        sha = stack.pop()
+        if sha in parents:
+            continue
+        # A local walk: the commit cache of the repository may be shared
+        links = commit_read_links(repo, sha)
+        parents[sha] = links[0]
+        roots.append((links[2], ""))
+        stack.extend(p for p in links[0] if p not in parents)
+
+    report.commits = len(parents)
+    report.max_parents = max((len(p) for p in parents.values()), default=0)
+
+    # The longest chain of parents: each commit is one more than its
+    # deepest parent, computed parents first
+    depth = dict()
+    for sha in parents:
+        stack = [ sha ]
+        while stack:
+            c = stack[-1]
+            if c in depth:
+                stack.pop()
+                continue
+            todo = [ p for p in parents[c] if p not in depth ]
+            if todo:
+                stack.extend(todo)
+            else:
+                depth[c] = 1 + max((depth[p] for p in parents[c]), default=0)
+                stack.pop()
+    report.history_depth = max(depth.values(), default=0)
+    return roots
+
+def sizer_trees(repo, report, roots, pool, top):
+    """Walk the trees from roots into report, level by level: the trees
+of a level are read by the pool, then the blobs they add are sized from
+their headers, also by the pool."""
+    seen = set()
+    paths = collections.defaultdict(lambda: [ 0, 0 ])
+    widest = list()
+    largest = list()
+
+    level = list()
+    for sha, path in roots:
+        sha = bytes.fromhex(sha)
+        if sha not in seen:
+            seen.add(sha)
+            level.append((sha, path))
+
+    while level:
+        following = list()
+        # Bounded batches, so a wide level doesn't pile up its entries
+        for i in range(0, len(level), 4096):
+            batch = level[i:i + 4096]
+            blobs = list()
+            for (sha, path), entries in zip(batch, pool.map(sizer_tree, [ sha for sha, _ in batch ], chunksize=64)):
+                report.trees += 1
+                report.tree_entries += len(entries)
+                item = (len(entries), sha.hex(), path)
+                if len(widest) < top:
+                    heapq.heappush(widest, item)
+                elif item > widest[0]:
+                    heapq.heapreplace(widest, item)
+
+                for mode, name, child in entries:
+                    if child in seen or mode.startswith(b'16'):
+                        continue
+                    seen.add(child)
+                    child_path = path + "/" + name if path else name
+                    if mode.startswith(b'04'):
+                        following.append((child, child_path))
+                    else:
+                        blobs.append((child, child_path))
+
+            sizes = pool.map(sizer_size, [ sha for sha, _ in blobs ], chunksize=256)
+            for (sha, path), size in zip(blobs, sizes):
+                report.blobs += 1
+                report.blob_size += size
+                entry = paths[path]
+                entry[0] += size
+                entry[1] += 1
+                item = (size, sha.hex(), path)
+                if len(largest) < top:
+                    heapq.heappush(largest, item)
+                elif item > largest[0]:
+                    heapq.heapreplace(largest, item)
+        level = following
+
+    report.widest_trees = sorted(widest, reverse=True)
+    report.largest_blobs = sorted(largest, reverse=True)
+    report.paths = heapq.nlargest(top, ((size, n, path) for path, (size, n) in paths.items()))
+    directories = collections.Counter()
+    for path, (size, _) in paths.items():
+        directories[path.split("/", 1)[0] + "/" if "/" in path else "."] += size
+    report.directories = [ (size, path) for path, size in directories.most_common(top) ]
+
+# The repository each sizer worker process reads from, and the length
+# of the top lists
+sizer_worker_repo = None
+sizer_worker_top = None
+
+def sizer_worker_init(worktree, top):
+    global sizer_worker_repo, sizer_worker_top
+    sizer_worker_repo = GitRepository(worktree)
+    sizer_worker_top = top
+
+def sizer_store(task):
+    """Size and type the loose objects of one objects/ subdirectory, or
+the entries lo to hi of a pack index, from their headers.  Returns
+(objects by type, sizes by type, objects by delta depth, biggest)."""
+    path, lo, hi = task
+    repo = sizer_worker_repo
+    types = collections.Counter()
+    sizes = collections.Counter()
+    depths = collections.Counter()
+    objects = list()
+
+    if path is None:
+        for f in os.listdir(repo_path(repo, "objects", lo)):
+            if len(f) == 38:
+                fmt, size = object_header(repo, lo + f)
+                objects.append((size, lo + f, fmt))
+    else:
+        pack = next(p for p in pack_list(repo) if p.path == path)
+        memo = dict()
+        for i in range(lo, hi):
+            offset = pack_offset(pack, i)
+            kind, size, pos, _ = pack_header(pack, offset)
+            fmt, depth = pack_chain(repo, pack, offset, memo)
+            depths[depth] += 1
+            objects.append((pack_object_size(pack, kind, size, pos), pack.names[20*i:20*i + 20].hex(), fmt))
+
+    for size, _, fmt in objects:
+        types[fmt] += 1
+        sizes[fmt] += size
+    return types, sizes, depths, heapq.nlargest(sizer_worker_top, objects)
+
+def sizer_tree(sha):
+    """Return the (mode, name, binary sha) entries of tree sha."""
+    data = object_read_raw(sizer_worker_repo, sha.hex())[1]
+    entries = list()
+    pos = 0
+    while pos < len(data):
+        x = data.find(b' ', pos)
+        y = data.find(b'\x00', x)
+        # Trees spell the mode of directories 40000
+        mode = data[pos:x].rjust(6, b'0')
+        entries.append((mode, data[x+1:y].decode("utf8", "replace"), data[y+1:y+21]))
+        pos = y + 21
+    return entries
+
+def sizer_size(sha):
+    """Return the size of object sha, from its header."""
+    return object_header(sizer_worker_repo, sha.hex())[1]
+
+# The executor of GitAsyncRepository, created by repo_executor
+repo_executor_pool = None
+repo_executor_lock = threading.Lock()
+
+def repo_executor():
+    """Return the thread pool which runs the blocking work of every
+GitAsyncRepository of the process.  It is bounded, with the default size
+of concurrent.futures, so however many requests are in flight only that
+many files are read or objects inflated at once (zlib and file reads
+release the GIL)."""
+    global repo_executor_pool
+    with repo_executor_lock:
+        if repo_executor_pool is None:
+            repo_executor_pool = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="tft")
+    return repo_executor_pool
+
+async def repo_open_async(path=".", executor=None):
+    """Return a GitAsyncRepository on the repository holding path."""
+    loop = asyncio.get_running_loop()
+    repo = await loop.run_in_executor(executor or repo_executor(), repo_find, path)
+    return GitAsyncRepository(repo, executor)
+
+class GitAsyncRepository(object):
+    """An asyncio handle on a repository, for services serving many of
+them at once.  Its coroutines return the data the library functions
+return, running those on an executor: by default the one
+repo_executor() shares across the process.  The repository should come
+from repo_open, so handles on it share its packs and caches."""
+    repo = None
+    executor = None
+
+    def __init__(self, repo, executor=None):
+        self.repo = repo
+        self.executor = executor
+
+    async def run(self, f, *args):
+        """Return f(repo, *args), run on the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor or repo_executor(),
+                                          functools.partial(f, self.repo, *args))
+
+    async def read_object(self, sha):
+        return await self.run(object_read, sha)
+
+    async def read_raw(self, sha):
+        return await self.run(object_read_raw, sha)
+
+    async def resolve(self, name, fmt=None):
+        return await self.run(object_find, name, fmt)
+
+    async def ls_tree(self, ref, recursive=False, paths=None):
+        return await self.run(lambda repo: list(tree_entries(repo, ref, recursive, paths=paths)))
+
+    async def ls_files(self, paths=None):
+        return await self.run(lambda repo: list(index_entries_limited(index_read(repo), paths)))
+
+    async def status(self, paths=None):
+        return await self.run(status, paths)
+
+    async def merge_bases(self, one, twos):
+        return await self.run(merge_bases, one, twos)
+
+    async def is_ancestor(self, ancestor, commit):
+        return await self.run(is_ancestor, ancestor, commit)
+
+    async def walk(self, tips, batch=64):
+        """Yield the (sha, GitCommit) of the commits reachable from tips
+(names or SHAs), newest first.  They are read batch commits at a time,
+so the executor isn't entered for every commit."""
+        shas = [ await self.resolve(name, b'commit') for name in tips ]
+        commits = commits_walk(self.repo, shas)
+        while True:
+            chunk = await self.run(lambda repo: list(itertools.islice(commits, batch)))
+            if not chunk:
+                return
+            for commit in chunk:
+                yield commit